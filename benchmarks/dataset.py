@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""Fill the database with a seeded synthetic dataset: occurrences come in bursts
+(mostly during the day), targets and locations are Zipf distributed, and only
+part of the locations have coordinates. The same seed and sizes always give
+the same occurrences, relative to the day they are generated on, so the
+dashboard always has recent ones. Occurrences are added through bulk.import_rows, so the
+daily rollup and the materialized views are filled like after an import.
+
+Usage: python -m benchmarks.dataset --occurrences N [--seed N] [--database NAME]
+
+Without --database this writes to the database of the environment (.env).
+With it, that database is created first if it doesn't exist.
+"""
+import argparse
+import bisect
+import itertools
+import os
+import random
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy.dialects.postgresql import insert
+
+from kill_your_selfie import aggregates, bulk, cache, database, models
+from kill_your_selfie.app import create_app
+from kill_your_selfie.config import Config
+
+WORDS = ("kill", "yourself", "selfie", "homework", "bus", "again", "monday", "printer", "wifi", "exam",
+         "coffee", "rain", "train", "meeting", "deadline", "game", "lost", "late", "why", "please")
+# relative chance of a burst starting in every hour of the day
+HOUR_WEIGHTS = (1, 1, 0.5, 0.2, 0.2, 0.2, 0.5, 2, 4, 5, 5, 6, 7, 6, 5, 5, 6, 7, 8, 8, 7, 5, 3, 2)
+
+
+def _zipf_sampler(rng: random.Random, values: list, exponent: float):
+    """function returning one of values, the k-th one with a chance proportional to 1 / k ** exponent"""
+    cumulative = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, len(values) + 1)))
+    return lambda: values[bisect.bisect(cumulative, rng.random() * cumulative[-1])]
+
+
+def generate_locations(seed: int, count: int = 100, mapped_fraction: float = 0.6) -> list[tuple]:
+    """(label, latitude, longitude) of count locations, with coordinates (around the
+    Netherlands) for about mapped_fraction of them and None for the others
+    """
+    rng = random.Random(seed)
+    locations = []
+    for number in range(count):
+        if rng.random() < mapped_fraction:
+            locations.append((f"location {number}", round(rng.gauss(52.1, 0.6), 6), round(rng.gauss(5.3, 0.8), 6)))
+        else:
+            locations.append((f"location {number}", None, None))
+    return locations
+
+
+def generate_occurrences(count: int, seed: int, locations: list[str], targets: int = 200, days: int = 730,
+                         end: datetime = None):
+    """Yield count occurrence rows (as bulk.import_rows takes them) within the days before end (today),
+    in order of time. Some days are much busier than others, and on every day bursts of on
+    average 4 occurrences a few minutes apart start at random (mostly daytime) hours.
+    """
+    rng = random.Random(seed)
+    end = end or datetime.combine(date.today(), time())
+    start = end - timedelta(days=days)
+    target = _zipf_sampler(rng, [f"target {number}" for number in range(targets)], 1.1)
+    location = _zipf_sampler(rng, locations, 1.3)
+    hours = list(range(24))
+    day_weights = list(itertools.accumulate(rng.lognormvariate(0, 1) for _ in range(days)))
+
+    previous = None
+    allocated = 0
+    for day in range(days):
+        # occurrences of this day, rounded so they add up to count
+        quota = round(count * day_weights[day] / day_weights[-1]) - allocated
+        allocated += quota
+        bursts = []
+        while quota > 0:
+            size = min(quota, 1 + int(rng.expovariate(1 / 3)))
+            offset = timedelta(days=day, hours=rng.choices(hours, HOUR_WEIGHTS)[0], seconds=rng.randrange(3600))
+            bursts.append((offset, size))
+            quota -= size
+        bursts.sort()
+
+        for offset, size in bursts:
+            # a burst mostly stays at one location and with one target
+            burst_location, burst_target = location(), target()
+            occurrence_time = start + offset
+            for _ in range(size):
+                occurrence_time += timedelta(seconds=rng.expovariate(1 / 120), microseconds=rng.randrange(1_000_000))
+                if previous is not None and occurrence_time <= previous:
+                    occurrence_time = previous + timedelta(microseconds=1)  # times are unique
+                previous = occurrence_time
+                yield {
+                    "time": occurrence_time,
+                    "location_label": burst_location if rng.random() < 0.9 else location(),
+                    "target": burst_target if rng.random() < 0.8 else target(),
+                    "context": " ".join(rng.choices(WORDS, k=3 + int(rng.expovariate(1 / 5)))),
+                }
+
+
+def populate(count: int, seed: int = 1, location_count: int = 100, batch_size: int = 5000) -> int:
+    """add the synthetic dataset to the database of the current app, returns the amount of occurrences inserted"""
+    locations = generate_locations(seed, location_count)
+    database.execute(
+        insert(models.Location)
+        .values([{"label": label, "latitude": latitude, "longitude": longitude} for label, latitude, longitude in locations])
+        .on_conflict_do_nothing(index_elements=["label"])
+    )
+    database.commit()
+    result = bulk.import_rows(generate_occurrences(count, seed, [label for label, _, _ in locations]), batch_size)
+    aggregates.refresh()
+    return result.inserted
+
+
+def _admin_connection(config: type[Config]):
+    """autocommit connection to the database of config, to create or drop other databases"""
+    connection = psycopg2.connect(host=config.DB_HOST, port=config.DB_PORT, user=config.DB_USERNAME,
+                                  password=config.DB_PASSWORD, dbname=config.DB_DATABASE)
+    connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    return connection
+
+
+def database_config(name: str, **settings) -> type[Config]:
+    """Config for the database called name, created with its tables if it doesn't exist,
+    and with the other settings overridden
+    """
+    connection = _admin_connection(Config)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (name,))
+        if cursor.fetchone() is None:
+            cursor.execute(f'CREATE DATABASE "{name}"')
+    connection.close()
+    config = type("BenchmarkConfig", (Config,), {"DB_DATABASE": name, **settings})
+    models.create_tables(create_app(config))
+    return config
+
+
+@contextmanager
+def ephemeral_database(name: str, **settings):
+    """a Config for a new database called name, which is dropped afterwards (see database_config)"""
+    config = database_config(name, **settings)
+    try:
+        yield config
+    finally:
+        connection = _admin_connection(Config)
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+        connection.close()
+        # a new database with the same name starts with new data versions
+        cache_path = config.STATS_CACHE_PATH or cache.default_path(database.database_url(config))
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(cache_path + suffix):
+                os.remove(cache_path + suffix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--occurrences", type=int, required=True)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--locations", type=int, default=100)
+    parser.add_argument("--database", help="database to create and fill instead of the one of the environment")
+    args = parser.parse_args()
+
+    app = create_app(database_config(args.database) if args.database else Config)
+    with app.app_context():
+        inserted = populate(args.occurrences, args.seed, args.locations)
+    print(f"Inserted {inserted} occurrences ({args.occurrences - inserted} already existed)")
+
+
+if __name__ == "__main__":
+    main()
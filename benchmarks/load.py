@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+"""Load test the full request path with virtual users replaying scripted journeys
+(see JOURNEYS): logging in, opening the dashboard and adding occurrences. Every
+virtual user runs journeys back to back (with --think seconds between requests)
+until the duration is over, each in a new session, so every journey logs in.
+
+The app runs either in this process behind the Flask test client, or as gunicorn
+(gunicorn.conf.py) on a local port, once for every workers x threads configuration
+given with --configs, to compare them in one run. It uses a new database with a
+synthetic dataset (see benchmarks/dataset.py), which is dropped afterwards unless
+--keep is given, and ntfy notifications go to a local stub server that only counts
+them. The login rate limits are disabled, and the materialized views aren't refreshed
+in the background, like in benchmarks/suite.py.
+
+This reports requests per second and latency percentiles per route for every
+configuration (requests in the first --warmup seconds not included), and the totals
+of all configurations side by side.
+
+Usage: python -m benchmarks.load [--target client|gunicorn] [--configs 1x4 2x4 4x2] [--users N] [--duration S]
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import requests
+
+from kill_your_selfie import auth, database, models
+from kill_your_selfie.app import create_app
+from benchmarks import dataset
+
+ROOT = Path(__file__).resolve().parent.parent
+USERNAME = "load-test"
+PASSWORD = "load test password"
+
+# name: (relative weight, steps), a step is (method, path, name of the form of a POST)
+JOURNEYS = {
+    # an admin looking at the dashboard, and moving the heatmap around
+    "dashboard": (1, [
+        ("POST", "/login", "login"),
+        ("GET", "/home", None),
+        ("GET", "/api/heatmap?zoom=11&bbox=4.8,51.8,5.8,52.4", None),
+        ("GET", "/home", None),
+    ]),
+    # reporting an occurrence, then checking the dashboard
+    "report": (3, [
+        ("POST", "/login", "login"),
+        ("GET", "/new-occurrence", None),
+        ("POST", "/new-occurrence", "occurrence"),
+        ("GET", "/home", None),
+    ]),
+}
+
+
+class _Forms:
+    """the form data of the POST steps, with a new occurrence time for every occurrence"""
+
+    def __init__(self, first_time: datetime, seed: int):
+        self._minutes = itertools.count()  # /new-occurrence takes times to the minute
+        self._first_time = first_time
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+
+    def form(self, name: str) -> dict:
+        if name == "login":
+            return {"username": USERNAME, "password": PASSWORD}
+        with self._lock:
+            occurrence_time = self._first_time + timedelta(minutes=next(self._minutes))
+            number = self._rng.randrange(20)
+        return {"time": occurrence_time.strftime("%Y-%m-%dT%H:%M"), "location": f"location {number}",
+                "target": f"target {number}", "context": "load test"}
+
+
+class _NtfyStub(BaseHTTPRequestHandler):
+    """ntfy server that accepts every message and counts them"""
+    received = 0
+    _lock = threading.Lock()
+
+    def do_POST(self):  # pylint: disable=C0103
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with _NtfyStub._lock:
+            _NtfyStub.received += 1
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        pass
+
+
+def _ntfy_stub() -> ThreadingHTTPServer:
+    """started ntfy stub server on a free local port"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _NtfyStub)
+    threading.Thread(target=server.serve_forever, name="ntfy-stub", daemon=True).start()
+    return server
+
+
+class _ClientSession:
+    """Flask test client with the interface of requests.Session that the virtual users use"""
+
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def request(self, method: str, path: str, data: dict = None) -> int:
+        return self._client.open(path, method=method, data=data).status_code
+
+
+class _HTTPSession:
+    """requests session to a running server"""
+
+    def __init__(self, base_url: str):
+        self._base_url = base_url
+        self._session = requests.Session()
+
+    def request(self, method: str, path: str, data: dict = None) -> int:
+        return self._session.request(method, self._base_url + path, data=data, allow_redirects=False,
+                                     timeout=60).status_code
+
+
+def _virtual_user(new_session, forms: _Forms, deadline: float, measure_from: float, think: float,
+                  seed: int, results: list) -> None:
+    """run journeys until the deadline, appending (route, seconds, ok) of every request after measure_from"""
+    rng = random.Random(seed)
+    names = list(JOURNEYS)
+    weights = [JOURNEYS[name][0] for name in names]
+    while time.perf_counter() < deadline:
+        session = new_session()
+        for method, path, form in JOURNEYS[rng.choices(names, weights)[0]][1]:
+            route = f"{method} {path.split('?')[0]}"
+            start = time.perf_counter()
+            try:
+                status = session.request(method, path, forms.form(form) if form else None)
+            except requests.RequestException:
+                status = None
+            end = time.perf_counter()
+            if start >= measure_from:
+                results.append((route, end - start, status is not None and status < 400))
+            if end >= deadline:
+                return
+            if think:
+                time.sleep(think)
+
+
+def run_load(new_session, forms: _Forms, users: int, duration: float, warmup: float, think: float) -> dict:
+    """requests per second and latency percentiles per route of users virtual users over duration seconds"""
+    results = []
+    measure_from = time.perf_counter() + warmup
+    deadline = measure_from + duration
+    threads = [
+        threading.Thread(target=_virtual_user, args=(new_session, forms, deadline, measure_from, think, seed, results))
+        for seed in range(users)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = max(time.perf_counter(), deadline) - measure_from
+
+    routes = {}
+    for route, seconds, ok in results:
+        routes.setdefault(route, []).append((seconds, ok))
+    routes["total"] = [(seconds, ok) for _, seconds, ok in results]
+    return {route: _summary(route_requests, elapsed) for route, route_requests in routes.items()}
+
+
+def _summary(route_requests: list[tuple[float, bool]], elapsed: float) -> dict:
+    latencies = [seconds * 1000 for seconds, _ in route_requests] or [0.0]
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(route_requests),
+        "errors": sum(not ok for _, ok in route_requests),
+        "rps": round(len(route_requests) / elapsed, 2),
+        "p50_ms": round(percentiles[49], 2),
+        "p95_ms": round(percentiles[94], 2),
+        "p99_ms": round(percentiles[98], 2),
+    }
+
+
+def _wait_until_up(base_url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {process.returncode}")
+        try:
+            if requests.get(base_url + "/login", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("gunicorn didn't start in time")
+
+
+def run_gunicorn(settings: dict, workers: int, threads: int, port: int, forms: _Forms, args) -> dict:
+    """results of run_load against gunicorn started with workers and threads (see gunicorn.conf.py)"""
+    environment = {**os.environ, **{name: str(value) for name, value in settings.items()},
+                   "GUNICORN_WORKERS": str(workers), "GUNICORN_THREADS": str(threads),
+                   "GUNICORN_BIND": f"127.0.0.1:{port}"}
+    base_url = f"http://127.0.0.1:{port}"
+    # a file rather than a pipe, which would block gunicorn once it is full
+    with tempfile.TemporaryFile() as log:
+        process = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"], cwd=ROOT,
+                                   env=environment, stdout=subprocess.DEVNULL, stderr=log)
+        try:
+            _wait_until_up(base_url, process)
+            return run_load(lambda: _HTTPSession(base_url), forms, args.users, args.duration, args.warmup, args.think)
+        finally:
+            # workers send their queued notifications before they exit
+            process.terminate()
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            if process.returncode != 0:
+                log.seek(0)
+                print(log.read().decode(errors="replace")[-2000:])
+
+
+def _print_results(results: dict) -> None:
+    print(f"  {'route':<24}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, result in sorted(results.items(), key=lambda item: (item[0] == "total", item[0])):
+        print(f"  {route:<24}{result['requests']:>10}{result['errors']:>8}{result['rps']:>10.1f}"
+              f"{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}{result['p99_ms']:>10.1f}")
+
+
+def _parse_config(value: str) -> tuple[int, int]:
+    """(workers, threads) of a WORKERSxTHREADS configuration"""
+    try:
+        workers, threads = (int(part) for part in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} isn't WORKERSxTHREADS, like 2x4") from None
+    return workers, threads
+
+
+def run_configs(config, settings: dict, args) -> dict:
+    """{configuration: results of run_load} on the database of config, for every configuration of the target"""
+    app = create_app(config)
+    with app.app_context():
+        if database.get_sql_data("SELECT COUNT(*) FROM occurrence")[0][0] < args.occurrences:
+            start = time.perf_counter()
+            dataset.populate(args.occurrences, args.seed)
+            print(f"Generated {args.occurrences} occurrences in {time.perf_counter() - start:.1f} s")
+        models.User.query.filter_by(username=USERNAME).delete()
+        database.commit()
+        auth.create_user(USERNAME, f"{USERNAME}@example.com", PASSWORD, True)
+        # new occurrences after all earlier ones, so they don't collide with those of earlier runs
+        last = database.get_sql_data("SELECT MAX(time) FROM occurrence")[0][0] or datetime.now()
+        database.db.engine.dispose()
+    forms = _Forms(max(last, datetime.now()).replace(second=0, microsecond=0) + timedelta(minutes=1), args.seed)
+
+    results = {}
+    try:
+        for workers_threads in args.configs if args.target == "gunicorn" else [None]:
+            label = "test client" if workers_threads is None else f"{workers_threads[0]}x{workers_threads[1]}"
+            print(f"{label}, {args.users} virtual users, {args.duration:g} s:")
+            sent = _NtfyStub.received
+            if workers_threads is None:
+                results[label] = run_load(lambda: _ClientSession(app), forms, args.users, args.duration, args.warmup,
+                                          args.think)
+                app.extensions["ntfy_controller"].dispatcher.flush()
+            else:
+                results[label] = run_gunicorn(settings, *workers_threads, args.port, forms, args)
+            _print_results(results[label])
+            print(f"  {_NtfyStub.received - sent} ntfy notifications (including the warmup)")
+    finally:
+        with app.app_context():
+            models.User.query.filter_by(username=USERNAME).delete()
+            database.commit()
+            database.db.engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=("client", "gunicorn"), default="gunicorn")
+    parser.add_argument("--configs", type=_parse_config, nargs="+", default=[(1, 4), (2, 4), (4, 2)],
+                        help="gunicorn WORKERSxTHREADS configurations to compare")
+    parser.add_argument("--users", type=int, default=16, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to measure per configuration")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds before measuring")
+    parser.add_argument("--think", type=float, default=0, help="seconds a virtual user waits between requests")
+    parser.add_argument("--bcrypt-rounds", type=int, help="BCRYPT_LOG_ROUNDS, lower to take logins out of the picture")
+    parser.add_argument("--occurrences", type=int, default=100_000, help="size of the synthetic dataset")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--keep", action="store_true", help="keep the database, and reuse it on the next run")
+    parser.add_argument("--output", type=Path, help="write the results as json to this file")
+    args = parser.parse_args()
+
+    ntfy = _ntfy_stub()
+    name = f"kys_load_{args.occurrences}_{args.seed}"
+    settings = {
+        "DB_DATABASE": name,
+        "NTFY_ENDPOINT": f"http://127.0.0.1:{ntfy.server_port}/load-test", "NTFY_AUTH": "",
+        "LOGIN_ATTEMPTS_PER_USERNAME": 10 ** 9, "LOGIN_ATTEMPTS_PER_IP": 10 ** 9,
+        "AGGREGATE_REFRESH_DELAY": 3600, "AGGREGATE_REFRESH_INTERVAL": 0,
+    }
+    if args.bcrypt_rounds:
+        settings["BCRYPT_LOG_ROUNDS"] = args.bcrypt_rounds
+    try:
+        if args.keep:
+            results = run_configs(dataset.database_config(name, **settings), settings, args)
+        else:
+            with dataset.ephemeral_database(name, **settings) as config:
+                results = run_configs(config, settings, args)
+    finally:
+        ntfy.shutdown()
+
+    if len(results) > 1:
+        print(f"\n{'configuration':<16}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+        for label, result in results.items():
+            total = result["total"]
+            print(f"{label:<16}{total['rps']:>10.1f}{total['p50_ms']:>10.1f}{total['p95_ms']:>10.1f}"
+                  f"{total['p99_ms']:>10.1f}{total['errors']:>8}")
+    if args.output:
+        args.output.write_text(json.dumps({"target": args.target, "users": args.users, "duration": args.duration,
+                                           "occurrences": args.occurrences, "configs": results}, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
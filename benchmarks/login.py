@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Benchmark logins per second of one worker for a few bcrypt costs, with as
+many concurrent requests as the worker has threads, and the time of a login
+with an unknown username compared to a wrong password (which should be the
+same). Needs the database of the environment (.env); creates a user for the
+benchmark and deletes it afterwards. The rate limits are disabled.
+
+Usage: python -m benchmarks.login [--rounds 10 12] [--threads N] [--requests N]
+"""
+import argparse
+import statistics
+import threading
+import time
+
+from kill_your_selfie import auth, database, models
+from kill_your_selfie.app import create_app
+from kill_your_selfie.config import Config
+
+USERNAME = "login-benchmark"
+PASSWORD = "benchmark password"
+
+
+def login(client, username: str, password: str) -> float:
+    """seconds a login request took"""
+    start = time.perf_counter()
+    response = client.post("/login", data={"username": username, "password": password})
+    elapsed = time.perf_counter() - start
+    expected = 302 if password == PASSWORD and username == USERNAME else 200
+    assert response.status_code == expected, response.status_code
+    return elapsed
+
+
+def run(app, threads: int, requests: int) -> float:
+    """logins per second with threads concurrent clients"""
+    def worker():
+        client = app.test_client()
+        for _ in range(requests // threads):
+            login(client, USERNAME, PASSWORD)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return (requests // threads * threads) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, nargs="+", default=[10, 11, 12])
+    parser.add_argument("--threads", type=int, default=Config.DB_POOL_SIZE + Config.DB_MAX_OVERFLOW)
+    parser.add_argument("--requests", type=int, default=40)
+    args = parser.parse_args()
+
+    print(f"{'rounds':<10}{'logins/s':>12}{'unknown ms':>12}{'wrong ms':>12}")
+    for rounds in args.rounds:
+        class BenchmarkConfig(Config):
+            BCRYPT_LOG_ROUNDS = rounds
+            LOGIN_ATTEMPTS_PER_USERNAME = LOGIN_ATTEMPTS_PER_IP = 10 ** 9
+
+        app = create_app(BenchmarkConfig)
+        with app.app_context():
+            models.User.query.filter_by(username=USERNAME).delete()
+            database.commit()
+            auth.create_user(USERNAME, f"{USERNAME}@example.com", PASSWORD)
+        try:
+            client = app.test_client()
+            login(client, "unknown " + USERNAME, PASSWORD)  # warm up the connection pool
+            unknown = statistics.median(login(client, "unknown " + USERNAME, PASSWORD) for _ in range(5)) * 1000
+            wrong = statistics.median(login(client, USERNAME, "wrong " + PASSWORD) for _ in range(5)) * 1000
+            rate = run(app, args.threads, args.requests)
+        finally:
+            with app.app_context():
+                models.User.query.filter_by(username=USERNAME).delete()
+                database.commit()
+        print(f"{rounds:<10}{rate:>12.1f}{unknown:>12.1f}{wrong:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""Benchmark the statistics and write paths on synthetic datasets (see
+benchmarks/dataset.py) of one or more sizes. Every size gets a new database,
+which is dropped afterwards unless --keep is given. For every function this
+reports the latency percentiles over the iterations (uncached), and the SQL
+statements and peak Python memory of one call.
+
+The results are written as JSON (by default to benchmarks/results/<commit>.json),
+and compared to an earlier result with --compare, marking functions that got
+more than 20% slower.
+
+Usage: python -m benchmarks.suite [--sizes 10000 1000000] [--iterations N] [--compare FILE]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from sqlalchemy import event
+
+from kill_your_selfie import database, occurrences, stats
+from kill_your_selfie.app import create_app
+from benchmarks import dataset
+
+ROOT = Path(__file__).resolve().parent.parent
+REGRESSION = 1.2
+
+
+def _add_occurrence_calls():
+    """add_occurrence with a new time on every call"""
+    times = iter(datetime(2030, 1, 1) + timedelta(seconds=number) for number in range(10 ** 9))
+    return lambda: occurrences.add_occurrence(next(times), "location 0", "target 0", "benchmark")
+
+
+FUNCTIONS = {
+    "weekly_bar_data": lambda: stats.weekly_bar_data,
+    "line_data_month": lambda: lambda: stats.line_data("month"),
+    "line_data_year": lambda: lambda: stats.line_data("year"),
+    "location_map_data": lambda: stats.location_map_data,
+    "get_target_options": lambda: occurrences.get_target_options,
+    "add_occurrence": _add_occurrence_calls,
+}
+
+
+def measure(function, iterations: int) -> dict:
+    """latency percentiles of function over iterations calls, and the SQL statements and peak memory of one call"""
+    statements = []
+    listener = lambda *_: statements.append(1)  # pylint: disable=C3001
+    function()  # warm up
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    event.listen(database.db.engine, "before_cursor_execute", listener)
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        event.remove(database.db.engine, "before_cursor_execute", listener)
+
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "p50_ms": round(percentiles[49], 3),
+        "p95_ms": round(percentiles[94], 3),
+        "p99_ms": round(percentiles[98], 3),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "sql_statements": len(statements),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def run_size(size: int, seed: int, iterations: int, engine: str, keep: bool) -> dict:
+    """results of all functions on a new database with size synthetic occurrences"""
+    name = f"kys_benchmark_{size}_{seed}"
+    # no background refreshes of the materialized views, they would add noise and outlive the database
+    settings = {"STATS_CACHE_BACKEND": "none", "STATS_ENGINE": engine,
+                "AGGREGATE_REFRESH_DELAY": 3600, "AGGREGATE_REFRESH_INTERVAL": 0}
+    if keep:
+        config = dataset.database_config(name, **settings)
+        return _run_functions(create_app(config), size, seed, iterations)
+    with dataset.ephemeral_database(name, **settings) as config:
+        return _run_functions(create_app(config), size, seed, iterations)
+
+
+def _run_functions(app, size: int, seed: int, iterations: int) -> dict:
+    with app.app_context():
+        # a kept database is only filled once
+        if database.get_sql_data("SELECT COUNT(*) FROM occurrence")[0][0] < size:
+            start = time.perf_counter()
+            dataset.populate(size, seed)
+            print(f"Generated {size} occurrences in {time.perf_counter() - start:.1f} s")
+        results = {}
+        for name, make_function in FUNCTIONS.items():
+            results[name] = measure(make_function(), iterations)
+            print(f"  {name:<22}{results[name]['p50_ms']:>10.2f} ms p50{results[name]['p99_ms']:>10.2f} ms p99")
+        database.db.engine.dispose()
+    return results
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: dict, baseline: dict) -> None:
+    """print the change in p50 latency of every function since the baseline results"""
+    print(f"\nCompared to {baseline['commit']} ({baseline['created']}):")
+    print(f"{'size':<10}{'function':<22}{'p50 ms':>10}{'was':>10}{'change':>10}")
+    for size, functions in results["sizes"].items():
+        for name, result in functions.items():
+            old = baseline["sizes"].get(size, {}).get(name)
+            if old is None:
+                continue
+            ratio = result["p50_ms"] / old["p50_ms"] if old["p50_ms"] else 1
+            marker = "  slower" if ratio > REGRESSION else ""
+            print(f"{size:<10}{name:<22}{result['p50_ms']:>10.2f}{old['p50_ms']:>10.2f}{ratio - 1:>+10.0%}{marker}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--engine", choices=("sql", "columnar"), default="sql", help="STATS_ENGINE to benchmark")
+    parser.add_argument("--keep", action="store_true", help="keep the databases, and reuse them on the next run")
+    parser.add_argument("--output", type=Path, help="defaults to benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", type=Path, help="earlier results to compare to")
+    args = parser.parse_args()
+
+    results = {
+        "commit": _commit(),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "seed": args.seed,
+        "iterations": args.iterations,
+        "engine": args.engine,
+        "sizes": {},
+    }
+    for size in args.sizes:
+        print(f"{size} occurrences:")
+        results["sizes"][str(size)] = run_size(size, args.seed, args.iterations, args.engine, args.keep)
+
+    output = args.output or ROOT / "benchmarks" / "results" / f"{results['commit']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2) + "\n")
+    print(f"Wrote {output}")
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""gunicorn settings: worker and thread counts derived from the cpu count and the
+amount of database connections the app may use (DB_MAX_CONNECTIONS).
+
+Every worker runs `threads` request threads, and can open up to
+DB_POOL_SIZE + DB_MAX_OVERFLOW connections to the primary and to every read
+replica (DB_REPLICA_URLS), plus one that LISTENs for live dashboard events,
+so the amount of workers is capped to keep all workers together within
+DB_MAX_CONNECTIONS. Every worker gets STREAM_MAX_CLIENTS extra threads for
+the live dashboard streams.
+GUNICORN_WORKERS and GUNICORN_THREADS override the derived values.
+"""
+# pylint: disable=C0103
+import multiprocessing
+from os import environ
+
+from kill_your_selfie.config import Config
+
+bind = environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+wsgi_app = "kill_your_selfie.app:create_app()"
+# import the app once in the parent, workers are forked from it
+preload_app = True
+worker_class = "gthread"
+
+if Config.DB_PGBOUNCER:
+    # without an app side pool every thread holds at most one (PgBouncer client) connection per database
+    pool_connections = threads = int(environ.get("GUNICORN_THREADS", 4))
+else:
+    pool_connections = Config.DB_POOL_SIZE + Config.DB_MAX_OVERFLOW
+    # more threads than connections would only wait for the pool
+    threads = min(int(environ.get("GUNICORN_THREADS", 4)), pool_connections)
+# a pool for the primary and one for every read replica, and the connection of the
+# listener thread for the live dashboard events (see events.EventBroker)
+connections_per_worker = pool_connections * (1 + len(Config.DB_REPLICA_URLS)) + 1
+# open dashboard streams keep a thread busy each, without using a database connection
+threads += Config.STREAM_MAX_CLIENTS
+
+workers = int(environ.get(
+    "GUNICORN_WORKERS",
+    max(1, min(multiprocessing.cpu_count() * 2 + 1, Config.DB_MAX_CONNECTIONS // connections_per_worker)),
+))
@@ -0,0 +1,209 @@
+"""materialized views with pre-aggregated statistics
+
+The views are refreshed with REFRESH MATERIALIZED VIEW CONCURRENTLY, so reads
+never wait for a refresh. Writes to the daily rollup count themselves in the
+write_count table, in the transaction of the write, and ask the refresh
+scheduler of their worker for a refresh, which runs after writes stopped for a
+moment. The count is spread over WRITE_COUNT_SHARDS rows, picked by the
+connection, so concurrent writers don't wait for each other's row lock. stats
+only reads from the views while the oldest write they miss is at most
+max_staleness seconds old, and falls back to the daily rollup otherwise.
+"""
+import logging
+import os
+import threading
+import time
+
+from flask import Flask, current_app
+from sqlalchemy import text as sql_txt
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import database, cache
+
+logger = logging.getLogger(__name__)
+
+# name: (query, columns of its unique index, needed for a concurrent refresh)
+VIEWS = {
+    "monthly_count": (
+        """
+        SELECT DATE_TRUNC('month', d.day)::date AS month, d.location_label, d.target, SUM(d.amount) AS amount
+        FROM daily_count d
+        GROUP BY 1, 2, 3
+        """,
+        ("month", "location_label", "target"),
+    ),
+    "location_count": (
+        """
+        SELECT d.location_label, SUM(d.amount) AS amount
+        FROM daily_count d
+        GROUP BY 1
+        """,
+        ("location_label",),
+    ),
+}
+
+# key of the advisory lock that makes sure only one process refreshes the views at a time
+_REFRESH_LOCK = 4_172_019
+
+WRITE_COUNT_SHARDS = 64
+# amount of committed writes to the daily rollup
+WRITE_VERSION = "SELECT COALESCE(SUM(version), 0) FROM write_count"
+# seconds fresh() keeps the answer that the views miss too old writes, the stats read
+# the daily rollup meanwhile, which is slower but never wrong
+STALE_RECHECK_SECONDS = 5
+
+
+def create_views() -> None:
+    """create the views that don't exist yet, and their unique indexes"""
+    for name, (query, index_columns) in VIEWS.items():
+        database.execute(sql_txt(f"CREATE MATERIALIZED VIEW IF NOT EXISTS {name} AS {query}"))
+        database.execute(sql_txt(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS ix_{name}_unique ON {name} ({', '.join(index_columns)})"
+        ))
+    # the views were just filled, or are refreshed by the scheduler as soon as the app writes
+    database.execute(sql_txt(
+        "INSERT INTO aggregate_state (id, refreshed_version) SELECT 1, 0 WHERE NOT EXISTS (SELECT 1 FROM aggregate_state)"
+    ))
+    # a refreshed version ahead of the write count is from before the writes were counted in write_count,
+    # have the next refresh catch up on the writes the views may miss since
+    database.execute(sql_txt(
+        f"UPDATE aggregate_state SET refreshed_version = -1 WHERE refreshed_version > ({WRITE_VERSION})"
+    ))
+    database.commit()
+
+
+def mark_stale() -> None:
+    """register a write to the daily rollup the views don't include yet, call this in the transaction of the write"""
+    database.execute(
+        sql_txt(
+            """
+            INSERT INTO write_count (shard, version) VALUES (pg_backend_pid() % :shards, 1)
+            ON CONFLICT (shard) DO UPDATE SET version = write_count.version + 1
+            """
+        ),
+        {"shards": WRITE_COUNT_SHARDS},
+    )
+
+
+class _Freshness:
+    """answer of fresh() for an app, kept until the time.monotonic() value until"""
+
+    def __init__(self, max_staleness: float):
+        self.max_staleness = max_staleness
+        self.answer = False
+        self.until = 0.0
+
+
+def fresh() -> bool:
+    """Whether the views miss no writes older than max_staleness seconds. The writes they miss
+    were committed after their refresh, so that holds for max_staleness seconds after the
+    refresh, or after a moment they missed no writes. The answer is kept until then, so the
+    stats don't query it every time.
+    """
+    freshness = current_app.extensions["aggregate_freshness"]
+    now = time.monotonic()
+    if now < freshness.until:
+        return freshness.answer
+    complete, refresh_age = database.execute(sql_txt(
+        f"""
+        SELECT refreshed_version >= ({WRITE_VERSION}), EXTRACT(EPOCH FROM clock_timestamp() - refreshed_at)
+        FROM aggregate_state WHERE id = 1
+        """
+    )).one_or_none() or (False, None)
+    if complete:
+        freshness.answer, freshness.until = True, now + freshness.max_staleness
+    elif refresh_age is not None and refresh_age < freshness.max_staleness:
+        freshness.answer, freshness.until = True, now + freshness.max_staleness - float(refresh_age)
+    else:
+        freshness.answer, freshness.until = False, now + min(STALE_RECHECK_SECONDS, freshness.max_staleness)
+    return freshness.answer
+
+
+def refresh(force: bool = False) -> bool:
+    """Refresh the views if they miss writes (or always with force). Returns False if
+    nothing was refreshed, also when another process is refreshing them at the moment.
+    """
+    with database.db.engine.begin() as connection:
+        if not connection.execute(sql_txt("SELECT pg_try_advisory_xact_lock(:key)"), {"key": _REFRESH_LOCK}).scalar():
+            return False
+        # writes committed before this are included, since every REFRESH below takes a new snapshot
+        version = connection.execute(sql_txt(WRITE_VERSION)).scalar()
+        refreshed_version = connection.execute(
+            sql_txt("SELECT refreshed_version FROM aggregate_state WHERE id = 1")
+        ).scalar()
+        if not force and version == refreshed_version:
+            return False
+        for name in VIEWS:
+            connection.execute(sql_txt(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {name}"))
+        connection.execute(
+            sql_txt("UPDATE aggregate_state SET refreshed_version = :version, refreshed_at = now() WHERE id = 1"),
+            {"version": version},
+        )
+    # statistics cached while the views missed writes don't have them either
+    cache.bump_version()
+    return True
+
+
+class RefreshScheduler:
+    """Refreshes the views from a background thread of the worker process, delay
+    seconds after the last requested refresh (but at most 10 times delay after
+    the first), and every interval seconds if they miss writes of other processes.
+    """
+
+    def __init__(self, app: Flask, delay: float = 5, interval: float = 60):
+        self.app = app
+        self.delay = delay
+        self.interval = interval
+        self._requested = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def request(self) -> None:
+        """ask for a refresh, call this after committing a write"""
+        self.start()
+        self._requested.set()
+
+    def start(self) -> None:
+        """start the background thread of this process, if it isn't running"""
+        # threads don't survive a fork, so a (pre)forked worker starts its own
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="aggregate-refresh", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            if self._requested.wait(self.interval or None):
+                deadline = time.monotonic() + 10 * self.delay
+                self._requested.clear()
+                # wait until the writes stop
+                while self._requested.wait(max(0, min(self.delay, deadline - time.monotonic()))):
+                    self._requested.clear()
+                    if time.monotonic() >= deadline:
+                        break
+            with self.app.app_context():
+                try:
+                    refresh()
+                except SQLAlchemyError:
+                    logger.exception("Failed to refresh the materialized views")
+
+
+def request_refresh() -> None:
+    """ask the refresh scheduler of the current app for a refresh"""
+    current_app.extensions["aggregate_scheduler"].request()
+
+
+def init_app(app: Flask, max_staleness: float = 300, refresh_delay: float = 5, refresh_interval: float = 60) -> None:
+    """Read the views while they miss no writes older than max_staleness seconds, and
+    refresh them refresh_delay seconds after writes, or every refresh_interval seconds.
+    """
+    app.extensions["aggregate_freshness"] = _Freshness(max_staleness)
+    scheduler = app.extensions["aggregate_scheduler"] = RefreshScheduler(app, refresh_delay, refresh_interval)
+    # started by the first request of every worker rather than here, so a preloading gunicorn
+    # master doesn't open database connections its workers would inherit. A read-only snapshot
+    # has no views to refresh
+    if not app.config.get("READ_ONLY"):
+        app.before_request(scheduler.start)
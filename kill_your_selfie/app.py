@@ -1,37 +1,95 @@
 """main app process"""
 # pylint: disable=C0301
-from datetime import datetime
+import hashlib
+import hmac
+import io
+import json
+import queue
+from datetime import date, datetime
 
-from flask import Flask, render_template, request, redirect, url_for, flash
+import click
+
+from flask import (Flask, Blueprint, Response, current_app, render_template, request, redirect, url_for, flash,
+                   make_response, jsonify, abort, stream_with_context)
 from flask_login import LoginManager, logout_user, login_required, current_user
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from .config import Config
-from . import database, models, auth, stats, occurrences, notifications
+from . import database, models, auth, stats, occurrences, notifications, cache, bulk, metrics, dashboard, assets, events, aggregates, search, columnar, snapshot, spatial
 
 login_manager = LoginManager()
 
-app = Flask(__name__)
-login_manager.init_app(app)
-auth.init_bcrypt(app)
+# cli_group=None registers the commands as top level flask commands
+bp = Blueprint("main", __name__, cli_group=None)
+
 
-app.config["SQLALCHEMY_DATABASE_URI"] = (
-    f"postgresql+psycopg2://{Config.DB_USERNAME}:{Config.DB_PASSWORD}@{Config.DB_HOST}:{Config.DB_PORT}/{Config.DB_DATABASE}"
-)
-app.config["SECRET_KEY"] = Config.SECRET
+def create_app(config: type[Config] = Config) -> Flask:
+    """Create and configure the app. This doesn't connect to the database, so it can
+    run in a gunicorn --preload parent process before the workers are forked.
+    Run `flask init-db` to create the database tables.
+    """
+    app = Flask(__name__)
+    if config.TRUSTED_PROXIES:
+        # the address of the client (for the login limits), scheme and host as the proxies received them
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=config.TRUSTED_PROXIES, x_proto=config.TRUSTED_PROXIES,
+                                x_host=config.TRUSTED_PROXIES)
+    app.config["SQLALCHEMY_DATABASE_URI"] = database.database_url(config)
+    app.config["READ_ONLY"] = bool(config.DB_SNAPSHOT)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = database.engine_options(config)
+    app.config["SECRET_KEY"] = config.SECRET
+    app.config["BCRYPT_LOG_ROUNDS"] = config.BCRYPT_LOG_ROUNDS
+    app.config["DASHBOARD_MODE"] = config.DASHBOARD_MODE
+    app.config["DASHBOARD_WORKERS"] = config.DASHBOARD_WORKERS
+    app.config["STREAM_HEARTBEAT_SECONDS"] = config.STREAM_HEARTBEAT_SECONDS
+    app.config["METRICS_TOKEN"] = config.METRICS_TOKEN
+
+    login_manager.init_app(app)
+    auth.init_bcrypt(app, config.BCRYPT_MAX_CONCURRENCY)
+    auth.init_login_limits(config.LOGIN_ATTEMPTS_PER_USERNAME, config.LOGIN_ATTEMPTS_PER_IP,
+                           config.LOGIN_ATTEMPT_PERIOD_SECONDS)
+    auth.init_user_cache(config.USER_CACHE_SECONDS)
+    database.init_replicas(app, config.DB_REPLICA_URLS, database.engine_options(config), config.DB_REPLICA_LAG_SECONDS)
+    database.register_app(app, config.DB_STATEMENT_TIMEOUT_MS if config.DB_PGBOUNCER else 0)
+    metrics.init_app(app, config.METRICS_DIR, config.SLOW_REQUEST_SECONDS)
+    cache.configure(config.STATS_CACHE_BACKEND,
+                    config.STATS_CACHE_PATH or cache.default_path(app.config["SQLALCHEMY_DATABASE_URI"]),
+                    config.STATS_CACHE_SIZE, config.DB_SNAPSHOT)
+    assets.init_app(app, config.ASSETS_FOLDER)
+    columnar.init_app(app, config.STATS_ENGINE)
+    aggregates.init_app(app, config.AGGREGATE_MAX_STALENESS_SECONDS, config.AGGREGATE_REFRESH_DELAY,
+                        config.AGGREGATE_REFRESH_INTERVAL)
+
+    if config.NTFY_ENDPOINT:
+        app.extensions["ntfy_controller"] = notifications.NtfyController(
+            config.NTFY_AUTH,
+            config.NTFY_ENDPOINT,
+            timeout=config.NTFY_TIMEOUT,
+            retries=config.NTFY_RETRIES,
+            queue_size=config.NTFY_QUEUE_SIZE,
+            coalesce_window=config.NTFY_COALESCE_SECONDS,
+        )
+    else:
+        app.extensions["ntfy_controller"] = notifications.DummyNtfyController()
+
+    app.extensions["event_broker"] = events.EventBroker(
+        {"host": config.DB_HOST, "port": config.DB_LISTEN_PORT, "user": config.DB_USERNAME,
+         "password": config.DB_PASSWORD, "dbname": config.DB_DATABASE},
+        max_subscribers=config.STREAM_MAX_CLIENTS,
+    )
 
-database.register_app(app)
-models.create_tables(app)
+    app.register_blueprint(bp)
+    return app
 
-if Config.NTFY_ENDPOINT:
-    ntfy_controller = notifications.NtfyController(Config.NTFY_AUTH, Config.NTFY_ENDPOINT)
-else:
-    ntfy_controller = notifications.DummyNtfyController()
+
+def _ntfy_controller() -> notifications.NtfyController:
+    """ntfy controller of the current app"""
+    return current_app.extensions["ntfy_controller"]
 
 
 @login_manager.user_loader
 def load_user(user_id):
     """loads a user probably"""
-    return models.User.query.get(user_id)
+    return auth.load_user(user_id)
 
 
 @login_manager.unauthorized_handler
@@ -39,19 +97,109 @@ def unauthorized_callback():
     """redirect user to login page when they try to access a
     resource that requires login
     """
-    return redirect(url_for("login", next=request.endpoint))
+    return redirect(url_for("main.login", next=request.endpoint))
+
+
+@bp.cli.command("init-db")
+def init_db():
+    """create the database tables and indexes that don't exist yet"""
+    models.create_tables(current_app)
+    print("Database initialised")
+
+
+@bp.cli.command("backfill-daily-counts")
+def backfill_daily_counts():
+    """rebuild the daily rollup table from all existing occurrences"""
+    print(f"Wrote {occurrences.backfill_daily_counts()} daily count rows")
+    aggregates.refresh()
+
+
+@bp.cli.command("import-occurrences")
+@click.argument("file", type=click.File("r", encoding="utf-8", errors="surrogateescape"))
+@click.option("--format", "file_format", type=click.Choice(bulk.FORMATS), help="defaults to the file extension")
+@click.option("--batch-size", default=5000, show_default=True)
+def import_occurrences_command(file, file_format, batch_size):
+    """import occurrences from a csv or jsonl file"""
+    result = bulk.import_rows(bulk.parse_rows(file, file_format or bulk.format_from_filename(file.name)), batch_size)
+    print(result)
+    aggregates.refresh()
+    for time in result.duplicates:
+        print(f"Skipped duplicate time: {time.isoformat()}")
+    for row_number in result.invalid:
+        print(f"Skipped invalid row: {row_number}")
+
+
+@bp.cli.command("refresh-aggregates")
+@click.option("--force", is_flag=True, help="also refresh the views if they don't miss any writes")
+def refresh_aggregates(force):
+    """refresh the materialized views with aggregated statistics"""
+    if aggregates.refresh(force):
+        print("Refreshed the materialized views")
+    else:
+        print("The materialized views are up to date or being refreshed")
+
+
+@bp.cli.command("snapshot")
+@click.argument("path", type=click.Path(dir_okay=False))
+def snapshot_command(path):
+    """write a read-only SQLite snapshot of the database to serve dashboards from (DB_SNAPSHOT)"""
+    for table, rows in snapshot.write(path).items():
+        print(f"Copied {rows} rows of {table}")
+
+
+@bp.cli.command("set-admin")
+@click.argument("username")
+@click.option("--revoke", is_flag=True, help="take admin rights away instead of granting them")
+def set_admin_command(username, revoke):
+    """grant a user admin rights (or revoke them with --revoke)"""
+    if not auth.set_admin(username, not revoke):
+        raise click.ClickException(f"User {username} doesn't exist")
+    print(f"{username} is {'no longer' if revoke else 'now'} an admin")
 
 
-@app.route("/")
+@bp.cli.command("build-assets")
+def build_assets():
+    """write fingerprinted and precompressed copies of the static files"""
+    manifest = assets.rebuild()
+    print(f"Built {len(manifest)} assets in {current_app.extensions['assets']['folder']}")
+    if assets.brotli is None:
+        print("The brotli package isn't installed, only gzip variants were written")
+
+
+@bp.before_app_request
+def read_only_guard():
+    """refuse writes when serving a snapshot, logging in only reads"""
+    if (current_app.config["READ_ONLY"] and request.method not in ("GET", "HEAD", "OPTIONS")
+            and request.endpoint != "main.login"):
+        abort(503, description="This is a read-only snapshot")
+
+
+@bp.route("/assets/<path:filename>")
+def asset(filename):
+    """fingerprinted static file built by `flask build-assets`"""
+    return assets.send_asset(filename)
+
+
+@bp.route("/metrics")
+def prometheus_metrics():
+    """request metrics of all workers in the Prometheus text format, for admins or with the METRICS_TOKEN bearer token"""
+    token = current_app.config["METRICS_TOKEN"]
+    authorization = request.headers.get("Authorization", "")
+    if not (token and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())) and not auth.is_admin():
+        abort(401, description="The metrics need an admin login or the metrics token")
+    return Response(metrics.exposition(), mimetype="text/plain; version=0.0.4")
+
+
+@bp.route("/")
 def index():
     """webroot, redirects to either home page or login page"""
     if current_user.is_authenticated:
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     else:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
 
-@app.route("/debug-ui")
+@bp.route("/debug-ui")
 def basepage():
     """displays the base html template"""
     flash("Debug ui")
@@ -60,42 +208,199 @@ def basepage():
     return render_template("form.html")
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     """login page"""
     if request.method == "POST":
+        # rate limited before hashing anything
+        if not auth.login_allowed(request.form.get("username"), request.remote_addr):
+            flash("Error: too many login attempts, please try again later")
+            return render_template("login.html"), 429
         message, success = auth.authenticate_user(request.form.get("username"), request.form.get("password"))
         if success:
-            return redirect(url_for("home") if (next_url := request.args.get("next")) is None else url_for(next_url))
+            return redirect(url_for("main.home") if (next_url := request.args.get("next")) is None else url_for(next_url))
         else:
             flash(f"Error: {message}")
 
     return render_template("login.html")
 
 
-@app.route("/logout")
+@bp.route("/logout")
 @login_required
 def logout():
     """logs out the user"""
     logout_user()
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 
-@app.route("/home")
+@bp.route("/home")
 @login_required
 def home():
     """home page"""
-    return render_template(
-        "index.html",
-        active="home",
-        weekly_bar_data=stats.weekly_bar_data(),
-        monthly_line_data=stats.line_data('month'),
-        yearly_line_data=stats.line_data('year'),
-        location_map=stats.location_map_data(),
-    )
+    timeseries_urls = {}
+    for time_range in ("week", "month", "year"):
+        start, end, bucket = stats.time_window(time_range)
+        timeseries_urls[time_range] = url_for(
+            "main.stats_timeseries", bucket=bucket, **{"from": start.date().isoformat(), "to": end.date().isoformat()}
+        )
+    # the panels are embedded in the page, so the dashboard doesn't need a request per panel
+    panels = None
+    if auth.is_admin():
+        panels = dashboard.panels(current_app.config["DASHBOARD_MODE"], current_app.config["DASHBOARD_WORKERS"])
+    return render_template("index.html", active="home", timeseries_urls=timeseries_urls, panels=panels,
+                           heatmap_zoom=stats.DASHBOARD_HEATMAP_ZOOM, heatmap_precisions=spatial.ZOOM_PRECISIONS)
+
 
+@bp.route("/api/stats/timeseries")
+@login_required
+@auth.admin_required
+def stats_timeseries():
+    """amount of occurrences per bucket between the from and to parameters (ISO 8601),
+    see stats.timeseries
+    """
+    if "from" not in request.args or "to" not in request.args:
+        abort(400, description="from and to are required")
+    try:
+        data = stats.timeseries(
+            _parse_time(request.args["from"]),
+            _parse_time(request.args["to"]),
+            request.args.get("bucket", "day"),
+            request.args.get("group_by") or None,
+        )
+    except ValueError as exc:
+        abort(400, description=str(exc))
+    return jsonify(data)
+
+
+def _parse_time(value: str) -> datetime:
+    """Naive datetime of an ISO 8601 parameter. Times with an offset are converted to the
+    time zone of the server, which the (naive) occurrence times and datetime.now() are in.
+    Raises ValueError if it isn't one.
+    """
+    time = datetime.fromisoformat(value)
+    return time.astimezone().replace(tzinfo=None) if time.tzinfo else time
+
+
+def _stats_filters() -> dict:
+    """the optional from and to (ISO 8601, as start and end), target and location parameters"""
+    return {
+        "start": _parse_time(request.args["from"]) if request.args.get("from") else None,
+        "end": _parse_time(request.args["to"]) if request.args.get("to") else None,
+        "target": request.args.get("target") or None,
+        "location": request.args.get("location") or None,
+    }
+
+
+@bp.route("/api/stats/hour-weekday")
+@login_required
+@auth.admin_required
+def stats_hour_weekday():
+    """amount of occurrences per weekday and hour of the day, see stats.hour_weekday"""
+    try:
+        return jsonify(stats.hour_weekday(**_stats_filters()))
+    except ValueError as exc:
+        abort(400, description=str(exc))
+    except columnar.AnalyticsUnavailable as exc:
+        abort(501, description=str(exc))
 
-@app.route('/user-settings', methods=['GET', 'POST'])
+
+@bp.route("/api/stats/streaks")
+@login_required
+@auth.admin_required
+def stats_streaks():
+    """longest and current runs of days with occurrences per target, see stats.streaks"""
+    try:
+        return jsonify(stats.streaks(request.args.get("target") or None, request.args.get("location") or None))
+    except columnar.AnalyticsUnavailable as exc:
+        abort(501, description=str(exc))
+
+
+@bp.route("/api/stats/rolling-average")
+@login_required
+@auth.admin_required
+def stats_rolling_average():
+    """average occurrences per day over a window of days, see stats.rolling_average"""
+    try:
+        filters = _stats_filters()
+        if filters["start"] is None or filters["end"] is None:
+            abort(400, description="from and to are required")
+        return jsonify(stats.rolling_average(window=request.args.get("window", 7, type=int), **filters))
+    except ValueError as exc:
+        abort(400, description=str(exc))
+    except columnar.AnalyticsUnavailable as exc:
+        abort(501, description=str(exc))
+
+
+@cache.cached()
+def _heatmap_payload() -> tuple[str, str]:
+    """json encoded heatmap points and their ETag"""
+    payload = json.dumps(stats.location_map_data(), separators=(",", ":"))
+    return payload, hashlib.sha1(payload.encode()).hexdigest()
+
+
+@bp.route("/api/heatmap")
+@login_required
+@auth.admin_required
+def heatmap_data():
+    """Heatmap points as a json list of [latitude, longitude, amount], one per mapped location.
+    With the zoom parameter (a map zoom level), one per geohash cell of the size for that zoom
+    (see spatial), only of the cells in the bbox parameter (west,south,east,north) if given.
+    """
+    if request.args.get("zoom") is None:
+        payload, etag = _heatmap_payload()
+    else:
+        zoom = request.args.get("zoom", type=int)
+        if zoom is None:
+            abort(400, description="zoom must be a whole number")
+        try:
+            bbox = spatial.parse_bbox(request.args["bbox"]) if request.args.get("bbox") else None
+            payload = json.dumps(stats.location_index.cells(zoom, bbox), separators=(",", ":"))
+        except ValueError as exc:
+            abort(400, description=str(exc))
+        etag = hashlib.sha1(payload.encode()).hexdigest()
+    response = make_response(payload)
+    response.mimetype = "application/json"
+    response.set_etag(etag)
+    response.last_modified = cache.last_modified()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@bp.route("/api/stream")
+@login_required
+@auth.admin_required
+def stream():
+    """Server-Sent Events with changes to the dashboard data: occurrence (a new occurrence),
+    location (a location was mapped) and refresh (many occurrences were imported)
+    """
+    if current_app.config["READ_ONLY"]:
+        abort(503, description="A read-only snapshot has no live updates")
+    broker = current_app.extensions["event_broker"]
+    subscription = broker.subscribe()
+    if subscription is None:
+        abort(503, description="Too many open streams")
+    response = Response(_stream_events(subscription, current_app.config["STREAM_HEARTBEAT_SECONDS"]),
+                        mimetype="text/event-stream", headers={"X-Accel-Buffering": "no"})
+    response.cache_control.no_cache = True
+    response.call_on_close(lambda: broker.unsubscribe(subscription))
+    return response
+
+
+def _stream_events(subscription: queue.Queue, heartbeat_seconds: float):
+    """Send the events of a subscription, and a comment every heartbeat_seconds to notice
+    clients that are gone. The request context is already gone while this runs, so an open
+    stream doesn't hold a database connection.
+    """
+    yield "retry: 10000\n\n"
+    while True:
+        try:
+            yield events.format_event(*subscription.get(timeout=heartbeat_seconds))
+        except queue.Empty:
+            yield ": keepalive\n\n"
+
+
+@bp.route('/user-settings', methods=['GET', 'POST'])
 @login_required
 def user_settings():
     """user settings page"""
@@ -114,7 +419,7 @@ def user_settings():
     return render_template("user_settings.html", active="user-settings")
 
 
-@app.route('/new-user', methods=['GET', 'POST'])
+@bp.route('/new-user', methods=['GET', 'POST'])
 @login_required
 @auth.admin_required
 def new_user():
@@ -130,13 +435,13 @@ def new_user():
             new_user_is_admin,
         )
         if success:
-            ntfy_controller.sendNewUserNotification(new_user_name, new_user_is_admin, new_user_email)
+            _ntfy_controller().sendNewUserNotification(new_user_name, new_user_is_admin, new_user_email)
         flash(message)
 
     return render_template("new_user.html", active="new-user")
 
 
-@app.route("/new-occurrence", methods=["GET", "POST"])
+@bp.route("/new-occurrence", methods=["GET", "POST"])
 @login_required
 def new_occurrence():
     """page to register a new occurrence"""
@@ -145,27 +450,203 @@ def new_occurrence():
         location = request.form.get("location")
         target = request.form.get("target")
         context = request.form.get("context")
-        occurrences.add_occurrence(
+        if occurrences.add_occurrence(
             # exception handling for datetime is not really needed since
             # form has built in validation
             time,
             location,
             target,
             context,
-        )
-        ntfy_controller.sendNewOccurrenceNotification(
-            {"time": time, "location": location, "target": target, "context": context}, current_user
-        )
+        ):
+            _ntfy_controller().sendNewOccurrenceNotification(
+                {"time": time, "location": location, "target": target, "context": context}, current_user
+            )
+        else:
+            flash("Error: an occurrence with that time already exists")
 
     return render_template(
         "new_occurrence.html",
         active="new-occurrence",
-        location_options=occurrences.get_location_options(),
-        target_options=occurrences.get_target_options(),
+        location_options=occurrences.option_indexes["location"].search(limit=10),
+        target_options=occurrences.option_indexes["target"].search(limit=10),
     )
 
 
-@app.route("/map-location", methods=["GET", "POST"])
+HISTORY_FILTERS = ("target", "location", "from", "to")
+
+
+def _history_request() -> tuple[dict, dict, int]:
+    """filters (see occurrences.page_occurrences), cursors and page size of an occurrence history request"""
+    args = request.args
+    filters = {
+        "target": args.get("target") or None,
+        "location": args.get("location") or None,
+        "start": date.fromisoformat(args["from"]) if args.get("from") else None,
+        "end": date.fromisoformat(args["to"]) if args.get("to") else None,
+    }
+    cursors = {name: _parse_time(args[name]) for name in ("before", "after") if args.get(name)}
+    return filters, cursors, max(1, min(args.get("limit", 50, type=int), 200))
+
+
+@bp.route("/occurrences")
+@login_required
+@auth.admin_required
+def occurrence_history():
+    """page through all occurrences, newest first"""
+    if current_app.config["READ_ONLY"]:
+        abort(503, description="The occurrence history needs PostgreSQL, a read-only snapshot doesn't have it")
+    try:
+        filters, cursors, limit = _history_request()
+    except ValueError as exc:
+        flash(f"Error: {exc}")
+        filters, cursors, limit = {}, {}, 50
+    return render_template(
+        "occurrences.html",
+        active="occurrences",
+        page=occurrences.page_occurrences(**cursors, limit=limit, **filters),
+        estimated_total=occurrences.estimate_occurrence_count(**filters),
+        # the filters as given, to keep them in the links to other pages
+        filter_args={name: request.args[name] for name in (*HISTORY_FILTERS, "limit") if request.args.get(name)},
+        location_options=occurrences.option_indexes["location"].search(limit=100),
+        target_options=occurrences.option_indexes["target"].search(limit=100),
+    )
+
+
+@bp.route("/api/occurrences")
+@login_required
+@auth.admin_required
+def occurrence_history_data():
+    """A page of occurrences, newest first, filtered by the target, location, from and to (dates)
+    parameters. Pass the returned older (or newer) time as before (or after) to get the next
+    (or previous) page. estimated_total is an estimate of the amount of matching occurrences.
+    """
+    if current_app.config["READ_ONLY"]:
+        abort(503, description="The occurrence history needs PostgreSQL, a read-only snapshot doesn't have it")
+    try:
+        filters, cursors, limit = _history_request()
+    except ValueError as exc:
+        abort(400, description=str(exc))
+    page = occurrences.page_occurrences(**cursors, limit=limit, **filters)
+    return jsonify({
+        "occurrences": [
+            {"time": time.isoformat(), "location": location, "target": target, "context": context}
+            for time, location, target, context in page.occurrences
+        ],
+        "newer": page.newer.isoformat() if page.newer else None,
+        "older": page.older.isoformat() if page.older else None,
+        "estimated_total": occurrences.estimate_occurrence_count(**filters),
+    })
+
+
+@bp.route("/api/search")
+@login_required
+@auth.admin_required
+def search_data():
+    """Search occurrences by their context with the q parameter (web search syntax), ranked
+    and with the matches highlighted in html, and targets and locations similar to q
+    """
+    if current_app.config["READ_ONLY"]:
+        abort(503, description="Search needs PostgreSQL, a read-only snapshot doesn't have it")
+    try:
+        return jsonify(search.search(request.args.get("q", ""), max(1, min(request.args.get("limit", 20, type=int), 100))))
+    except ValueError as exc:
+        abort(400, description=str(exc))
+
+
+@bp.route("/api/occurrences:batch", methods=["POST"])
+@login_required
+def occurrences_batch():
+    """Add a batch of occurrences, e.g. queued while offline. Expects a json list of
+    {"time": ..., "location": ..., "target": ..., "context": ...} objects and returns the
+    status of every item (created, duplicate, conflict or invalid), see bulk.import_batch.
+    """
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        abort(400, description="Expected a json list of occurrences")
+    if len(items) > 1000:
+        abort(413, description="At most 1000 occurrences can be added at once")
+    statuses = bulk.import_batch(items)
+    if created := statuses.count("created"):
+        _ntfy_controller().sendNewOccurrencesNotification(created, current_user)
+    return jsonify([{"time": item.get("time"), "status": status} for item, status in zip(items, statuses)])
+
+
+@bp.route("/api/options/<field>")
+@login_required
+def options(field):
+    """previously used values of an occurrence field starting with the prefix parameter, most used first"""
+    if field not in occurrences.option_indexes:
+        abort(404, description=f"No options for field {field}")
+    limit = max(1, min(request.args.get("limit", 10, type=int), 100))
+    return jsonify(occurrences.option_indexes[field].search(request.args.get("prefix", ""), limit))
+
+
+@bp.route("/import-occurrences", methods=["GET", "POST"])
+@login_required
+@auth.admin_required
+def import_occurrences():
+    """page to upload a csv or jsonl file with occurrences"""
+    file = request.files.get("file")
+    if request.method == "POST" and (file is None or not file.filename):
+        # the form was sent without choosing a file
+        flash("Error: choose a file to import")
+    elif request.method == "POST":
+        try:
+            file_format = bulk.format_from_filename(file.filename)
+            result = bulk.import_rows(bulk.parse_rows(io.TextIOWrapper(file.stream, encoding="utf-8", errors="surrogateescape"), file_format))
+            flash(str(result))
+            if result.duplicates:
+                flash("Duplicate times: " + ", ".join(time.isoformat() for time in result.duplicates[:20])
+                      + (", ..." if len(result.duplicates) > 20 else ""))
+            if result.invalid:
+                flash("Invalid rows: " + ", ".join(str(row_number) for row_number in result.invalid[:20])
+                      + (", ..." if len(result.invalid) > 20 else ""))
+        except ValueError as exc:
+            flash(f"Error: {exc}")
+
+    return render_template("import_occurrences.html", active="import-occurrences")
+
+
+@bp.route("/export")
+@login_required
+@auth.admin_required
+def export():
+    """download all occurrences as csv or jsonl"""
+    file_format = request.args.get("format", "csv")
+    if file_format not in bulk.FORMATS:
+        abort(400, description=f"Unsupported file format: {file_format}")
+    return Response(
+        stream_with_context(bulk.export_rows(file_format)),
+        mimetype="text/csv" if file_format == "csv" else "application/jsonl",
+        headers={"Content-Disposition": f"attachment; filename=occurrences.{file_format}"},
+    )
+
+
+# radius in meters within which other mapped locations are probably the same place
+NEARBY_METERS = 100
+
+
+@bp.route("/api/locations/nearby")
+@login_required
+@auth.admin_required
+def nearby_locations():
+    """mapped locations within the radius parameter (meters) of the latitude and longitude parameters,
+    nearest first, see spatial.LocationIndex.nearby
+    """
+    latitude = request.args.get("latitude", type=float)
+    longitude = request.args.get("longitude", type=float)
+    if latitude is None or longitude is None:
+        abort(400, description="latitude and longitude are required")
+    try:
+        return jsonify(stats.location_index.nearby(
+            latitude, longitude, request.args.get("radius", NEARBY_METERS, type=float),
+            max(1, min(request.args.get("limit", 10, type=int), 100)),
+        ))
+    except ValueError as exc:
+        abort(400, description=str(exc))
+
+
+@bp.route("/map-location", methods=["GET", "POST"])
 @login_required
 @auth.admin_required
 def map_location():
@@ -176,14 +657,19 @@ def map_location():
         location_options = [""]  # Add at least one element to the list so it is iterable
 
     if request.method == 'POST':
-        occurrences.map_location(
-            request.form.get("location"),
-            float(request.form.get("latitude")),
-            float(request.form.get("longitude")),
-        )
+        location = request.form.get("location")
+        latitude, longitude = float(request.form.get("latitude")), float(request.form.get("longitude"))
+        occurrences.map_location(location, latitude, longitude)
+        # other labels at the same place are probably typos or aliases
+        duplicates = [nearby["label"] for nearby in stats.location_index.nearby(latitude, longitude, NEARBY_METERS)
+                      if nearby["label"] != location]
+        if duplicates:
+            flash(f"{', '.join(duplicates)} {'is' if len(duplicates) == 1 else 'are'} mapped within "
+                  f"{NEARBY_METERS} m of {location}, it might be the same location")
 
     return render_template(
         "map_location.html",
         active="map-location",
         loc_options=location_options,
+        nearby_meters=NEARBY_METERS,
     )
@@ -0,0 +1,155 @@
+"""fingerprinted and precompressed static assets
+
+`flask build-assets` (or `python -m kill_your_selfie.assets`, which doesn't
+create the app, so it runs without the database settings, e.g. while
+building the Docker image) copies every file of the static folder to the assets
+folder with a hash of its content in the name (scripts/map.js becomes e.g.
+scripts/map.1a2b3c4d5e6f.js), writes gzip and brotli variants of text files
+next to them, and a manifest.json mapping the original names to the hashed
+ones. Since the content of a hashed file never changes, it is served with a
+long-lived immutable Cache-Control header, in the best encoding the browser
+accepts. Brotli variants are only written when the brotli package is installed.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import posixpath
+import re
+import shutil
+from pathlib import Path
+
+from flask import Flask, Response, current_app, request, send_from_directory, url_for
+
+from .config import Config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# the static folder of the app
+STATIC_FOLDER = Path(__file__).parent / "static"
+MANIFEST = "manifest.json"
+COMPRESSIBLE = (".css", ".js", ".json", ".svg", ".txt")
+# encodings in order of preference, with the suffix of their precompressed variants
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+MAX_AGE = 365 * 24 * 3600
+
+_CSS_URL = re.compile(r"""url\(\s*(["']?)([^"')]+)\1\s*\)""")
+
+
+def build(static_folder: str, assets_folder: str) -> dict:
+    """(Re)build the assets folder from the static folder, returns the manifest"""
+    static_folder = Path(static_folder)
+    assets_folder = Path(assets_folder)
+    shutil.rmtree(assets_folder, ignore_errors=True)
+    manifest = {}
+
+    def fingerprint(name: str) -> str:
+        """hashed name of a static file, building it first if needed"""
+        if name in manifest:
+            return manifest[name]
+        content = (static_folder / name).read_bytes()
+        if name.endswith(".css"):
+            content = _rewrite_css_urls(content, name, static_folder, fingerprint)
+        stem, extension = posixpath.splitext(name)
+        manifest[name] = f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{extension}"
+        target = assets_folder / manifest[name]
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(content)
+        if extension in COMPRESSIBLE:
+            _write_compressed(target, content)
+        return manifest[name]
+
+    for path in sorted(static_folder.rglob("*")):
+        if path.is_file():
+            fingerprint(path.relative_to(static_folder).as_posix())
+    (assets_folder / MANIFEST).write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    return manifest
+
+
+def _rewrite_css_urls(content: bytes, name: str, static_folder: Path, fingerprint) -> bytes:
+    """point relative url()s in a stylesheet to the hashed names of the files they refer to"""
+    directory = posixpath.dirname(name)
+
+    def replace(match: re.Match) -> str:
+        reference = match.group(2).strip()
+        path = reference.split("?", 1)[0].split("#", 1)[0]
+        if not path or ":" in path or path.startswith("/"):
+            return match.group(0)  # absolute url or data uri
+        referenced = posixpath.normpath(posixpath.join(directory, path))
+        if not (static_folder / referenced).is_file():
+            return match.group(0)
+        return f'url("{posixpath.relpath(fingerprint(referenced), directory or ".")}")'
+
+    return _CSS_URL.sub(replace, content.decode("utf-8")).encode("utf-8")
+
+
+def _write_compressed(target: Path, content: bytes) -> None:
+    """write the gzip and brotli variants of a file, if they are smaller"""
+    variants = {".gz": gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(content, quality=11)
+    for suffix, compressed in variants.items():
+        if len(compressed) < len(content):
+            target.with_name(target.name + suffix).write_bytes(compressed)
+
+
+def _load_manifest(assets_folder: str) -> dict:
+    try:
+        return json.loads(Path(assets_folder, MANIFEST).read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def init_app(app: Flask, assets_folder: str) -> None:
+    """use the assets built in assets_folder, if any, and add asset_url to the templates"""
+    app.extensions["assets"] = {"folder": assets_folder, "manifest": _load_manifest(assets_folder)}
+    app.add_template_global(asset_url)
+
+
+def rebuild() -> dict:
+    """rebuild the assets of the current app and start using them"""
+    extension = current_app.extensions["assets"]
+    extension["manifest"] = build(current_app.static_folder, extension["folder"])
+    return extension["manifest"]
+
+
+def asset_url(filename: str) -> str:
+    """Url of a static file like url_for('static', filename=...), pointing to its hashed
+    version if the assets are built. Debug mode always uses the static files themselves,
+    so changes show up without rebuilding.
+    """
+    hashed = current_app.extensions["assets"]["manifest"].get(filename)
+    if hashed is None or current_app.debug:
+        return url_for("static", filename=filename)
+    return url_for("main.asset", filename=hashed)
+
+
+def send_asset(filename: str) -> Response:
+    """a hashed asset in the best encoding the client accepts, cached for a year"""
+    folder = current_app.extensions["assets"]["folder"]
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    for encoding, suffix in ENCODINGS:
+        if request.accept_encodings[encoding] and Path(folder, filename + suffix).is_file():
+            response = send_from_directory(folder, filename + suffix, mimetype=mimetype, max_age=MAX_AGE)
+            response.content_encoding = encoding
+            break
+    else:
+        response = send_from_directory(folder, filename, mimetype=mimetype, max_age=MAX_AGE)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.immutable = True
+    return response
+
+
+def main() -> None:
+    """build the assets of the static folder into ASSETS_FOLDER"""
+    manifest = build(STATIC_FOLDER, Config.ASSETS_FOLDER)
+    print(f"Built {len(manifest)} assets in {Config.ASSETS_FOLDER}")
+    if brotli is None:
+        print("The brotli package isn't installed, only gzip variants were written")
+
+
+if __name__ == "__main__":
+    main()
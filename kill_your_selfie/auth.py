@@ -1,12 +1,30 @@
 """functions for authentication"""
+import threading
+import time
+from contextlib import contextmanager
+
 from flask import Flask, abort
 from flask_bcrypt import Bcrypt
-from flask_login import login_user, current_user
-from sqlalchemy.exc import IntegrityError
+from flask_login import UserMixin, login_user, current_user
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
-from . import models, database
+from . import models, database, cache
+from .ratelimit import TokenBucketLimiter
 
 _bcrypt = Bcrypt()
+_log_rounds = 12
+# bcrypt hashes at a time per worker, so a burst of logins can't take all cpu and threads
+_hash_slots = threading.BoundedSemaphore(2)
+_hash_wait_seconds = 10
+_dummy_hash = None  # compared against for unknown users, see init_bcrypt
+
+_username_limiter = None
+_ip_limiter = None
+
+_user_cache = {}  # user id: (expiry time, credential version, CachedUser)
+_user_cache_lock = threading.Lock()
+_user_cache_seconds = 60
 
 
 class AuthenticationError(Exception):
@@ -20,9 +38,114 @@ class AuthenticationError(Exception):
         return f"{self.message}"
 
 
-def init_bcrypt(app: Flask) -> None:
-    """initialise bcrypt with app (calls init_app on Bcrypt object)"""
+class CachedUser(UserMixin):
+    """Copy of the fields of a user that are needed to serve requests, used as
+    current_user so authenticating a request doesn't need a database query.
+    Its admin flag is only for showing links, use is_admin to grant access.
+    """
+
+    def __init__(self, user: models.User):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+        self.admin = user.admin
+
+    def __repr__(self):
+        return f"<CachedUser {self.username}>"
+
+
+def init_bcrypt(app: Flask, max_concurrency: int = 2) -> None:
+    """Initialise bcrypt with app (calls init_app on Bcrypt object), with the cost in
+    BCRYPT_LOG_ROUNDS. At most max_concurrency hashes are computed at a time per worker.
+    """
+    global _log_rounds, _hash_slots, _dummy_hash  # pylint: disable=W0603
     _bcrypt.init_app(app)
+    _log_rounds = app.config.get("BCRYPT_LOG_ROUNDS", 12)
+    _hash_slots = threading.BoundedSemaphore(max_concurrency)
+    # computed now rather than on the first login of an unknown user, which would take longer
+    # than a wrong password and so give away that the username doesn't exist
+    _dummy_hash = _bcrypt.generate_password_hash("dummy password", _log_rounds).decode("utf-8")
+
+
+def init_login_limits(attempts_per_username: int, attempts_per_ip: int, period: float) -> None:
+    """allow bursts of this many login attempts per username and per ip address, refilled over period seconds"""
+    global _username_limiter, _ip_limiter  # pylint: disable=W0603
+    _username_limiter = TokenBucketLimiter(attempts_per_username, period)
+    _ip_limiter = TokenBucketLimiter(attempts_per_ip, period)
+
+
+def login_allowed(username: str, remote_addr: str) -> bool:
+    """take a login attempt from the limits of username and ip address, returns False if either is used up"""
+    # the ip first, so attempts from a blocked ip don't use up the attempts of the username
+    if _ip_limiter is not None and not _ip_limiter.allow(remote_addr or ""):
+        return False
+    return _username_limiter is None or _username_limiter.allow((username or "").casefold())
+
+
+@contextmanager
+def _hash_slot():
+    """wait for a turn to compute a bcrypt hash"""
+    if not _hash_slots.acquire(timeout=_hash_wait_seconds):
+        raise AuthenticationError("The server is busy, please try again")
+    try:
+        yield
+    finally:
+        _hash_slots.release()
+
+
+def _hash_password(password: str) -> str:
+    with _hash_slot():
+        return _bcrypt.generate_password_hash(password, _log_rounds).decode("utf-8")
+
+
+def _check_password(pw_hash: str, password: str) -> bool:
+    with _hash_slot():
+        return _bcrypt.check_password_hash(pw_hash, password)
+
+
+def _needs_rehash(pw_hash: str) -> bool:
+    """whether a hash ($2b$<log rounds>$...) has a different cost than configured"""
+    try:
+        return int(pw_hash.split("$")[2]) != _log_rounds
+    except (IndexError, ValueError):
+        return False
+
+
+def init_user_cache(seconds: float) -> None:
+    """set how long loaded users are cached, 0 disables the cache"""
+    global _user_cache_seconds  # pylint: disable=W0603
+    _user_cache_seconds = seconds
+
+
+def invalidate_user_cache() -> None:
+    """Make every worker on the host load users from the database again, call this
+    after changing a user. Other hosts still see stale users until they expire after
+    the cache time, except for the admin flag (see is_admin).
+    """
+    cache.bump_version("users")
+    with _user_cache_lock:
+        _user_cache.clear()
+
+
+def load_user(user_id: str) -> CachedUser | None:
+    """load a user for flask-login, from the cache if it was loaded recently"""
+    credential_version = cache.version("users")
+    with _user_cache_lock:
+        expiry, version, user = _user_cache.get(user_id, (0, None, None))
+    if version == credential_version and expiry > time.monotonic():
+        return user
+
+    try:
+        db_user = database.db.session.get(models.User, int(user_id))
+    except ValueError:
+        return None
+    if db_user is None:
+        return None
+    user = CachedUser(db_user)
+    if _user_cache_seconds:
+        with _user_cache_lock:
+            _user_cache[user_id] = (time.monotonic() + _user_cache_seconds, credential_version, user)
+    return user
 
 
 def authenticate_user(username: str, password: str) -> tuple[str, bool]:
@@ -38,15 +161,27 @@ def authenticate_user(username: str, password: str) -> tuple[str, bool]:
     """
     # Finds a user by filtering for the username
     user = models.User.query.filter_by(username=username).first()
-    if user is None:
-        return "User with that username doesn't exist", False
-    # Check if the password entered is the same as the user's password
-    if _bcrypt.check_password_hash(user.password, password):
-        # Use the login_user method to log in the user
-        login_user(user, remember=True)
-        return "Login successful", True
+    try:
+        # unknown users are checked against a dummy hash, so they take as long as a wrong password
+        valid = _check_password(_dummy_hash if user is None else user.password, password or "")
+    except AuthenticationError as exc:
+        return str(exc), False
+    if user is None or not valid:
+        return "Wrong username or password", False
 
-    return "Wrong password", False
+    if _needs_rehash(user.password):
+        # the cost was changed since the password was set
+        try:
+            user.password = _hash_password(password)
+            database.commit()
+            invalidate_user_cache()
+        except AuthenticationError:
+            pass  # too busy, try again on the next login
+        except SQLAlchemyError:
+            database.rollback()  # e.g. a read-only snapshot
+    # Use the login_user method to log in the user
+    login_user(user, remember=True)
+    return "Login successful", True
 
 
 def create_user(username: str, email: str, password: str, admin: bool = False) -> tuple[str, bool]:
@@ -57,9 +192,10 @@ def create_user(username: str, email: str, password: str, admin: bool = False) -
     :param admin: whether the user is an admin
     :return: tuple of: (success/error message: string, successfully authenticated: bool)
     """
-    pw_hash = _bcrypt.generate_password_hash(password).decode(
-        "utf-8"
-    )
+    try:
+        pw_hash = _hash_password(password)
+    except AuthenticationError as exc:
+        return str(exc), False
     # noinspection PyArgumentList
     # ^ to supress errors caused by bug in pycharm
     new_user = models.User(
@@ -71,6 +207,7 @@ def create_user(username: str, email: str, password: str, admin: bool = False) -
     try:
         database.add(new_user)
         database.commit()
+        invalidate_user_cache()
         return "User added", True
     except IntegrityError:
         database.rollback()
@@ -84,7 +221,7 @@ def update_user(user_id: str, username: str, email: str = None, new_password: st
     """
     user = models.User.query.get(user_id)
     # if user entered new password: check if current password is correct
-    if new_password and not _bcrypt.check_password_hash(user.password, current_password):
+    if new_password and not _check_password(user.password, current_password or ""):
         raise AuthenticationError("Your current password was incorrect.")
 
     if username:
@@ -92,18 +229,38 @@ def update_user(user_id: str, username: str, email: str = None, new_password: st
     if email:
         user.email = email
     if new_password:
-        pw_hash = _bcrypt.generate_password_hash(new_password).decode(
-            "utf-8"
-        )
-        user.password = pw_hash
+        user.password = _hash_password(new_password)
     database.commit()
+    invalidate_user_cache()
+
+
+def set_admin(username: str, admin: bool) -> bool:
+    """grant or revoke admin rights, returns False if the user doesn't exist"""
+    user = models.User.query.filter_by(username=username).first()
+    if user is None:
+        return False
+    user.admin = admin
+    database.commit()
+    invalidate_user_cache()
+    return True
+
+
+def is_admin() -> bool:
+    """Whether the current user is an admin. Read from the database rather than the
+    user cache, so revoking admin rights takes effect right away in every worker.
+    """
+    if not current_user.is_authenticated:
+        return False
+    return bool(database.db.session.execute(
+        select(models.User.admin).where(models.User.id == current_user.id)
+    ).scalar())
 
 
 def admin_required(func):
     """Decorator to make a page only accessible to admins"""
 
     def admin_gate(*args, **kwargs):
-        if current_user.admin:
+        if is_admin():
             return func(*args, **kwargs)
         else:
             abort(401, description="You need to be admin to access this page")
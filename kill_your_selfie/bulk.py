@@ -0,0 +1,230 @@
+"""bulk import and export of occurrences"""
+import csv
+import io
+import json
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from itertools import batched
+from typing import Iterable, Iterator, TextIO
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from . import models, database, cache, events, aggregates
+
+FIELDS = ("time", "location", "target", "context")
+FORMATS = ("csv", "jsonl")
+# longest values of the varchar columns, a longer one would make the INSERT of its whole batch fail
+MAX_LENGTHS = {name: models.Occurrence.__table__.c[name].type.length for name in ("location_label", "target")}
+
+
+@dataclass
+class ImportResult:
+    """outcome of a bulk import"""
+    inserted: int = 0
+    duplicates: list[datetime] = field(default_factory=list)  # times that were already in the database
+    invalid: list[int] = field(default_factory=list)  # numbers of rows that couldn't be parsed
+
+    def __str__(self):
+        return (f"Imported {self.inserted} occurrences, skipped {len(self.duplicates)} duplicates "
+                f"and {len(self.invalid)} invalid rows")
+
+
+def format_from_filename(filename: str) -> str:
+    """guess the file format from the extension of a filename"""
+    file_format = filename.rsplit(".", 1)[-1].lower()
+    if file_format == "json":
+        file_format = "jsonl"
+    if file_format not in FORMATS:
+        raise ValueError(f"Unsupported file format: {file_format}")
+    return file_format
+
+
+def parse_rows(stream: TextIO, file_format: str) -> Iterator[dict | None]:
+    """Lazily parse occurrences from a csv (with header) or jsonl file with the fields
+    time (ISO 8601), location, target and context. Yields None for rows that are invalid,
+    including lines that aren't json and, if the stream decodes with errors="surrogateescape",
+    lines that aren't valid UTF-8.
+    """
+    match file_format:
+        case "csv":
+            records = csv.DictReader(stream)
+            while True:
+                try:
+                    record = next(records)
+                except StopIteration:
+                    return
+                except csv.Error:
+                    yield None
+                    continue
+                yield parse_record(record)
+        case "jsonl":
+            for line in stream:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    yield None
+                    continue
+                yield parse_record(record)
+        case _:
+            raise ValueError(f"Unsupported file format: {file_format}")
+
+
+def parse_record(record: dict) -> dict | None:
+    """convert an occurrence record from an import into column values, None if it is invalid"""
+    try:
+        row = {
+            "time": datetime.fromisoformat(record["time"]),
+            "location_label": record["location"],
+            "target": record["target"],
+            "context": record.get("context") or "",
+        }
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
+    if not all(isinstance(row[key], str) for key in ("location_label", "target", "context")):
+        return None
+    if any(len(row[key]) > length for key, length in MAX_LENGTHS.items()):
+        return None
+    try:
+        # bytes that weren't valid UTF-8 are decoded to lone surrogates, which can't be stored
+        for key in ("location_label", "target", "context"):
+            row[key].encode("utf-8")
+    except UnicodeEncodeError:
+        return None
+    return row
+
+
+def import_rows(rows: Iterable[dict | None], batch_size: int = 5000) -> ImportResult:
+    """Insert parsed occurrences in batches of multi-row INSERT ... ON CONFLICT statements,
+    creating missing locations and updating the daily rollup. Every batch is committed separately.
+    """
+    result = ImportResult()
+    try:
+        for batch_number, batch in enumerate(batched(rows, batch_size)):
+            valid = []
+            for index, row in enumerate(batch):
+                if row is None:
+                    result.invalid.append(batch_number * batch_size + index + 1)
+                else:
+                    valid.append(row)
+            if valid:
+                _import_batch(valid, result)
+    finally:
+        # the batches before a failing one are committed, so their writes have to be announced as well
+        if result.inserted:
+            database.rollback()
+            cache.bump_version("stats", cache.OCCURRENCES)
+            events.publish("refresh", {"inserted": result.inserted})
+            database.commit()
+            aggregates.request_refresh()
+    return result
+
+
+def import_batch(records: list[dict]) -> list[str]:
+    """Idempotently import a batch of occurrence records, e.g. queued offline on a phone.
+    Returns the status of every record:
+
+    - "created": the occurrence was added;
+    - "duplicate": an identical occurrence already exists, e.g. because the batch was sent before;
+    - "conflict": a different occurrence with the same time already exists;
+    - "invalid": the record is missing fields, has an invalid time, or a location or target that is too long.
+    """
+    rows = [parse_record(record) for record in records]
+    result = import_rows(rows, batch_size=max(len(rows), 1))
+
+    # of the rows with the same time, only the first one can have been inserted
+    skipped = Counter(result.duplicates)
+    created_times = {
+        time for time, amount in Counter(row["time"] for row in rows if row is not None).items()
+        if amount > skipped[time]
+    }
+    existing = {}
+    if skipped:
+        existing = {
+            occurrence.time: (occurrence.location_label, occurrence.target, occurrence.context)
+            for occurrence in models.Occurrence.query.filter(models.Occurrence.time.in_(list(skipped)))
+        }
+
+    statuses = []
+    for row in rows:
+        if row is None:
+            statuses.append("invalid")
+        elif row["time"] in created_times:
+            created_times.remove(row["time"])
+            statuses.append("created")
+        elif existing.get(row["time"]) == (row["location_label"], row["target"], row["context"]):
+            statuses.append("duplicate")
+        else:
+            statuses.append("conflict")
+    return statuses
+
+
+def _import_batch(rows: list[dict], result: ImportResult) -> None:
+    """insert one batch of occurrences and commit it"""
+    database.execute(
+        insert(models.Location)
+        .values([{"label": label} for label in {row["location_label"] for row in rows}])
+        .on_conflict_do_nothing(index_elements=["label"])
+    )
+    inserted = database.execute(
+        insert(models.Occurrence)
+        .values(rows)
+        .on_conflict_do_nothing(index_elements=["time"])
+        .returning(models.Occurrence.time, models.Occurrence.location_label, models.Occurrence.target)
+    ).all()
+
+    daily_counts = Counter((time.date(), location, target) for time, location, target in inserted)
+    if daily_counts:
+        statement = insert(models.DailyCount).values([
+            {"day": day, "location_label": location, "target": target, "amount": amount}
+            for (day, location, target), amount in daily_counts.items()
+        ])
+        database.execute(statement.on_conflict_do_update(
+            index_elements=["day", "location_label", "target"],
+            set_={"amount": models.DailyCount.amount + statement.excluded.amount},
+        ))
+        aggregates.mark_stale()
+    database.commit()
+
+    inserted_times = {row[0] for row in inserted}
+    result.inserted += len(inserted)
+    for row in rows:
+        if row["time"] in inserted_times:
+            # a later row with the same time in this batch is a duplicate as well
+            inserted_times.remove(row["time"])
+        else:
+            result.duplicates.append(row["time"])
+
+
+def export_rows(file_format: str, batch_size: int = 1000) -> Iterator[str]:
+    """Yield all occurrences as csv or jsonl lines, ordered by time. Rows are
+    fetched from a server-side cursor, so the table is never loaded in memory at once.
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f"Unsupported file format: {file_format}")
+    rows = database.execute(
+        select(models.Occurrence.time, models.Occurrence.location_label,
+               models.Occurrence.target, models.Occurrence.context)
+        .order_by(models.Occurrence.time)
+        .execution_options(yield_per=batch_size)
+    )
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if file_format == "csv":
+        writer.writerow(FIELDS)
+    for partition in rows.partitions():
+        for time, location, target, context in partition:
+            values = (time.isoformat(), location, target, context)
+            if file_format == "csv":
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(FIELDS, values))) + "\n")
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
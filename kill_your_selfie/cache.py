@@ -0,0 +1,298 @@
+"""caching of computed statistics
+
+Cached values are keyed on a data version that the write paths bump
+(see bump_version) and on the current date, so results that depend on
+"today" roll over at midnight without needing an explicit invalidation.
+The versions are kept in a SQLite file, so a bump is seen right away by
+every gunicorn worker and cli command on the host, whichever backend
+stores the values.
+"""
+import functools
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+from tempfile import gettempdir
+from typing import Callable
+
+from . import database
+
+# data version namespace of the occurrences themselves, only bumped by the writes that add them,
+# for indexes of them that don't have to be rebuilt when the stats namespace is bumped
+# because the materialized views were refreshed
+OCCURRENCES = "occurrences"
+
+
+class _SQLiteFile:
+    """SQLite file with the cache tables, opened once per thread and process"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads or forked processes
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entry (key TEXT PRIMARY KEY, namespace TEXT, value BLOB)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_version (namespace TEXT PRIMARY KEY, version INTEGER, changed_at REAL)"
+            )
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+
+class VersionStore(_SQLiteFile):
+    """data versions of the namespaces, shared between all processes using the same file"""
+
+    def get_version(self, namespace: str) -> int:
+        """current data version of a namespace"""
+        row = self._connection().execute(
+            "SELECT version FROM cache_version WHERE namespace = ?", (namespace,)
+        ).fetchone()
+        return 0 if row is None else row[0]
+
+    def get_changed_at(self, namespace: str) -> float:
+        """timestamp of the last version bump of a namespace"""
+        connection = self._connection()
+        # the first process to ask decides the timestamp, so all of them agree on it
+        connection.execute(
+            "INSERT OR IGNORE INTO cache_version (namespace, version, changed_at) VALUES (?, 0, ?)",
+            (namespace, time.time()),
+        )
+        return connection.execute(
+            "SELECT changed_at FROM cache_version WHERE namespace = ?", (namespace,)
+        ).fetchone()[0]
+
+    def bump_version(self, namespace: str) -> None:
+        """invalidate everything that was cached for a namespace"""
+        self._connection().execute(
+            """INSERT INTO cache_version (namespace, version, changed_at) VALUES (?, 1, ?)
+            ON CONFLICT (namespace) DO UPDATE SET version = version + 1, changed_at = excluded.changed_at""",
+            (namespace, time.time()),
+        )
+
+
+class SnapshotVersions:
+    """data versions of an app serving a read-only snapshot (see snapshot), which change
+    in every namespace whenever the snapshot file is replaced
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def get_version(self, namespace: str) -> int:  # pylint: disable=W0613
+        """version of the current snapshot file"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return 0
+        # a replaced file has a new inode, a copy of an older snapshot may keep its mtime
+        return hash((stat.st_ino, stat.st_mtime_ns))
+
+    def get_changed_at(self, namespace: str) -> float:  # pylint: disable=W0613
+        """time the current snapshot file was written"""
+        try:
+            return os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return 0.0
+
+    def bump_version(self, namespace: str) -> None:
+        """nothing to do, a snapshot isn't written to"""
+
+
+class NullBackend:
+    """backend that never stores values"""
+
+    def get(self, key: str) -> tuple[bool, object]:
+        """returns a tuple of: (whether the key was found, cached value)"""
+        return False, None
+
+    def set(self, namespace: str, key: str, value) -> None:
+        """store a value in the cache"""
+
+    def discard(self, namespace: str) -> None:
+        """drop the values of a namespace, after its version was bumped"""
+
+
+class LRUBackend(NullBackend):
+    """in-process least-recently-used cache, only shared between the threads of
+    one worker. Values of older versions that other workers bumped are never
+    returned again, and are evicted eventually.
+    """
+
+    def __init__(self, max_size: int = 128):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key: str) -> tuple[bool, object]:
+        with self._lock:
+            if key not in self._entries:
+                return False, None
+            self._entries.move_to_end(key)
+            return True, self._entries[key][1]
+
+    def set(self, namespace: str, key: str, value) -> None:
+        with self._lock:
+            self._entries[key] = (namespace, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, namespace: str) -> None:
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[0] == namespace]:
+                del self._entries[key]
+
+
+class SQLiteBackend(_SQLiteFile, NullBackend):
+    """cache stored in a local SQLite file, shared between all gunicorn
+    workers running on the same host
+    """
+
+    def __init__(self, path: str, max_size: int = 128):
+        super().__init__(path)
+        self.max_size = max_size
+
+    def get(self, key: str) -> tuple[bool, object]:
+        row = self._connection().execute("SELECT value FROM cache_entry WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False, None
+        return True, pickle.loads(row[0])
+
+    def set(self, namespace: str, key: str, value) -> None:
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache_entry (key, namespace, value) VALUES (?, ?, ?)",
+            (key, namespace, pickle.dumps(value)),
+        )
+        # evict the oldest entries, rowids of replaced entries are renewed
+        connection.execute(
+            "DELETE FROM cache_entry WHERE rowid <= (SELECT MAX(rowid) FROM cache_entry) - ?",
+            (self.max_size,),
+        )
+
+    def discard(self, namespace: str) -> None:
+        self._connection().execute("DELETE FROM cache_entry WHERE namespace = ?", (namespace,))
+
+
+def default_path(database_url: str) -> str:
+    """cache file in the temporary directory for a database, so apps using different
+    databases on one host (like the benchmarks) don't share versions
+    """
+    digest = hashlib.sha256(database_url.encode()).hexdigest()[:12]
+    return os.path.join(gettempdir(), f"kill_your_selfie_cache_{digest}.sqlite3")
+
+
+_versions = VersionStore(os.path.join(gettempdir(), "kill_your_selfie_cache.sqlite3"))
+_backend = NullBackend()
+
+
+def configure(backend: str, path: str, max_size: int = 128, snapshot: str = None) -> None:
+    """Select the cache backend: 'sqlite', 'lru' or 'none', and the file with the data versions
+    (and sqlite values). An app serving the snapshot file snapshot takes the versions from it instead.
+    """
+    global _backend, _versions  # pylint: disable=W0603
+    match backend:
+        case "lru":
+            _backend = LRUBackend(max_size)
+        case "sqlite":
+            _backend = SQLiteBackend(path, max_size)
+        case "none":
+            _backend = NullBackend()
+        case _:
+            raise ValueError(f"Unknown cache backend: {backend}")
+    _versions = SnapshotVersions(snapshot) if snapshot else VersionStore(path)
+
+
+def version(namespace: str = "stats") -> int:
+    """current data version of a namespace"""
+    return _versions.get_version(namespace)
+
+
+def last_modified(namespace: str = "stats") -> datetime:
+    """time at which the data of a namespace was last changed"""
+    return datetime.fromtimestamp(_versions.get_changed_at(namespace), timezone.utc)
+
+
+def bump_version(*namespaces: str) -> None:
+    """mark the data of the namespaces (stats if none are given) as changed, call this after committing a write"""
+    for namespace in namespaces or ("stats",):
+        _versions.bump_version(namespace)
+        _backend.discard(namespace)
+
+
+def cached(namespace: str = "stats"):
+    """Decorator that caches the result of a function until the data version
+    of the namespace is bumped or the date changes.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # results read from a replica are kept apart from those read from the primary
+            source = "primary" if database.read_target() == database.PRIMARY else "replica"
+            key = f"{namespace}:{version(namespace)}:{date.today()}:{source}:{func.__qualname__}:{args!r}:{kwargs!r}"
+            found, value = _backend.get(key)
+            if not found:
+                value = func(*args, **kwargs)
+                # until the replicas caught up with the last write, what they return may not include it
+                if source == "primary" or time.time() - _versions.get_changed_at(namespace) >= database.replica_lag_seconds():
+                    _backend.set(namespace, key, value)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+class VersionedIndex:
+    """Base of in-memory indexes of database data, like occurrences.OptionIndex and
+    spatial.LocationIndex. An index is (re)loaded lazily whenever the data version of
+    its namespace changed because of a write it hasn't seen, e.g. one done by another
+    worker, and the worker doing a write can update it in place instead (see _apply_write).
+    """
+
+    def __init__(self, load: Callable[[], list], namespace: str = "stats"):
+        """:param load: function returning the rows to build the index from, see _build"""
+        self._load = load
+        self._namespace = namespace
+        self._lock = threading.Lock()
+        self._version = None
+
+    def _build(self, rows: list) -> dict:
+        """the attributes of the index built from the rows returned by load, set together while holding the lock"""
+        raise NotImplementedError
+
+    def _ensure_loaded(self) -> None:
+        """load the index if it is missing writes, call this before reading it"""
+        current_version = version(self._namespace)
+        if self._version == current_version:
+            return
+        # the index is kept until the next write, so it mustn't be behind the primary
+        with database.reading_from(database.PRIMARY):
+            attributes = self._build(self._load())
+        with self._lock:
+            for name, value in attributes.items():
+                setattr(self, name, value)
+            self._version = current_version
+
+    def _apply_write(self, update: Callable[[], None]) -> None:
+        """Update the index in place for a write, call this after bumping the data version for
+        it. Skipped if the index missed other writes, it is reloaded on its next use then.
+        """
+        current_version = version(self._namespace)
+        with self._lock:
+            if self._version is None or self._version != current_version - 1:
+                return
+            update()
+            self._version = current_version
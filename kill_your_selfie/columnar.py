@@ -0,0 +1,267 @@
+"""in-memory columnar copy of the occurrences, for vectorized statistics
+
+Every worker keeps the time, location and target of all occurrences in NumPy
+arrays, with the locations and targets dictionary encoded as integer codes.
+The arrays are loaded on first use, add_occurrence appends to them after
+committing, and they are reloaded when the occurrences data version (see
+cache.OCCURRENCES) shows writes they don't have, like those of other workers
+or imports. Needs numpy, without it the statistics are computed in SQL.
+"""
+import logging
+import threading
+from dataclasses import dataclass
+from datetime import date, datetime
+
+from flask import Flask
+
+from . import cache, database
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+ENGINES = ("sql", "columnar")
+
+# numpy datetime units of the buckets, weeks are counted in days
+_UNITS = {"hour": "h", "day": "D", "month": "M"}
+
+_enabled = False
+
+
+class AnalyticsUnavailable(Exception):
+    """Error when statistics need the columnar store, but numpy isn't installed"""
+    def __init__(self, *args):
+        super().__init__(*args)
+
+
+class _Dictionary:
+    """integer codes of the distinct values of a column, in order of first use"""
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def encode_all(self, values: list) -> "np.ndarray":
+        return np.fromiter((self.encode(value) for value in values), dtype=np.int32, count=len(values))
+
+
+def _bucket_numbers(times: "np.ndarray", bucket: str) -> "np.ndarray":
+    """number of the hour, day, week or month of every time since the epoch"""
+    if bucket == "week":
+        # day 0 (1970-01-01) was a thursday, and weeks start on monday like DATE_TRUNC('week', ...)
+        return (times.astype("datetime64[D]").astype(np.int64) + 3) // 7
+    return times.astype(f"datetime64[{_UNITS[bucket]}]").astype(np.int64)
+
+
+def _bucket_labels(first: int, last: int, bucket: str) -> list[str]:
+    """ISO 8601 start of the buckets numbered first to last, see _bucket_numbers"""
+    numbers = np.arange(first, last + 1)
+    starts = (numbers * 7 - 3).astype("datetime64[D]") if bucket == "week" else numbers.astype(f"datetime64[{_UNITS[bucket]}]")
+    return [start.isoformat() for start in starts.astype("datetime64[us]").tolist()]
+
+
+@dataclass(frozen=True)
+class Columns:
+    """Consistent snapshot of the occurrences. Codes index into location_labels
+    and target_names, which are shared with the store and only ever grow.
+    """
+    times: "np.ndarray"  # datetime64[us]
+    locations: "np.ndarray"  # int32 codes, a code of the None location if it has none
+    targets: "np.ndarray"  # int32 codes
+    location_labels: list
+    target_names: list
+
+    def _mask(self, start: datetime = None, end: datetime = None, target: str = None,
+              location: str = None) -> "np.ndarray":
+        """which occurrences are between start and end (both inclusive) and of target and location, if given"""
+        mask = np.ones(len(self.times), dtype=bool)
+        if start is not None:
+            mask &= self.times >= np.datetime64(start, "us")
+        if end is not None:
+            mask &= self.times <= np.datetime64(end, "us")
+        for value, names, codes in ((target, self.target_names, self.targets),
+                                    (location, self.location_labels, self.locations)):
+            if value is not None:
+                mask &= codes == (names.index(value) if value in names else -1)
+        return mask
+
+    def timeseries(self, start: datetime, end: datetime, bucket: str, group_by: str = None) -> dict:
+        """the result of stats.timeseries"""
+        first, last = _bucket_numbers(np.array([start, end], dtype="datetime64[us]"), bucket).tolist()
+        count = last - first + 1
+        index = _bucket_numbers(self.times, bucket) - first
+        in_range = (index >= 0) & (index < count)
+        index = index[in_range]
+        labels = _bucket_labels(first, last, bucket)
+        if group_by is None:
+            return {"bucket": bucket, "labels": labels,
+                    "series": {"total": np.bincount(index, minlength=count).tolist()}}
+
+        codes, names = (self.targets, self.target_names) if group_by == "target" else (self.locations, self.location_labels)
+        present, compact = np.unique(codes[in_range], return_inverse=True)
+        counts = np.bincount(compact * count + index, minlength=len(present) * count).reshape(len(present), count)
+        series = {}
+        for code, amounts in zip(present.tolist(), counts):
+            # like COALESCE(name, '') in SQL
+            name = names[code] or ""
+            series[name] = series[name] + amounts if name in series else amounts
+        return {"bucket": bucket, "labels": labels,
+                "series": {name: series[name].tolist() for name in sorted(series)}}
+
+    def location_totals(self) -> dict[str, int]:
+        """amount of occurrences per location label"""
+        totals = np.bincount(self.locations, minlength=len(self.location_labels)).tolist()
+        return {label: total for label, total in zip(self.location_labels, totals) if label is not None and total}
+
+    def hour_weekday(self, **filters) -> list[list[int]]:
+        """amount of occurrences per weekday (rows, monday first) and hour of the day (columns)"""
+        times = self.times[self._mask(**filters)]
+        days = times.astype("datetime64[D]").astype(np.int64)
+        hours = times.astype("datetime64[h]").astype(np.int64) - days * 24
+        return np.bincount((days + 3) % 7 * 24 + hours, minlength=7 * 24).reshape(7, 24).tolist()
+
+    def streaks(self, today: date, **filters) -> list[dict]:
+        """Longest run of consecutive days with occurrences per target, with the day it ended,
+        and the current run (ending today or yesterday). Longest runs first.
+        """
+        mask = self._mask(**filters)
+        days = self.times[mask].astype("datetime64[D]").astype(np.int64)
+        if not len(days):
+            return []
+        first_day = days.min()
+        # sorted distinct (target, day) pairs packed in one integer
+        keys = np.unique(self.targets[mask].astype(np.int64) << 32 | (days - first_day))
+        targets = keys >> 32
+        days = (keys & 0xFFFFFFFF) + first_day
+
+        run_starts = np.flatnonzero(np.r_[True, (np.diff(targets) != 0) | (np.diff(days) != 1)])
+        lengths = np.diff(np.r_[run_starts, len(keys)])
+        run_ends = run_starts + lengths - 1
+        run_targets = targets[run_starts]
+        # last run of every target, and its longest (the latest one if tied)
+        last_runs = np.flatnonzero(np.r_[run_targets[1:] != run_targets[:-1], True])
+        order = np.lexsort((days[run_ends], lengths, run_targets))
+        longest = order[last_runs]
+        current = np.where(days[run_ends[last_runs]] >= np.datetime64(today, "D").astype(np.int64) - 1,
+                           lengths[last_runs], 0)
+
+        result = [
+            {"target": self.target_names[target], "longest": length,
+             "longest_end": day.isoformat(), "current": current_length}
+            for target, length, day, current_length in zip(
+                run_targets[longest].tolist(), lengths[longest].tolist(),
+                days[run_ends[longest]].astype("datetime64[D]").tolist(), current.tolist())
+        ]
+        result.sort(key=lambda streak: (-streak["longest"], streak["target"]))
+        return result
+
+    def rolling_average(self, start: datetime, end: datetime, window: int, target: str = None,
+                        location: str = None) -> dict:
+        """average amount of occurrences per day over the window days up to every day between start and end"""
+        first, last = _bucket_numbers(np.array([start, end], dtype="datetime64[us]"), "day").tolist()
+        index = _bucket_numbers(self.times[self._mask(target=target, location=location)], "day") - (first - window + 1)
+        count = last - first + window
+        daily = np.bincount(index[(index >= 0) & (index < count)], minlength=count)
+        sums = np.cumsum(np.r_[0, daily])
+        return {"bucket": "day", "window": window, "labels": _bucket_labels(first, last, "day"),
+                "series": {"total": ((sums[window:] - sums[:-window]) / window).tolist()}}
+
+
+def _load_occurrences() -> list:
+    """time, location and target of every occurrence, by time"""
+    return database.get_sql_data("SELECT time, location_label, target FROM occurrence ORDER BY time")
+
+
+class OccurrenceStore(cache.VersionedIndex):
+    """The columns of the occurrences of a worker, growing in place as occurrences
+    are added. Snapshots stay valid, since appending only writes past their end
+    or into new arrays.
+    """
+
+    def __init__(self):
+        super().__init__(_load_occurrences, cache.OCCURRENCES)
+        self._size = 0
+        self._loaded = 0  # the first _loaded times are sorted, they were loaded from the database
+        self._times = self._locations = self._targets = None
+        self._location_labels = self._target_names = None
+
+    def _build(self, rows: list) -> dict:
+        location_labels, target_names = _Dictionary(), _Dictionary()
+        times = np.array([row[0] for row in rows], dtype="datetime64[us]")
+        logger.info("Loaded %d occurrences into the columnar store", len(times))
+        return {
+            "_times": times, "_locations": location_labels.encode_all([row[1] for row in rows]),
+            "_targets": target_names.encode_all([row[2] for row in rows]),
+            "_location_labels": location_labels, "_target_names": target_names,
+            "_size": len(times), "_loaded": len(times),
+        }
+
+    def add(self, time: datetime, location: str, target: str) -> None:
+        """append an occurrence, call this after bumping the data version for the write"""
+
+        def update():
+            value = np.datetime64(time, "us")
+            # loaded between the commit of the occurrence and the version bump, so it has it already
+            position = np.searchsorted(self._times[:self._loaded], value)
+            if position < self._loaded and self._times[position] == value:
+                return
+            if self._size == len(self._times):
+                capacity = max(1024, 2 * self._size)
+                self._times = np.resize(self._times, capacity)
+                self._locations = np.resize(self._locations, capacity)
+                self._targets = np.resize(self._targets, capacity)
+            self._times[self._size] = value
+            self._locations[self._size] = self._location_labels.encode(location)
+            self._targets[self._size] = self._target_names.encode(target)
+            self._size += 1
+
+        self._apply_write(update)
+
+    def columns(self) -> Columns:
+        """snapshot of all occurrences, loading them again first if writes are missing"""
+        self._ensure_loaded()
+        with self._lock:
+            return Columns(self._times[:self._size], self._locations[:self._size], self._targets[:self._size],
+                           self._location_labels.values, self._target_names.values)
+
+
+store = OccurrenceStore() if np is not None else None
+
+
+def init_app(app: Flask, engine: str = "sql") -> None:
+    """compute the statistics with the sql or columnar engine"""
+    global _enabled  # pylint: disable=W0603
+    if engine not in ENGINES:
+        raise ValueError(f"STATS_ENGINE must be one of {', '.join(ENGINES)}")
+    if engine == "columnar" and store is None:
+        logger.warning("STATS_ENGINE is columnar, but numpy isn't installed, computing statistics in SQL")
+    _enabled = engine == "columnar" and store is not None
+    app.config["STATS_ENGINE"] = "columnar" if _enabled else "sql"
+
+
+def enabled() -> bool:
+    """whether the statistics are computed on the columnar store"""
+    return _enabled
+
+
+def columns() -> Columns:
+    """snapshot of the occurrences in the columnar store, raises AnalyticsUnavailable without numpy"""
+    if store is None:
+        raise AnalyticsUnavailable("These statistics need numpy, which isn't installed")
+    return store.columns()
+
+
+def add(time: datetime, location: str, target: str) -> None:
+    """append a committed occurrence to the store, see OccurrenceStore.add"""
+    if store is not None:
+        store.add(time, location, target)
@@ -0,0 +1,51 @@
+"""data of all panels of the home page dashboard, fetched at once
+
+In "combined" mode, the time series panels are fetched in a single SQL statement,
+and the heatmap comes from the geohash index of the locations (see spatial). In
+"parallel" mode (or when the combined statement fails), every panel is fetched
+in its own thread with its own app context and thus its own database session.
+A panel that fails is None, the page then loads it from its API endpoint.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, current_app
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import database, stats
+
+logger = logging.getLogger(__name__)
+
+MODES = ("combined", "parallel")
+
+
+def _fetch_panel(app: Flask, read_target: str, panel: str):
+    """data of one panel, None if it fails"""
+    with app.app_context(), database.reading_from(read_target):
+        try:
+            return stats.dashboard_panel(panel)
+        except SQLAlchemyError:
+            logger.exception("Failed to fetch dashboard panel %s", panel)
+            return None
+
+
+def _fetch_parallel(max_workers: int) -> dict:
+    """data of every panel, fetched in parallel"""
+    app = current_app._get_current_object()  # pylint: disable=W0212
+    read_target = database.read_target()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dashboard") as executor:
+        results = executor.map(lambda panel: _fetch_panel(app, read_target, panel), stats.DASHBOARD_PANELS)
+        return dict(zip(stats.DASHBOARD_PANELS, results))
+
+
+def panels(mode: str = "combined", max_workers: int = 4) -> dict:
+    """{panel name: data or None if it failed} for every panel in stats.DASHBOARD_PANELS"""
+    if mode not in MODES:
+        raise ValueError(f"Unknown dashboard mode: {mode}")
+    if mode == "combined":
+        try:
+            return stats.dashboard_panels()
+        except SQLAlchemyError:
+            logger.exception("Failed to fetch the dashboard in one statement, fetching the panels separately")
+            database.rollback()
+    return _fetch_parallel(max_workers)
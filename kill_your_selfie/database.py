@@ -1,23 +1,204 @@
-"""functions for database interaction"""
-from flask import Flask
+"""functions for database interaction
+
+Reads of functions decorated with replica_reads go to a read replica when
+DB_REPLICA_URLS is set, everything else to the primary. A user reads from the
+primary for DB_REPLICA_LAG_SECONDS after a write request of theirs, so they
+see their own writes while the replicas catch up.
+"""
+import functools
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import path
+
+from flask import Flask, after_this_request, request, session
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text as sql_txt
+from flask_sqlalchemy.session import Session
+from sqlalchemy import DateTime, event, literal_column, text as sql_txt
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql.expression import ColumnElement, FunctionElement
 
 from typing import Sequence
 from sqlalchemy.engine import Row
 
-db = SQLAlchemy()
+PRIMARY = "primary"
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+_replicas = []  # bind keys of the replicas
+_replica_lag_seconds = 10.0
+# where the reads of replica_reads functions go in the current request, and whether one is running
+_read_target = ContextVar("read_target", default=PRIMARY)
+_replica_reads = ContextVar("replica_reads", default=False)
+
+
+class RoutingSession(Session):
+    """session sending the statements of replica_reads functions to the replica of the request"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and _replica_reads.get() and not self._flushing and _read_target.get() != PRIMARY:
+            return self._db.engines[_read_target.get()]
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 add = db.session.add
+execute = db.session.execute
 commit = db.session.commit
 rollback = db.session.rollback
 
 
-def register_app(app: Flask) -> None:
-    """register Flask app with SQLAlchemy instance"""
+def database_url(config) -> str:
+    """SQLAlchemy url of the database of an app Config"""
+    if config.DB_SNAPSHOT:
+        # opened read-only, see snapshot
+        return f"sqlite:///file:{path.abspath(config.DB_SNAPSHOT)}?mode=ro&uri=true"
+    return f"postgresql+psycopg2://{config.DB_USERNAME}:{config.DB_PASSWORD}@{config.DB_HOST}:{config.DB_PORT}/{config.DB_DATABASE}"
+
+
+def engine_options(config) -> dict:
+    """SQLALCHEMY_ENGINE_OPTIONS for the pool settings of an app Config"""
+    if config.DB_SNAPSHOT:
+        # opened for every request, so a replaced snapshot is used right away
+        return {"poolclass": NullPool}
+    if config.DB_PGBOUNCER:
+        # PgBouncer does the pooling, and rejects the options startup parameter
+        return {"poolclass": NullPool}
+    options = {
+        "pool_size": config.DB_POOL_SIZE,
+        "max_overflow": config.DB_MAX_OVERFLOW,
+        "pool_timeout": config.DB_POOL_TIMEOUT,
+        "pool_recycle": config.DB_POOL_RECYCLE,
+        "pool_pre_ping": config.DB_POOL_PRE_PING,
+    }
+    if config.DB_STATEMENT_TIMEOUT_MS:
+        options["connect_args"] = {"options": f"-c statement_timeout={config.DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
+
+def register_app(app: Flask, transaction_statement_timeout_ms: int = 0) -> None:
+    """Register Flask app with SQLAlchemy instance. When transaction_statement_timeout_ms
+    is set, every transaction starts with SET LOCAL statement_timeout, for poolers
+    where connection level settings don't stick.
+    """
     db.init_app(app)
+    if transaction_statement_timeout_ms:
+        with app.app_context():
+            for engine in db.engines.values():
+                event.listen(engine, "begin", _set_statement_timeout(transaction_statement_timeout_ms))
+
+
+def _set_statement_timeout(timeout_ms: int):
+    def set_statement_timeout(connection):
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+    return set_statement_timeout
+
+
+def init_replicas(app: Flask, urls: list[str], options: dict, lag_seconds: float = 10) -> None:
+    """Add engines for the read replicas at urls (with engine options), call this before
+    register_app. Users read from the primary for lag_seconds after they wrote.
+    """
+    global _replicas, _replica_lag_seconds  # pylint: disable=W0603
+    _replicas = [f"replica_{number}" for number in range(len(urls))]
+    _replica_lag_seconds = lag_seconds
+    app.config["SQLALCHEMY_BINDS"] = {key: {"url": url, **options} for key, url in zip(_replicas, urls)}
+    if not _replicas:
+        return
+
+    @app.before_request
+    def choose_read_target():
+        # the replica reads of a request all go to the same replica
+        recently_wrote = time.time() - session.get("wrote_at", 0) < _replica_lag_seconds
+        _read_target.set(PRIMARY if recently_wrote else random.choice(_replicas))
+        if request.method in WRITE_METHODS:
+            @after_this_request
+            def remember_write(response):
+                if response.status_code < 400:
+                    session["wrote_at"] = time.time()
+                return response
+
+    @app.teardown_request
+    def reset_read_target(_exc):
+        _read_target.set(PRIMARY)
+
+
+def read_target() -> str:
+    """PRIMARY or the bind key of the replica that replica_reads functions read from in the current request"""
+    return _read_target.get()
+
+
+@contextmanager
+def reading_from(target: str):
+    """read from target (see read_target) in replica_reads functions, e.g. in a thread working for a request"""
+    token = _read_target.set(target)
+    try:
+        yield
+    finally:
+        _read_target.reset(token)
+
+
+def replica_lag_seconds() -> float | None:
+    """how far the replicas may be behind the primary, None without replicas"""
+    return _replica_lag_seconds if _replicas else None
+
+
+def replica_reads(func):
+    """decorator sending the statements of func to the replica of the current request, if any,
+    for functions that only read and can do with data that is a few seconds old
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _replica_reads.set(True)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _replica_reads.reset(token)
+
+    return wrapper
+
+
+def get_sql_data(query, params: dict = None) -> Sequence[Row]:
+    """get data from raw SQL query, with optional bind parameters (:name in query)"""
+    return db.session.execute(sql_txt(query), params).fetchall()
+
+
+def dialect() -> str:
+    """name of the database dialect of the current app, postgresql or sqlite"""
+    return db.engine.dialect.name
+
+
+class date_trunc(FunctionElement):  # pylint: disable=C0103
+    """Portable DATE_TRUNC(bucket, expression): the start of the hour, day, week (starting
+    on monday) or month of a timestamp or date, as a timestamp
+    """
+    type = DateTime()
+    inherit_cache = True
+    _BUCKETS = ("hour", "day", "week", "month")
+
+    def __init__(self, bucket: str, expression: ColumnElement):
+        if bucket not in self._BUCKETS:
+            raise ValueError(f"bucket must be one of {', '.join(self._BUCKETS)}")
+        self.bucket = bucket
+        # the bucket is an argument as well, so it is part of the key of the compiled statement cache
+        super().__init__(literal_column(f"'{bucket}'"), expression)
+
+
+@compiles(date_trunc)
+def _compile_date_trunc(element: date_trunc, compiler, **kwargs) -> str:
+    bucket, expression = (compiler.process(clause, **kwargs) for clause in element.clauses)
+    return f"DATE_TRUNC({bucket}, CAST({expression} AS TIMESTAMP))"
 
 
-def get_sql_data(query) -> Sequence[Row]:
-    """get data from raw SQL query"""
-    return db.session.execute(sql_txt(query)).fetchall()
+@compiles(date_trunc, "sqlite")
+def _compile_date_trunc_sqlite(element: date_trunc, compiler, **kwargs) -> str:
+    expression = compiler.process(element.clauses.clauses[1], **kwargs)
+    match element.bucket:
+        case "hour":
+            return f"strftime('%Y-%m-%d %H:00:00', {expression})"
+        case "week":
+            # the next sunday (or the day itself if it is one), and 6 days back from there
+            return f"datetime({expression}, 'weekday 0', '-6 days', 'start of day')"
+        case _:
+            return f"datetime({expression}, 'start of {element.bucket}')"
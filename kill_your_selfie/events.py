@@ -0,0 +1,117 @@
+"""live updates for open dashboards, over Postgres LISTEN/NOTIFY
+
+Writes publish small events with NOTIFY in the transaction of the write, so
+they are only sent when it commits. Every worker process has one listener thread with
+its own connection that LISTENs for them and hands them to the Server-Sent
+Events streams (see /api/stream) of that worker.
+"""
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import text as sql_txt
+
+from . import database
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "kys_events"
+
+
+def publish(event_type: str, data: dict) -> None:
+    """Send an event to all open streams once the current transaction commits.
+    Keep data small, NOTIFY payloads are limited to 8000 bytes.
+    """
+    database.execute(
+        sql_txt("SELECT pg_notify(:channel, :payload)"),
+        {"channel": CHANNEL, "payload": json.dumps({"type": event_type, "data": data}, default=str)},
+    )
+
+
+class EventBroker:
+    """Fans out the events of the channel to the subscribed streams of this
+    worker process. The listener thread is started on the first subscription,
+    and reconnects after losing its connection.
+    """
+
+    def __init__(self, connect_args: dict, max_subscribers: int = 4, queue_size: int = 100,
+                 reconnect_delay: float = 5):
+        """:param connect_args: keyword arguments for psycopg2.connect"""
+        self.connect_args = connect_args
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.reconnect_delay = reconnect_delay
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def subscribe(self) -> queue.Queue | None:
+        """queue that receives (event type, data) of every event, None if there are too many subscribers"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # subscriptions and threads don't survive a fork, so a (pre)forked worker starts over
+                self._subscribers = set()
+                self._thread = None
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscription = queue.Queue(maxsize=self.queue_size)
+            self._subscribers.add(subscription)
+            if self._thread is None:
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="event-listener", daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription: queue.Queue) -> None:
+        """stop sending events to a subscription"""
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def _dispatch(self, payload: str) -> None:
+        try:
+            event = json.loads(payload)
+            message = (event["type"], event["data"])
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignoring invalid event: %s", payload)
+            return
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(message)
+            except queue.Full:
+                pass  # the client isn't keeping up, drop the event
+
+    def _run(self) -> None:
+        while True:
+            connection = None
+            try:
+                connection = psycopg2.connect(**self.connect_args)
+                connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL}")
+                while True:
+                    # only wakes up when a notification arrives
+                    if select.select([connection], [], [], 60) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self._dispatch(connection.notifies.pop(0).payload)
+            except (psycopg2.Error, OSError) as exc:
+                logger.warning("Lost the event listener connection, reconnecting: %s", exc)
+            finally:
+                if connection is not None:
+                    connection.close()
+            time.sleep(self.reconnect_delay)
+
+
+def format_event(event_type: str, data) -> str:
+    """an event in the Server-Sent Events format"""
+    return f"event: {event_type}\ndata: {json.dumps(data, default=str)}\n\n"
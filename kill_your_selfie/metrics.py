@@ -0,0 +1,209 @@
+"""per-request performance instrumentation, exposed in the Prometheus text format
+
+Every worker process keeps its own histograms. When a metrics directory is
+configured, each worker regularly writes them to its own file in that
+directory, and /metrics adds up the files of all workers, so the numbers
+are correct whichever gunicorn worker answers the scrape.
+"""
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+
+from flask import Flask, g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+
+from .database import db
+
+logger = logging.getLogger(__name__)
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# name: (help text, buckets)
+HISTOGRAMS = {
+    "kys_request_duration_seconds": ("Wall time of requests per route", TIME_BUCKETS),
+    "kys_sql_queries": ("SQL queries executed per request", COUNT_BUCKETS),
+    "kys_sql_duration_seconds": ("Total time spent executing SQL per request", TIME_BUCKETS),
+    "kys_template_render_seconds": ("Total time spent rendering templates per request", TIME_BUCKETS),
+    "kys_ntfy_seconds": ("Total time spent in the ntfy controller per request", TIME_BUCKETS),
+    "kys_ntfy_post_seconds": ("Time taken by posts to the ntfy server, including retries", TIME_BUCKETS),
+}
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_histograms = {}  # name: {label value: [bucket counts..., sum, count]}
+_metrics_dir = None
+_file = None
+_flush_interval = 1.0
+_last_flush = 0.0
+_slow_request_seconds = None
+
+
+def observe(name: str, value: float, label: str = "") -> None:
+    """add an observation to a histogram"""
+    buckets = HISTOGRAMS[name][1]
+    with _lock:
+        values = _histograms.setdefault(name, {}).setdefault(label, [0] * (len(buckets) + 2))
+        values[bisect_left(buckets, value)] += 1  # counts per bucket, cumulated when exporting
+        values[-2] += value
+        values[-1] += 1
+    _maybe_flush()
+
+
+@contextmanager
+def track(kind: str):
+    """add the time spent inside this block to the current request's total for kind (e.g. 'ntfy')"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context() and "metrics" in g:
+            g.metrics[kind] += time.perf_counter() - start
+
+
+def _maybe_flush(force: bool = False) -> None:
+    """write this worker's histograms to its file in the metrics directory"""
+    global _last_flush  # pylint: disable=W0603
+    target = _file
+    if target is None:
+        return
+    with _flush_lock:
+        if not force and time.monotonic() - _last_flush < _flush_interval:
+            return
+        _last_flush = time.monotonic()
+        with _lock:
+            data = json.dumps(_histograms)
+        # written next to the file and renamed, so readers never see a partial file
+        with tempfile.NamedTemporaryFile("w", dir=target.parent, prefix=f"{target.stem}-", suffix=".tmp",
+                                         delete=False) as temporary_file:
+            temporary_file.write(data)
+        os.replace(temporary_file.name, target)
+
+
+def _collect() -> dict:
+    """histograms of all workers added up"""
+    if _metrics_dir is None:
+        with _lock:
+            return json.loads(json.dumps(_histograms))
+    _maybe_flush(force=True)
+    merged = {}
+    for path in Path(_metrics_dir).glob("metrics-*.json"):
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue
+        for name, labels in data.items():
+            for label, values in labels.items():
+                total = merged.setdefault(name, {}).setdefault(label, [0] * len(values))
+                for i, value in enumerate(values):
+                    total[i] += value
+    return merged
+
+
+def exposition() -> str:
+    """all histograms in the Prometheus text exposition format"""
+    lines = []
+    data = _collect()
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for label, values in sorted(data.get(name, {}).items()):
+            label_text = f'route="{label}",' if label else ""
+            cumulative = 0
+            for bound, count in zip((*buckets, "+Inf"), values[:-2]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label_text}le="{bound}"}} {cumulative}')
+            label_text = f'{{route="{label}"}}' if label else ""
+            lines.append(f"{name}_sum{label_text} {values[-2]}")
+            lines.append(f"{name}_count{label_text} {values[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+def _before_request() -> None:
+    g.metrics = {"start": time.perf_counter(), "sql_queries": 0, "sql": 0.0, "template": 0.0, "ntfy": 0.0,
+                 "statements": []}
+
+
+def _teardown_request(_exc) -> None:
+    if "metrics" not in g:
+        return
+    timings = g.pop("metrics")
+    duration = time.perf_counter() - timings["start"]
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    observe("kys_request_duration_seconds", duration, route)
+    observe("kys_sql_queries", timings["sql_queries"], route)
+    observe("kys_sql_duration_seconds", timings["sql"], route)
+    observe("kys_template_render_seconds", timings["template"], route)
+    observe("kys_ntfy_seconds", timings["ntfy"], route)
+    if _slow_request_seconds is not None and duration > _slow_request_seconds:
+        logger.warning(
+            "Slow request %s %s: %.3fs total, %d SQL queries taking %.3fs, %.3fs rendering templates, "
+            "%.3fs in ntfy controller. SQL statements:\n%s",
+            request.method, request.path, duration, timings["sql_queries"], timings["sql"], timings["template"],
+            timings["ntfy"], "\n".join(f"[{seconds:.3f}s] {statement}" for statement, seconds in timings["statements"]),
+        )
+
+
+def _before_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany) -> None:
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, _cursor, statement, _parameters, _context, _executemany) -> None:
+    seconds = time.perf_counter() - conn.info["metrics_query_start"].pop()
+    if has_request_context() and "metrics" in g:
+        g.metrics["sql_queries"] += 1
+        g.metrics["sql"] += seconds
+        if _slow_request_seconds is not None:
+            g.metrics["statements"].append((statement, seconds))
+
+
+def _before_render_template(_app, **_extra) -> None:
+    if "metrics" in g:
+        g.metrics.setdefault("template_start", []).append(time.perf_counter())
+
+
+def _template_rendered(_app, **_extra) -> None:
+    if "metrics" in g and g.metrics.get("template_start"):
+        g.metrics["template"] += time.perf_counter() - g.metrics["template_start"].pop()
+
+
+def init_app(app: Flask, metrics_dir: str = None, slow_request_seconds: float = None) -> None:
+    """Instrument app. When metrics_dir is set, the histograms of all worker processes
+    sharing that directory are added up. Requests taking longer than slow_request_seconds
+    are logged together with their SQL statements.
+    """
+    global _metrics_dir, _slow_request_seconds  # pylint: disable=W0603
+    _slow_request_seconds = slow_request_seconds
+    if metrics_dir:
+        _metrics_dir = metrics_dir
+        os.makedirs(metrics_dir, exist_ok=True)
+        atexit.register(_maybe_flush, force=True)
+
+    @app.before_request
+    def before_request():
+        global _file  # pylint: disable=W0603
+        # the file name is decided in the worker itself, a (pre)forked worker has a different pid
+        prefix = f"metrics-{os.getpid()}-"
+        if _metrics_dir and (_file is None or not _file.name.startswith(prefix)):
+            with _lock:
+                if _file is None or not _file.name.startswith(prefix):
+                    _file = Path(_metrics_dir, f"{prefix}{time.time_ns()}.json")
+                    # observations inherited from the parent process are counted by the parent
+                    _histograms.clear()
+        _before_request()
+
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+    with app.app_context():
+        # the primary and the read replicas (see database.init_replicas)
+        for engine in db.engines.values():
+            event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", _after_cursor_execute)
@@ -3,6 +3,7 @@ from flask import Flask
 from flask_login import UserMixin
 
 from .database import db
+from . import aggregates, search
 
 
 class Location(db.Model):
@@ -27,12 +28,58 @@ class Occurrence(db.Model):
     target = db.Column(db.String(80), unique=False, nullable=False)
     context = db.Column(db.String(), unique=False, nullable=False)
 
+    __table_args__ = (
+        # for paging through the occurrences of a target or location by time, see occurrences.page_occurrences
+        db.Index("ix_occurrence_target_time", "target", "time"),
+        db.Index("ix_occurrence_location_label_time", "location_label", "time"),
+        # full-text search, the expression has to match the one in search.search
+        db.Index("ix_occurrence_context_search", db.text("to_tsvector('simple', context)"), postgresql_using="gin"),
+    )
+
     location = db.relationship("Location", back_populates="occurrences")
 
     def __repr__(self):
         return f"<Occurrence {self.time}>"
 
 
+class DailyCount(db.Model):
+    """amount of occurrences per day, location and target,
+    kept up to date by occurrences.add_occurrence
+    """
+    __tablename__ = "daily_count"
+
+    day = db.Column(db.Date, primary_key=True)
+    location_label = db.Column(db.String(80), primary_key=True)
+    target = db.Column(db.String(80), primary_key=True)
+    amount = db.Column(db.Integer, unique=False, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<DailyCount {self.day} {self.location_label} {self.target}: {self.amount}>"
+
+
+class AggregateState(db.Model):
+    """single row with how up to date the materialized views of the aggregates module are"""
+    __tablename__ = "aggregate_state"
+
+    id = db.Column(db.Integer, primary_key=True)
+    refreshed_version = db.Column(db.BigInteger, nullable=False, default=0)  # write version included in the views
+    refreshed_at = db.Column(db.TIMESTAMP(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f"<AggregateState {self.refreshed_version}>"
+
+
+class WriteCount(db.Model):
+    """writes to the daily rollup, counted in a row per shard (see aggregates.mark_stale)"""
+    __tablename__ = "write_count"
+
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.BigInteger, nullable=False)
+
+    def __repr__(self):
+        return f"<WriteCount {self.shard}: {self.version}>"
+
+
 class User(UserMixin, db.Model):
     """application user"""
     __tablename__ = "user"
@@ -48,6 +95,12 @@ class User(UserMixin, db.Model):
 
 
 def create_tables(app: Flask) -> None:
-    """create tables in database that do not exist yet"""
+    """create tables, indexes and materialized views in database that do not exist yet, used by `flask init-db`"""
     with app.app_context():
         db.create_all()
+        # create_all skips tables that already exist, including indexes added to them later
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+        aggregates.create_views()
+        search.create_indexes()
@@ -1,10 +1,149 @@
-import requests
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class NtfyDispatcher:
+    """Sends ntfy messages from a background thread, so request handlers
+    never wait for the ntfy server.
+
+    Messages are put on a bounded queue (new messages are dropped when it is
+    full) and posted over a pooled session, retrying failed posts with
+    exponential backoff. When coalesce_window is set, messages arriving within
+    that many seconds of each other are sent as one digest message.
+    """
+
+    def __init__(self, endpoint: str, timeout: float = 5, retries: int = 3, backoff: float = 0.5,
+                 queue_size: int = 100, coalesce_window: float = 0):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.coalesce_window = coalesce_window
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._session = None
+
+    def submit(self, data: str, headers: dict) -> bool:
+        """queue a message, returns False if it was dropped because the queue is full"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((data, headers))
+            return True
+        except queue.Full:
+            logger.warning("ntfy queue is full, dropping notification")
+            return False
+
+    def flush(self, timeout: float = 5) -> bool:
+        """wait until all queued messages are sent, returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() > deadline or not self._is_running():
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout: float = 5) -> None:
+        """send the remaining messages, for at most timeout seconds, and stop the background thread"""
+        if self._is_running():
+            self.flush(timeout)
+            # the thread stops after its current batch, and drops what is left if the queue
+            # is still full, so it doesn't block on the stop sentinel
+            self._stop.set()
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                logger.warning("Dropping %d unsent ntfy notifications", self._queue.qsize())
+            self._thread.join(timeout)
+
+    def _is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+
+    def _ensure_started(self) -> None:
+        # threads don't survive a fork, so a (pre)forked worker starts its own
+        with self._lock:
+            if self._is_running():
+                return
+            # imported here, so workers that never send notifications don't load requests
+            import requests  # pylint: disable=C0415
+            self._session = requests.Session()
+            self._stop.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="ntfy-dispatcher", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            message = self._queue.get()
+            if message is None:
+                self._queue.task_done()
+                return
+            batch = [message]
+            deadline = time.monotonic() + self.coalesce_window
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    message = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if message is None:
+                    # send this batch and stop, close set the stop event already
+                    self._queue.task_done()
+                    break
+                batch.append(message)
+            try:
+                self._post(*(batch[0] if len(batch) == 1 else self._digest(batch)))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    @staticmethod
+    def _digest(batch: list[tuple[str, dict]]) -> tuple[str, dict]:
+        """combine several messages into one"""
+        data = "\n\n".join(f"**{headers.get('Title')}**\n{data}" for data, headers in batch)
+        headers = dict(batch[0][1])
+        headers["Title"] = f"{len(batch)} new notifications"
+        headers["Tags"] = ",".join(dict.fromkeys(h["Tags"] for _, h in batch if h.get("Tags")))
+        headers["Priority"] = max((h["Priority"] for _, h in batch if h.get("Priority")), default=None)
+        return data, headers
+
+    def _post(self, data: str, headers: dict) -> None:
+        start = time.perf_counter()
+        try:
+            self._post_with_retries(data, headers)
+        finally:
+            metrics.observe("kys_ntfy_post_seconds", time.perf_counter() - start)
+
+    def _post_with_retries(self, data: str, headers: dict) -> None:
+        import requests  # pylint: disable=C0415
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._session.post(self.endpoint, data=data.encode("utf-8"), headers=headers,
+                                              timeout=self.timeout)
+                response.raise_for_status()
+                return
+            except requests.RequestException as exc:
+                if attempt == self.retries:
+                    logger.error("Failed to send ntfy notification: %s", exc)
+                    return
+                time.sleep(self.backoff * 2 ** attempt)
 
 
 class NtfyController:
-    def __init__(self, auth_key, endpoint):
+    def __init__(self, auth_key, endpoint, **dispatcher_options):
         self.auth_key = auth_key
         self.endpoint = endpoint
+        self.dispatcher = NtfyDispatcher(endpoint, **dispatcher_options)
 
     def sendNotification(self, data: str, title: str = None, tags: str = None, priority: str = None):
         headers = {
@@ -15,7 +154,8 @@ class NtfyController:
             "Tags": tags,
             "Icon": None
         }
-        requests.post(self.endpoint, data=data, headers=headers)
+        with metrics.track("ntfy"):
+            self.dispatcher.submit(data, headers)
 
     def sendNewOccurrenceNotification(self, occurrence: dict, user):
         self.sendNotification(
@@ -25,6 +165,14 @@ class NtfyController:
             priority="3"  # If priority is lower than 3, the notification won't make any sound
         )
 
+    def sendNewOccurrencesNotification(self, amount: int, user):
+        self.sendNotification(
+            title=f"{amount} new occurrences were added by {user.username}",
+            data=f"amount: {amount}",
+            tags="newoccurrence",
+            priority="3"
+        )
+
     def sendNewUserNotification(self, username: str, is_admin: bool, email: str):
         self.sendNotification(
             title=f"User {username} was given access to kys",
@@ -46,4 +194,6 @@ class DummyNtfyController(NtfyController):
 
     def sendNewOccurrenceNotification(self, occurrence: dict, user): ...
 
+    def sendNewOccurrencesNotification(self, amount: int, user): ...
+
     def sendNewUserNotification(self, username: str, is_admin: bool, email: str): ...
@@ -1,6 +1,15 @@
 """Occurrence related functions"""
 import datetime
-from . import models, database
+import heapq
+from bisect import bisect_left, insort
+from dataclasses import dataclass
+from itertools import takewhile
+from typing import Callable
+
+from sqlalchemy import func, literal, select, text as sql_txt
+from sqlalchemy.engine import Row
+
+from . import models, database, cache, events, aggregates, columnar, stats
 
 
 class InvalidTimeError(Exception):
@@ -9,41 +18,207 @@ class InvalidTimeError(Exception):
         super().__init__(*args)
 
 
+class OptionIndex(cache.VersionedIndex):
+    """In-memory sorted index of the values used for an occurrence field,
+    for prefix search ranked by how often each value was used.
+    """
+
+    def __init__(self, load: Callable[[], list[tuple[str, int]]]):
+        """:param load: function returning (value, amount of uses) for every value"""
+        super().__init__(load, cache.OCCURRENCES)
+        self._keys = []  # sorted (casefolded value, value) tuples
+        self._counts = {}
+
+    def _build(self, rows: list[tuple[str, int]]) -> dict:
+        counts = dict(rows)
+        return {"_counts": counts, "_keys": sorted((value.casefold(), value) for value in counts)}
+
+    def add(self, value: str) -> None:
+        """register a use of value, call this after bumping the data version for the write"""
+
+        def update():
+            if value not in self._counts:
+                self._counts[value] = 0
+                insort(self._keys, (value.casefold(), value))
+            self._counts[value] += 1
+
+        self._apply_write(update)
+
+    def search(self, prefix: str = "", limit: int = 10) -> list[str]:
+        """values starting with prefix (case insensitive), most used first"""
+        self._ensure_loaded()
+        prefix = prefix.casefold()
+        with self._lock:
+            keys = self._keys
+            matches = takewhile(lambda key: key[0].startswith(prefix),
+                                (keys[index] for index in range(bisect_left(keys, (prefix, "")), len(keys))))
+            # only the limit most used are kept sorted, ties stay in alphabetical order
+            return heapq.nsmallest(limit, (value for _, value in matches), key=lambda value: -self._counts[value])
+
+
+@database.replica_reads
 def get_location_options() -> list:
     """Get history for location field"""
-    location_options=[]
-    for location in models.Location.query.all():
-        if not location.label in location_options:
-            location_options.append(location.label)
-    return location_options
+    return [label for (label,) in models.Location.query.with_entities(models.Location.label).order_by(models.Location.label)]
 
 
+@database.replica_reads
 def get_target_options() -> list:
     """Get history for target field"""
-    target_options = []
-    for occurrence in models.Occurrence.query.all():
-        if not occurrence.target in target_options:
-            target_options.append(occurrence.target)
-    return target_options
-
-
-def add_occurrence(time: datetime.datetime, location: str, target: str, context: str) -> None:
-    """Add a new occurrence"""
-    new_occurrence = models.Occurrence(
-        time=time,
-        location_label=location,
-        target=target,
-        context=context,
+    return [target for (target,) in models.Occurrence.query.with_entities(models.Occurrence.target).distinct()]
+
+
+def _count_options(column) -> list[tuple[str, int]]:
+    """amount of occurrences per distinct value of column"""
+    return models.Occurrence.query.with_entities(column, func.count()).filter(column.isnot(None)).group_by(column).all()
+
+
+option_indexes = {
+    "location": OptionIndex(lambda: _count_options(models.Occurrence.location_label)),
+    "target": OptionIndex(lambda: _count_options(models.Occurrence.target)),
+}
+
+
+@dataclass
+class OccurrencePage:
+    """a page of occurrences, newest first, with the cursors of the pages around it"""
+    occurrences: list[Row]  # (time, location_label, target, context)
+    newer: datetime.datetime | None = None  # pass as after to get the page with newer occurrences
+    older: datetime.datetime | None = None  # pass as before to get the page with older occurrences
+
+
+def _history_filters(target: str = None, location: str = None, start: datetime.date = None,
+                     end: datetime.date = None) -> list:
+    """conditions for occurrences with a target and location, between the start and end date (inclusive)"""
+    conditions = []
+    if target:
+        conditions.append(models.Occurrence.target == target)
+    if location:
+        conditions.append(models.Occurrence.location_label == location)
+    if start is not None:
+        conditions.append(models.Occurrence.time >= start)
+    if end is not None:
+        conditions.append(models.Occurrence.time < end + datetime.timedelta(days=1))
+    return conditions
+
+
+def page_occurrences(before: datetime.datetime = None, after: datetime.datetime = None, limit: int = 50,
+                     **filters) -> OccurrencePage:
+    """Page through the occurrences matching the filters (see _history_filters), newest first.
+    Pages are found with the time of the occurrence at their edge rather than an offset, so
+    any page takes as long as the first one.
+
+    :param before: time of the oldest occurrence of the previous page, for the next (older) page
+    :param after: time of the newest occurrence of the next page, for the previous (newer) page
+    """
+    time_column = models.Occurrence.time
+    query = select(time_column, models.Occurrence.location_label, models.Occurrence.target,
+                   models.Occurrence.context).where(*_history_filters(**filters))
+    if after is not None:
+        rows = database.execute(query.where(time_column > after).order_by(time_column).limit(limit + 1)).all()
+        more_newer = len(rows) > limit
+        rows = rows[:limit][::-1]
+        more_older = True
+    else:
+        if before is not None:
+            query = query.where(time_column < before)
+        rows = database.execute(query.order_by(time_column.desc()).limit(limit + 1)).all()
+        more_older = len(rows) > limit
+        rows = rows[:limit]
+        more_newer = before is not None
+    return OccurrencePage(
+        rows,
+        newer=rows[0].time if rows and more_newer else None,
+        older=rows[-1].time if rows and more_older else None,
+    )
+
+
+def estimate_occurrence_count(**filters) -> int:
+    """the planner's estimate of the amount of occurrences matching the filters (see _history_filters),
+    which is much cheaper than counting them
+    """
+    compiled = (
+        select(literal(1)).select_from(models.Occurrence).where(*_history_filters(**filters))
+        .compile(dialect=database.db.engine.dialect)
     )
-    if new_occurrence.location_label not in get_location_options():
-        new_location = models.Location(
-            label=new_occurrence.location_label,
-            latitude=None,
-            longitude=None
-        )
-        database.add(new_location)
-    database.add(new_occurrence)
+    plan = database.db.session.connection().exec_driver_sql(
+        f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params
+    ).scalar()
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def add_occurrence(time: datetime.datetime, location: str, target: str, context: str) -> bool:
+    """Add a new occurrence, creating its location, updating the daily rollup, counting the
+    write for the materialized views (see aggregates.mark_stale) and announcing it to open
+    dashboards (see events.publish) in a single statement.
+    Returns False if an occurrence with that time already exists.
+    """
+    inserted = database.execute(
+        sql_txt(
+            """
+            WITH new_location AS (
+                INSERT INTO location (label) VALUES (:location)
+                ON CONFLICT (label) DO NOTHING
+            ), new_occurrence AS (
+                INSERT INTO occurrence (time, location_label, target, context)
+                VALUES (:time, :location, :target, :context)
+                ON CONFLICT (time) DO NOTHING
+                RETURNING time, location_label, target
+            ), new_daily_count AS (
+                INSERT INTO daily_count (day, location_label, target, amount)
+                SELECT n.time::date, n.location_label, n.target, 1 FROM new_occurrence n
+                ON CONFLICT (day, location_label, target) DO UPDATE SET amount = daily_count.amount + 1
+            ), new_write AS (
+                INSERT INTO write_count (shard, version)
+                SELECT pg_backend_pid() % :shards, 1 FROM new_occurrence
+                ON CONFLICT (shard) DO UPDATE SET version = write_count.version + 1
+            ), announced AS (
+                SELECT pg_notify(:channel, json_build_object(
+                    'type', 'occurrence',
+                    'data', json_build_object('time', n.time, 'location', n.location_label, 'target', n.target,
+                                              'latitude', l.latitude, 'longitude', l.longitude)
+                )::text)
+                FROM new_occurrence n
+                LEFT JOIN location l ON l.label = n.location_label
+            )
+            SELECT COUNT(*) FROM announced
+            """
+        ),
+        {"time": time, "location": location, "target": target, "context": context,
+         "shards": aggregates.WRITE_COUNT_SHARDS, "channel": events.CHANNEL},
+    ).scalar() > 0
+    database.commit()
+    if inserted:
+        cache.bump_version("stats", cache.OCCURRENCES)
+        aggregates.request_refresh()
+        columnar.add(time, location, target)
+        option_indexes["location"].add(location)
+        option_indexes["target"].add(target)
+        stats.location_index.add(location)
+    return inserted
+
+
+def backfill_daily_counts() -> int:
+    """(Re)build the daily rollup from the occurrence table.
+    Returns the amount of rollup rows written.
+    """
+    result = database.execute(sql_txt(
+        """
+        INSERT INTO daily_count (day, location_label, target, amount)
+        SELECT
+            DATE_TRUNC('day', o.time)::date,
+            COALESCE(o.location_label, ''),
+            o.target,
+            COUNT(o.time)
+        FROM occurrence o
+        GROUP BY 1, 2, 3
+        ON CONFLICT (day, location_label, target) DO UPDATE SET amount = EXCLUDED.amount
+        """
+    ))
+    aggregates.mark_stale()
     database.commit()
+    cache.bump_version()
+    return result.rowcount
 
 
 def map_location(location: str, latitude: float, longitude: float) -> None:
@@ -51,4 +226,6 @@ def map_location(location: str, latitude: float, longitude: float) -> None:
     location = models.Location.query.filter_by(label=location).first()
     location.latitude = latitude
     location.longitude = longitude
+    events.publish("location", {"label": location.label, "latitude": latitude, "longitude": longitude})
     database.commit()
+    cache.bump_version()
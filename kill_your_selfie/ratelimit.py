@@ -0,0 +1,33 @@
+"""in-process token bucket rate limiting"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    """Allows bursts of up to capacity attempts per key, refilled at capacity
+    attempts per period seconds. Keys that haven't been used for longest are
+    forgotten when there are more than max_keys, which only makes them start
+    with a full bucket again.
+
+    The buckets are kept in the worker process, so every worker limits on its own.
+    """
+
+    def __init__(self, capacity: int, period: float, max_keys: int = 10000):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key: (tokens, last update time)
+        self._lock = threading.Lock()
+
+    def allow(self, key: str) -> bool:
+        """take a token for key, returns False if there are none left"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed
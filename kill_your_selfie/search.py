@@ -0,0 +1,139 @@
+"""full-text search over the context of occurrences, and fuzzy search over targets and locations
+
+The context is searched through a GIN index on its tsvector (see models.Occurrence).
+Targets and locations are matched by trigram similarity (pg_trgm) on the location
+and daily_count tables, which have a row per location or per day and target rather
+than per occurrence. Without the pg_trgm extension they are matched with ILIKE.
+"""
+import logging
+
+from markupsafe import Markup, escape
+from sqlalchemy import text as sql_txt
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import database
+
+logger = logging.getLogger(__name__)
+
+TEXT_SEARCH_CONFIG = "simple"  # no stemming, the context can be in any language
+MAX_QUERY_LENGTH = 200
+
+# ts_headline marks matches with these, the context is html escaped before replacing them with <mark>
+_HIGHLIGHT_START = "\x02"
+_HIGHLIGHT_STOP = "\x03"
+
+_TRIGRAM_INDEXES = {
+    "ix_location_label_trgm": "location USING gin (label gin_trgm_ops)",
+    "ix_daily_count_target_trgm": "daily_count USING gin (target gin_trgm_ops)",
+}
+
+_has_trigrams = None
+
+
+def create_indexes() -> bool:
+    """create the pg_trgm extension and trigram indexes, returns False if pg_trgm isn't available"""
+    try:
+        database.execute(sql_txt("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        database.commit()
+    except SQLAlchemyError as exc:
+        database.rollback()
+        logger.warning("pg_trgm isn't available, targets and locations are searched without an index: %s", exc)
+        return False
+    for name, definition in _TRIGRAM_INDEXES.items():
+        database.execute(sql_txt(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}"))
+    database.commit()
+    return True
+
+
+def _trigrams_available() -> bool:
+    """whether pg_trgm is installed, checked once per process"""
+    global _has_trigrams  # pylint: disable=W0603
+    if _has_trigrams is None:
+        _has_trigrams = bool(database.get_sql_data("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")[0][0])
+    return _has_trigrams
+
+
+def _highlight(headline: str) -> Markup:
+    """html of a ts_headline with the matches in <mark>"""
+    return Markup(
+        str(escape(headline)).replace(_HIGHLIGHT_START, "<mark>").replace(_HIGHLIGHT_STOP, "</mark>")
+    )
+
+
+def search_occurrences(query: str, limit: int = 20) -> list[dict]:
+    """Occurrences whose context matches query (web search syntax: words, "phrases", or, -word),
+    best matches first, with the matching part of the context highlighted in html
+    """
+    rows = database.get_sql_data(
+        f"""
+        WITH q AS (
+            SELECT websearch_to_tsquery('{TEXT_SEARCH_CONFIG}', :query) AS tsquery
+        ), matches AS (
+            SELECT o.time, o.location_label, o.target, o.context,
+                ts_rank_cd(to_tsvector('{TEXT_SEARCH_CONFIG}', o.context), q.tsquery) AS rank
+            FROM occurrence o, q
+            WHERE to_tsvector('{TEXT_SEARCH_CONFIG}', o.context) @@ q.tsquery
+            ORDER BY rank DESC, o.time DESC
+            LIMIT :limit
+        )
+        -- headlines are expensive, so only for the returned matches
+        SELECT m.time, m.location_label, m.target, m.context, m.rank,
+            ts_headline('{TEXT_SEARCH_CONFIG}', m.context, q.tsquery, :headline_options) AS headline
+        FROM matches m, q
+        ORDER BY m.rank DESC, m.time DESC
+        """,
+        {
+            "query": query,
+            "limit": limit,
+            "headline_options": f'StartSel="{_HIGHLIGHT_START}", StopSel="{_HIGHLIGHT_STOP}"',
+        },
+    )
+    return [
+        {"time": time.isoformat(), "location": location, "target": target, "context": context,
+         "rank": float(rank), "highlight": _highlight(headline)}
+        for time, location, target, context, rank, headline in rows
+    ]
+
+
+def search_values(query: str, limit: int = 5) -> dict[str, list[dict]]:
+    """targets and locations similar to query, most similar first"""
+    if _trigrams_available():
+        match = "{column} % :query"
+        similarity = "similarity({column}, :query)"
+    else:
+        match = "{column} ILIKE :pattern"
+        similarity = "1.0"
+    pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    rows = database.get_sql_data(
+        f"""
+        (
+            SELECT 'target' AS kind, d.target AS value, MAX({similarity.format(column="d.target")}) AS similarity
+            FROM daily_count d
+            WHERE {match.format(column="d.target")}
+            GROUP BY d.target
+            ORDER BY 3 DESC, 2
+            LIMIT :limit
+        ) UNION ALL (
+            SELECT 'location', l.label, {similarity.format(column="l.label")}
+            FROM location l
+            WHERE {match.format(column="l.label")}
+            ORDER BY 3 DESC, 2
+            LIMIT :limit
+        )
+        """,
+        {"query": query, "pattern": pattern, "limit": limit},
+    )
+    values = {"targets": [], "locations": []}
+    for kind, value, value_similarity in rows:
+        values[f"{kind}s"].append({"value": value, "similarity": float(value_similarity)})
+    return values
+
+
+def search(query: str, limit: int = 20) -> dict:
+    """occurrences matching query in their context, and targets and locations similar to it"""
+    query = query.strip()
+    if not query:
+        raise ValueError("The search query is empty")
+    if len(query) > MAX_QUERY_LENGTH:
+        raise ValueError(f"The search query can be at most {MAX_QUERY_LENGTH} characters")
+    return {"occurrences": search_occurrences(query, limit), **search_values(query)}
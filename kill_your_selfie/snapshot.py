@@ -0,0 +1,44 @@
+"""read-only SQLite snapshots of the database, to serve dashboards without the primary database
+
+`flask snapshot PATH` copies every table to a new SQLite file next to PATH, and
+moves it to PATH once it is complete. An app with DB_SNAPSHOT=PATH serves from
+the snapshot read-only, opening it again for every request, so replacing it
+takes effect right away. The data versions of the cache follow the file, so
+the cached statistics and in-memory indexes are rebuilt from a new one. Writes, live updates, search and the occurrence
+history need PostgreSQL and aren't available there.
+"""
+import os
+from pathlib import Path
+
+from sqlalchemy import Column, create_engine, select
+from sqlalchemy.schema import CreateTable
+
+from .database import db
+
+
+def write(path: str, batch_size: int = 5000) -> dict[str, int]:
+    """Copy every table of the current app's database to a SQLite snapshot at path,
+    returns the amount of rows per table
+    """
+    temporary = Path(f"{path}.tmp")
+    temporary.unlink(missing_ok=True)
+    target = create_engine(f"sqlite:///{temporary}")
+    copied = {}
+    source = db.session.connection().execution_options(yield_per=batch_size)
+    try:
+        with target.begin() as connection:
+            for table in db.metadata.sorted_tables:
+                connection.execute(CreateTable(table))
+                for index in table.indexes:
+                    # expression indexes like the full-text search one are PostgreSQL specific
+                    if all(isinstance(expression, Column) for expression in index.expressions):
+                        index.create(connection)
+                copied[table.name] = 0
+                for rows in source.execute(select(table)).partitions():
+                    connection.execute(table.insert(), [dict(row._mapping) for row in rows])
+                    copied[table.name] += len(rows)
+    finally:
+        target.dispose()
+        db.session.rollback()
+    os.replace(temporary, path)
+    return copied
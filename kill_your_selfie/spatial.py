@@ -0,0 +1,218 @@
+"""geohash index of the mapped locations, for the heatmap and finding nearby locations
+
+Every mapped location is encoded as a geohash of MAX_PRECISION characters. The
+first n characters of it are the cell of precision n the location is in, so one
+encoding gives its cell at every precision. The heatmap adds the locations up
+per cell, with the precision depending on the zoom level of the map (see
+ZOOM_PRECISIONS), so labels at (almost) the same place become a single point.
+"""
+import math
+from typing import Callable
+
+from . import cache
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+MAX_PRECISION = 9  # cells of about 5 by 5 m
+# precision of the heatmap cells per zoom level of the map, about the finest with cells
+# wider than the 25 px radius of the heatmap points (at the equator)
+ZOOM_PRECISIONS = (2, 2, 3, 3, 3, 4, 4, 5, 5, 5, 6, 6, 7, 7, 7, 8, 8, 9, 9, 9)
+MAX_ZOOM = len(ZOOM_PRECISIONS) - 1
+EARTH_RADIUS_METERS = 6_371_000
+MAX_NEARBY_METERS = 50_000
+
+
+def encode(latitude: float, longitude: float, precision: int = MAX_PRECISION) -> str:
+    """geohash of the cell of precision characters that contains latitude and longitude"""
+    south, north, west, east = -90.0, 90.0, -180.0, 180.0
+    characters = []
+    value = bits = 0
+    longitude_bit = True  # the bits alternate between longitude and latitude, starting with longitude
+    while len(characters) < precision:
+        if longitude_bit:
+            middle = (west + east) / 2
+            if longitude >= middle:
+                value, west = value << 1 | 1, middle
+            else:
+                value, east = value << 1, middle
+        else:
+            middle = (south + north) / 2
+            if latitude >= middle:
+                value, south = value << 1 | 1, middle
+            else:
+                value, north = value << 1, middle
+        longitude_bit = not longitude_bit
+        bits += 1
+        if bits == 5:
+            characters.append(_BASE32[value])
+            value = bits = 0
+    return "".join(characters)
+
+
+def cell_size(precision: int) -> tuple[float, float]:
+    """(height, width) in degrees of the cells of precision characters"""
+    bits = 5 * precision
+    return 180 / 2 ** (bits // 2), 360 / 2 ** ((bits + 1) // 2)
+
+
+def bounds(geohash: str) -> tuple[float, float, float, float]:
+    """(south, west, north, east) of the cell of a geohash"""
+    south, west = -90.0, -180.0
+    height, width = 180.0, 360.0
+    longitude_bit = True
+    for character in geohash:
+        value = _BASE32.index(character)
+        for shift in range(4, -1, -1):
+            bit = value >> shift & 1
+            if longitude_bit:
+                width /= 2
+                west += bit * width
+            else:
+                height /= 2
+                south += bit * height
+            longitude_bit = not longitude_bit
+    return south, west, south + height, west + width
+
+
+def _normalize_longitude(longitude: float) -> float:
+    return (longitude + 180) % 360 - 180
+
+
+def parse_bbox(bbox: str) -> tuple[float, float, float, float]:
+    """(south, west, north, east) of a "west,south,east,north" bounding box (like Leaflet's
+    LatLngBounds.toBBoxString()), with the longitudes between -180 and 180. Raises ValueError
+    if it isn't one. west is larger than east if the box crosses the antimeridian.
+    """
+    try:
+        west, south, east, north = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise ValueError("bbox must be west,south,east,north in degrees") from None
+    if not all(math.isfinite(value) for value in (west, south, east, north)) or south > north or west > east:
+        raise ValueError("bbox must be west,south,east,north in degrees")
+    if east - west >= 360:
+        return max(south, -90.0), -180.0, min(north, 90.0), 180.0
+    return max(south, -90.0), _normalize_longitude(west), min(north, 90.0), _normalize_longitude(east)
+
+
+def _intersects(cell: tuple[float, float, float, float], bbox: tuple[float, float, float, float]) -> bool:
+    """whether a cell and a bounding box (see parse_bbox) overlap"""
+    south, west, north, east = cell
+    if south > bbox[2] or north < bbox[0]:
+        return False
+    if bbox[1] <= bbox[3]:
+        return west <= bbox[3] and east >= bbox[1]
+    return west <= bbox[3] or east >= bbox[1]  # crossing the antimeridian
+
+
+def distance(latitude: float, longitude: float, other_latitude: float, other_longitude: float) -> float:
+    """great-circle distance in meters between two coordinates"""
+    latitude, longitude, other_latitude, other_longitude = map(
+        math.radians, (latitude, longitude, other_latitude, other_longitude))
+    haversine = (math.sin((other_latitude - latitude) / 2) ** 2
+                 + math.cos(latitude) * math.cos(other_latitude) * math.sin((other_longitude - longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(haversine)))
+
+
+def _covering_cells(south: float, west: float, north: float, east: float, precision: int) -> set[str]:
+    """geohashes of the cells of precision characters covering a bounding box (west < east)"""
+    height, width = cell_size(precision)
+    cells = set()
+    latitude = max(-90.0, south)
+    while True:
+        longitude = west
+        while True:
+            cells.add(encode(latitude, _normalize_longitude(longitude), precision))
+            if longitude >= east:
+                break
+            longitude = min(east, longitude + width)
+        if latitude >= min(90.0, north):
+            break
+        latitude = min(90.0, north, latitude + height)
+    return cells
+
+
+class LocationIndex(cache.VersionedIndex):
+    """In-memory geohash index of the mapped locations and their amounts of occurrences"""
+
+    def __init__(self, load: Callable[[], list[tuple[str, float, float, int]]]):
+        """:param load: function returning (label, latitude, longitude, amount of occurrences) of every mapped location"""
+        super().__init__(load)
+        self._locations = {}  # label: (latitude, longitude, geohash)
+        self._amounts = {}
+        # per precision, {geohash: [amount, sum of amount * latitude, sum of amount * longitude, labels]}
+        self._cells = [{} for _ in range(MAX_PRECISION + 1)]
+
+    def _build(self, rows: list[tuple[str, float, float, int]]) -> dict:
+        locations, amounts = {}, {}
+        cells = [{} for _ in range(MAX_PRECISION + 1)]
+        for label, latitude, longitude, amount in rows:
+            geohash = encode(latitude, longitude)
+            locations[label] = (latitude, longitude, geohash)
+            amounts[label] = amount
+            for precision in range(1, MAX_PRECISION + 1):
+                cell = cells[precision].setdefault(geohash[:precision], [0, 0.0, 0.0, []])
+                cell[0] += amount
+                cell[1] += amount * latitude
+                cell[2] += amount * longitude
+                cell[3].append(label)
+        return {"_locations": locations, "_amounts": amounts, "_cells": cells}
+
+    def add(self, label: str) -> None:
+        """register an occurrence at the location label, call this after bumping the data version for the write"""
+
+        def update():
+            if label in self._locations:
+                latitude, longitude, geohash = self._locations[label]
+                self._amounts[label] += 1
+                for precision in range(1, MAX_PRECISION + 1):
+                    cell = self._cells[precision][geohash[:precision]]
+                    cell[0] += 1
+                    cell[1] += latitude
+                    cell[2] += longitude
+
+        self._apply_write(update)
+
+    def cells(self, zoom: int, bbox: tuple[float, float, float, float] = None) -> list[tuple[float, float, int]]:
+        """Heatmap points of the cells for a zoom level (see ZOOM_PRECISIONS) that overlap bbox
+        (see parse_bbox), or all of them: (latitude, longitude, amount of occurrences), at the
+        average position of the occurrences in the cell
+        """
+        if not 0 <= zoom <= MAX_ZOOM:
+            raise ValueError(f"zoom must be between 0 and {MAX_ZOOM}")
+        self._ensure_loaded()
+        with self._lock:
+            return [
+                (round(latitude_sum / amount, 6), round(longitude_sum / amount, 6), amount)
+                for geohash, (amount, latitude_sum, longitude_sum, _) in self._cells[ZOOM_PRECISIONS[zoom]].items()
+                if amount and (bbox is None or _intersects(bounds(geohash), bbox))
+            ]
+
+    def nearby(self, latitude: float, longitude: float, radius: float, limit: int = 10) -> list[dict]:
+        """Mapped locations within radius meters of latitude and longitude, nearest first
+
+        :return: [{"label": label, "latitude": ..., "longitude": ..., "distance": meters, "amount": occurrences}]
+        """
+        if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            raise ValueError("latitude must be between -90 and 90 and longitude between -180 and 180")
+        if not 0 < radius <= MAX_NEARBY_METERS:
+            raise ValueError(f"radius must be between 0 and {MAX_NEARBY_METERS} meters")
+        self._ensure_loaded()
+        # the finest cells that are at least as high as the radius, the box around the circle is then a few cells
+        degrees = math.degrees(radius / EARTH_RADIUS_METERS)
+        precision = max([1] + [precision for precision in range(1, MAX_PRECISION + 1)
+                               if cell_size(precision)[0] >= degrees])
+        longitude_degrees = degrees / max(math.cos(math.radians(min(89.0, abs(latitude) + degrees))), 1e-6)
+        if longitude_degrees >= 180:
+            west, east = -180.0, 180.0
+        else:
+            west, east = longitude - longitude_degrees, longitude + longitude_degrees
+        with self._lock:
+            found = []
+            for geohash in _covering_cells(latitude - degrees, west, latitude + degrees, east, precision):
+                for label in self._cells[precision].get(geohash, (0, 0, 0, ()))[3]:
+                    other_latitude, other_longitude, _ = self._locations[label]
+                    meters = distance(latitude, longitude, other_latitude, other_longitude)
+                    if meters <= radius:
+                        found.append({"label": label, "latitude": other_latitude, "longitude": other_longitude,
+                                      "distance": round(meters, 1), "amount": self._amounts[label]})
+        found.sort(key=lambda location: (location["distance"], location["label"]))
+        return found[:limit]
@@ -39,10 +39,10 @@ function createSimpleBarGraph(canvas, name, data) {
       }
     }
   };
-  new Chart(canvas, config)
+  return new Chart(canvas, config)
 }
 
-lastWeekData=document.getElementById("bargraph-weekly").getAttribute("data-chart")
-lastWeekData=JSON.parse(lastWeekData);
-
-createSimpleBarGraph(document.getElementById('bargraph-weekly'), 'Occurrences In The Last 7 Days', lastWeekData);
+const weeklyCanvas = document.getElementById('bargraph-weekly');
+loadPanel(weeklyCanvas).then(timeseries => {
+  dashboardCharts.week = createSimpleBarGraph(weeklyCanvas, 'Occurrences In The Last 7 Days', timeseriesPairs(timeseries, weeklyCanvas.getAttribute("data-label")));
+});
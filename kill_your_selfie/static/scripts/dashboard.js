@@ -0,0 +1,22 @@
+const dashboardData = JSON.parse(document.getElementById('dashboard-data').textContent) || {};
+// charts (and the heatmap layer) of the panels, to update them when the data changes
+const dashboardCharts = {};
+
+function loadPanel(element) {
+// Loads the data of the dashboard panel in the data-panel attribute of the element from
+// the data embedded in the page, or from the url in its data-src attribute if it is missing
+
+    const panel = element.getAttribute('data-panel');
+    if (dashboardData[panel]) {
+        return Promise.resolve(dashboardData[panel]);
+    }
+    return reloadPanel(element);
+}
+
+function reloadPanel(element) {
+// Loads the data of the dashboard panel from the url in the data-src attribute of the element
+
+    return fetch(element.getAttribute('data-src'))
+        .then(response => response.json())
+        .then(data => dashboardData[element.getAttribute('data-panel')] = data);
+}
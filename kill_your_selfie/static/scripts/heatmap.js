@@ -0,0 +1,85 @@
+// characters of geohashes, see spatial.encode
+const GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz';
+
+function geohash(latitude, longitude, precision) {
+// Geohash of the cell of precision characters that contains latitude and longitude, like spatial.encode
+
+    let south = -90, north = 90, west = -180, east = 180;
+    let hash = '', value = 0, bits = 0;
+    // the bits alternate between longitude and latitude, starting with longitude
+    let longitudeBit = true;
+    while (hash.length < precision) {
+        if (longitudeBit) {
+            const middle = (west + east) / 2;
+            if (longitude >= middle) {
+                value = value * 2 + 1;
+                west = middle;
+            } else {
+                value = value * 2;
+                east = middle;
+            }
+        } else {
+            const middle = (south + north) / 2;
+            if (latitude >= middle) {
+                value = value * 2 + 1;
+                south = middle;
+            } else {
+                value = value * 2;
+                north = middle;
+            }
+        }
+        longitudeBit = !longitudeBit;
+        bits += 1;
+        if (bits === 5) {
+            hash += GEOHASH_BASE32[value];
+            value = bits = 0;
+        }
+    }
+    return hash;
+}
+
+function heatmapPrecision(element) {
+// Geohash precision of the heatmap cells at the zoom level of the map in the element, see spatial.ZOOM_PRECISIONS
+
+    const precisions = element.getAttribute('data-precisions').split(',').map(Number);
+    return precisions[Math.min(Number(element.getAttribute('data-zoom')), precisions.length - 1)];
+}
+
+
+function drawHeatmapPoints(points) {
+    const layer = dashboardCharts.heatmap;
+    if (layer) {
+        layer.setOptions({max: Math.max(1, ...points.map(point => point[2]))});
+        layer.setLatLngs(points);
+    }
+}
+
+function createHeatmap(element) {
+// Creates a heatmap in the element, loading points in the form of
+// [[latitude, longitude, amount], ...] with loadPanel. When the map is moved or
+// zoomed, it loads the points of the cells in view at the new zoom level instead
+
+    const map = createMap(element.id, [51.05, 3.43], Number(element.getAttribute('data-zoom')));
+    const src = new URL(element.getAttribute('data-src'), window.location.href);
+
+    loadPanel(element)
+        .then(points => {
+            const max = Math.max(1, ...points.map(point => point[2]));
+            dashboardCharts.heatmap = L.heatLayer(points, {radius: 25, blur: 15, max: max}).addTo(map);
+            map.on('moveend', () => {
+                element.setAttribute('data-zoom', map.getZoom());
+                src.searchParams.set('zoom', map.getZoom());
+                src.searchParams.set('bbox', map.getBounds().toBBoxString());
+                const url = src.pathname + src.search;
+                // live updates reload the panel from data-src too, so they keep to the view
+                element.setAttribute('data-src', url);
+                reloadPanel(element).then(points => {
+                    if (element.getAttribute('data-src') === url) {
+                        drawHeatmapPoints(points);
+                    }
+                });
+            });
+        });
+}
+
+createHeatmap(document.getElementById("heatmap"));
@@ -39,12 +39,70 @@ function createSimpleLineGraph(canvas, name, data) {
           }
         }
       };
-      new Chart(canvas, config)
+      return new Chart(canvas, config)
     }
 
+function createMultiLineGraph(canvas, timeseries) {
+    // Creates a line graph on the canvas with a line for every series of a time series
 
-    lastMonthData=JSON.parse(document.getElementById("linegraph-monthly").getAttribute("data-chart"));
-    lastYearData=JSON.parse(document.getElementById("linegraph-yearly").getAttribute("data-chart"));
+      const config = {
+        type: 'line',
+        data: {
+          labels: timeseries.labels.map(label => timeseriesLabel(label, timeseries.bucket === 'hour' ? 'hour' : 'date')),
+          datasets: Object.entries(timeseries.series).map(([name, values]) => ({
+            label: name,
+            data: values,
+            fill: false,
+            cubicInterpolationMode: 'monotone',
+            tension: 0.4
+          }))
+        },
+        options: {
+          responsive: true,
+          plugins: {
+            legend: {
+                display: Object.keys(timeseries.series).length > 1,
+            }
+          }
+        }
+      };
+      return new Chart(canvas, config)
+    }
+
+
+    for (const [id, name] of [['linegraph-monthly', 'Occurrences This Day'], ['linegraph-yearly', 'Occurrences This Month']]) {
+      const canvas = document.getElementById(id);
+      loadPanel(canvas).then(timeseries => {
+        dashboardCharts[canvas.getAttribute('data-panel')] = createSimpleLineGraph(canvas, name, timeseriesPairs(timeseries, canvas.getAttribute("data-label")));
+      });
+    }
+
+    // Explore arbitrary ranges
+    const explorer = document.getElementById('timeseries-explorer');
+    const explorerCanvas = document.getElementById('linegraph-explorer');
+    let explorerChart;
+
+    function updateExplorer() {
+      if (!explorer.checkValidity()) {
+        return;
+      }
+      const url = new URL(explorer.getAttribute('data-src'), window.location.origin);
+      for (const [key, value] of new FormData(explorer)) {
+        url.searchParams.set(key, value);
+      }
+      fetch(url)
+        .then(response => response.ok ? response.json() : Promise.reject(response))
+        .then(timeseries => {
+          if (explorerChart) {
+            explorerChart.destroy();
+          }
+          explorerChart = createMultiLineGraph(explorerCanvas, timeseries);
+        })
+        .catch(() => explorer.classList.add('was-validated'));
+    }
 
-    createSimpleLineGraph(document.getElementById('linegraph-monthly'), 'Occurrences This Day', lastMonthData);
-    createSimpleLineGraph(document.getElementById('linegraph-yearly'), 'Occurrences This Month', lastYearData);
+    const today = new Date();
+    explorer.elements['to'].value = today.toISOString().slice(0, 10);
+    explorer.elements['from'].value = new Date(today.getTime() - 90 * 24 * 3600 * 1000).toISOString().slice(0, 10);
+    explorer.addEventListener('change', updateExplorer);
+    updateExplorer();
@@ -0,0 +1,85 @@
+// Applies the changes sent by /api/stream to the dashboard panels in place
+
+// length of the start of ISO 8601 times that is the same for all times in a bucket
+const bucketPrefixLengths = {hour: 13, day: 10, month: 7};
+
+function addToTimeseriesPanel(panel, time) {
+// Adds an occurrence at the ISO 8601 time to a time series panel, if it is in the shown range
+
+    const chart = dashboardCharts[panel];
+    const timeseries = dashboardData[panel];
+    if (!chart || !timeseries || !(timeseries.bucket in bucketPrefixLengths)) {
+        return;
+    }
+    const length = bucketPrefixLengths[timeseries.bucket];
+    const index = timeseries.labels.findIndex(label => label.slice(0, length) === time.slice(0, length));
+    if (index === -1) {
+        return;
+    }
+    timeseries.series.total[index] += 1;
+    chart.data.datasets[0].data[index] += 1;
+    chart.update();
+}
+
+function addToHeatmap(latitude, longitude) {
+// Adds an occurrence at a mapped location to the heatmap: to the point of the geohash cell it
+// is in at the current zoom level, which is at the average position of the occurrences in it
+
+    const element = document.getElementById('heatmap');
+    const points = dashboardData.heatmap;
+    if (!points || latitude === null || longitude === null) {
+        return;
+    }
+    const precision = heatmapPrecision(element);
+    const cell = geohash(latitude, longitude, precision);
+    const point = points.find(point => geohash(point[0], point[1], precision) === cell);
+    if (point) {
+        point[0] = (point[0] * point[2] + latitude) / (point[2] + 1);
+        point[1] = (point[1] * point[2] + longitude) / (point[2] + 1);
+        point[2] += 1;
+    } else {
+        points.push([latitude, longitude, 1]);
+    }
+    drawHeatmapPoints(points);
+}
+
+function redrawPanel(element) {
+// Reloads a panel from its API url and redraws it
+
+    const panel = element.getAttribute('data-panel');
+    reloadPanel(element).then(data => {
+        if (panel === 'heatmap') {
+            drawHeatmapPoints(data);
+        } else if (dashboardCharts[panel]) {
+            const pairs = timeseriesPairs(data, element.getAttribute('data-label'));
+            dashboardCharts[panel].data.labels = pairs.map(pair => pair[0]);
+            dashboardCharts[panel].data.datasets[0].data = pairs.map(pair => pair[1]);
+            dashboardCharts[panel].update();
+        }
+    });
+}
+
+function redrawPanels() {
+    document.querySelectorAll('[data-panel]').forEach(redrawPanel);
+}
+
+const stream = new EventSource(document.getElementById('dashboard-data').getAttribute('data-stream'));
+let streamInterrupted = false;
+
+stream.addEventListener('occurrence', event => {
+    const occurrence = JSON.parse(event.data);
+    for (const panel of ['week', 'month', 'year']) {
+        addToTimeseriesPanel(panel, occurrence.time);
+    }
+    addToHeatmap(occurrence.latitude, occurrence.longitude);
+});
+stream.addEventListener('location', () => redrawPanel(document.getElementById('heatmap')));
+stream.addEventListener('refresh', redrawPanels);
+stream.addEventListener('error', () => streamInterrupted = true);
+stream.addEventListener('open', () => {
+    // changes made while reconnecting were missed
+    if (streamInterrupted) {
+        streamInterrupted = false;
+        redrawPanels();
+    }
+});
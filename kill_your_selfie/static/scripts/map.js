@@ -0,0 +1,12 @@
+function createMap(elementId, center, zoom) {
+// Creates a leaflet map with OpenStreetMap tiles in the element with the given id
+
+    const map = L.map(elementId).setView(center, zoom);
+
+    L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
+        maxZoom: 19,
+        attribution: '© OpenStreetMap contributors'
+    }).addTo(map);
+
+    return map
+}
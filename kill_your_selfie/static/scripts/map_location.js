@@ -1,11 +1,5 @@
 // Initialize the map
-const map = L.map('map').setView([51.05, 3.73], 10);
-
-// Add OpenStreetMap tiles
-L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
-    maxZoom: 19,
-    attribution: '© OpenStreetMap contributors'
-}).addTo(map);
+const map = createMap('map', [51.05, 3.73], 10);
 
 // Marker variable (to add or move the marker dynamically)
 let marker;
@@ -16,6 +10,10 @@ latInput.addEventListener("change", coordChange)
 const lngInput = document.getElementById('lng');
 lngInput.addEventListener("change", coordChange)
 
+// Locations that are already mapped near the marker, they might be the same place
+const nearbyElement = document.getElementById('nearby');
+const nearbyLayer = L.layerGroup().addTo(map);
+
 // Add click event to the map
 map.on('click', function (e) {
     const { lat, lng } = e.latlng;
@@ -30,12 +28,36 @@ map.on('click', function (e) {
     } else {
         marker = L.marker([lat, lng]).addTo(map); // Add new marker
     }
+    showNearby(lat, lng);
 });
 
 function coordChange() {
+    if (latInput.value === '' || lngInput.value === '') {
+        return;
+    }
     if (marker) {
         marker.setLatLng([latInput.value, lngInput.value]) // Move existing marker
     } else {
-        marker = L.marker([lat, lng]).addTo(map); // Add new marker
+        marker = L.marker([latInput.value, lngInput.value]).addTo(map); // Add new marker
     }
+    showNearby(latInput.value, lngInput.value);
+}
+
+function showNearby(lat, lng) {
+// Lists and marks the mapped locations within the radius of the nearby element around lat and lng
+
+    const radius = nearbyElement.getAttribute('data-radius');
+    const params = new URLSearchParams({latitude: lat, longitude: lng, radius: radius});
+    fetch(`${nearbyElement.getAttribute('data-src')}?${params}`)
+        .then(response => response.ok ? response.json() : [])
+        .then(locations => {
+            nearbyLayer.clearLayers();
+            for (const location of locations) {
+                L.circleMarker([location.latitude, location.longitude], {radius: 6})
+                    .bindTooltip(location.label)
+                    .addTo(nearbyLayer);
+            }
+            nearbyElement.textContent = locations.length === 0 ? '' : `Already mapped within ${radius} m: `
+                + locations.map(location => `${location.label} (${Math.round(location.distance)} m)`).join(', ');
+        });
 }
\ No newline at end of file
@@ -0,0 +1,27 @@
+// Fills the datalist of inputs with a data-options-src attribute with
+// previously used values matching what has been typed so far
+(() => {
+    'use strict'
+
+    document.querySelectorAll('input[data-options-src]').forEach(input => {
+      const datalist = document.getElementById(input.getAttribute('list'))
+      let timeout
+
+      input.addEventListener('input', () => {
+        clearTimeout(timeout)
+        timeout = setTimeout(() => {
+          const url = new URL(input.getAttribute('data-options-src'), window.location.origin)
+          url.searchParams.set('prefix', input.value)
+          fetch(url)
+            .then(response => response.json())
+            .then(options => {
+              datalist.replaceChildren(...options.map(option => {
+                const element = document.createElement('option')
+                element.value = option
+                return element
+              }))
+            })
+        }, 150)
+      })
+    })
+  })()
@@ -0,0 +1,25 @@
+
+function timeseriesLabel(bucketStart, format) {
+// Formats the ISO 8601 start of a time series bucket as a label for a graph
+
+    const date = new Date(bucketStart);
+    switch (format) {
+        case 'weekday':
+            return date.toLocaleDateString('en-US', {weekday: 'long'});
+        case 'day':
+            return date.getDate();
+        case 'month':
+            return date.toLocaleDateString('en-US', {month: 'long'});
+        case 'hour':
+            return date.toLocaleString('en-GB', {dateStyle: 'short', timeStyle: 'short'});
+        default:
+            return date.toLocaleDateString('en-GB');
+    }
+}
+
+function timeseriesPairs(timeseries, format) {
+// Converts the total of a time series to the form of
+// [[label, value], [label, value], ...]
+
+    return timeseries.labels.map((label, i) => [timeseriesLabel(label, format), timeseries.series.total[i]]);
+}
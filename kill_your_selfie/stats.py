@@ -1,126 +1,309 @@
-"""functions to get statistics"""
-from datetime import datetime, timedelta
+"""functions to get statistics
 
-import folium
-import folium.plugins
+They are computed in SQL, with queries built with SQLAlchemy Core that give the same
+results on PostgreSQL and SQLite (see database.date_trunc and snapshot), or with
+STATS_ENGINE=columnar on the in-memory columnar store of the worker (see columnar).
+The hour and weekday, streak and rolling average statistics always use the columnar store.
+"""
+from datetime import date, datetime, time, timedelta
 
-from . import database
+from sqlalchemy import Date, Integer, String, Select, column, func, literal_column, null, select, table, union_all
 
+from . import database, cache, aggregates, columnar, models, spatial
 
-def weekly_bar_data() -> list:
-    """Data for weekly bar graph"""
-    data = []
-    occurrences_per_day = database.get_sql_data(
-        """SELECT
-            DATE_TRUNC('day', time)::date AS day,
-            COUNT(time) AS amount
-        FROM occurrence
-        GROUP BY DATE_TRUNC('day', time)
-        ORDER BY DATE_TRUNC('day', time) ASC
-        """
-    )
-    # filter selection on days from last 7 days
-    for day in occurrences_per_day:
-        if (datetime.now() - timedelta(days=7)).date() <= day[0] <= datetime.now().date():
-            # add tuple consisting of name of weekday and amount of uses on that day
-            data.append((day[0].strftime("%A"), day[1]))
-
-    # add the weekdays without entries to the data
-    weekdays = [
-        "Sunday",
-        "Monday",
-        "Tuesday",
-        "Wednesday",
-        "Thursday",
-        "Friday",
-        "Saturday",
-    ]
-    # get the index of the first weekday of our selection
-    first_day = int((datetime.now() - timedelta(days=7)).strftime("%w")) + 1
-    # shift the array to start with the first weekday we want
-    weekdays = weekdays[first_day:] + weekdays[:first_day]
-
-    i = 0
-    while i < len(weekdays):  # add empty weekdays that don't appear in the database
-        if i >= len(data):
-            data.append((weekdays[i], 0))
-        elif weekdays[i] != data[i][0]:
-            data.insert(i, (weekdays[i], 0))
-        i += 1
+BUCKETS = ("hour", "day", "week", "month")
+GROUPS = ("target", "location")
+MAX_BUCKETS = 5000
 
-    return data
+# materialized views, see aggregates
+_monthly_count = table("monthly_count", column("month", Date), column("location_label", String),
+                       column("target", String), column("amount", Integer))
+_location_count = table("location_count", column("location_label", String), column("amount", Integer))
 
 
-def line_data(time_range) -> list:
-    data = []
+def _use_views() -> bool:
+    """whether the materialized views (only on PostgreSQL) are fresh enough to read"""
+    return database.dialect() == "postgresql" and aggregates.fresh()
+
+
+def _bucket_count(start: datetime, end: datetime, bucket: str) -> int:
+    """(over)estimate of the amount of buckets between start and end"""
+    days = (end - start).total_seconds() / 86400
+    match bucket:
+        case "hour":
+            return int(days * 24) + 2
+        case "day":
+            return int(days) + 2
+        case "week":
+            return int(days / 7) + 2
+        case "month":
+            return int(days / 28) + 2
+
+
+def _truncate(moment: datetime, bucket: str) -> datetime:
+    """start of the hour, day, week (starting on monday) or month of moment, like database.date_trunc"""
+    match bucket:
+        case "hour":
+            return moment.replace(minute=0, second=0, microsecond=0)
+        case "day":
+            return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        case "week":
+            return _truncate(moment, "day") - timedelta(days=moment.weekday())
+        case "month":
+            return _truncate(moment, "day").replace(day=1)
+
+
+def _next_bucket(bucket_start: datetime, bucket: str) -> datetime:
+    match bucket:
+        case "hour":
+            return bucket_start + timedelta(hours=1)
+        case "day":
+            return bucket_start + timedelta(days=1)
+        case "week":
+            return bucket_start + timedelta(weeks=1)
+        case "month":
+            return bucket_start.replace(year=bucket_start.year + bucket_start.month // 12,
+                                        month=bucket_start.month % 12 + 1)
+
+
+def _bucket_starts(start: datetime, end: datetime, bucket: str) -> list[datetime]:
+    """start of every bucket from the one containing start up to the one containing end"""
+    starts = [_truncate(start, bucket)]
+    last = _truncate(end, bucket)
+    while starts[-1] < last:
+        starts.append(_next_bucket(starts[-1], bucket))
+    return starts
+
+
+@cache.cached()
+@database.replica_reads
+def timeseries(start: datetime, end: datetime, bucket: str = "day", group_by: str = None) -> dict:
+    """Amount of occurrences per hour, day, week or month between start and end (both inclusive),
+    optionally per target or location. Buckets without occurrences are filled with zeros.
+
+    :return: {"bucket": bucket, "labels": [ISO 8601 start of every bucket],
+        "series": {"total" or target/location name: [amount per bucket]}}
+    """
+    if bucket not in BUCKETS:
+        raise ValueError(f"bucket must be one of {', '.join(BUCKETS)}")
+    if group_by is not None and group_by not in GROUPS:
+        raise ValueError(f"group_by must be one of {', '.join(GROUPS)}")
+    if end < start:
+        raise ValueError("end must not be before start")
+    if _bucket_count(start, end, bucket) > MAX_BUCKETS:
+        raise ValueError(f"a time series can have at most {MAX_BUCKETS} buckets")
+
+    if columnar.enabled():
+        return columnar.columns().timeseries(start, end, bucket, group_by)
+    bucket_starts = _bucket_starts(start, end, bucket)
+    rows = database.execute(_timeseries_query(bucket_starts, bucket, group_by, bucket == "month" and _use_views())).all()
+    return _timeseries_result(rows, bucket_starts, bucket, group_by)
+
+
+def _timeseries_source(lower: datetime, upper: datetime, bucket: str, use_views: bool = False) -> Select:
+    """(time, location, target, amount) of the occurrences (or amounts of them) from lower until upper.
+    The hourly series needs the occurrence table itself, the others can use the daily rollup,
+    and the monthly series the monthly view while it is fresh enough.
+    """
+    if bucket == "hour":
+        occurrence = models.Occurrence.__table__
+        return select(
+            occurrence.c.time.label("time"), occurrence.c.location_label.label("location"),
+            occurrence.c.target.label("target"), literal_column("1", Integer).label("amount"),
+        ).where(occurrence.c.time >= lower, occurrence.c.time < upper)
+    source, day = (_monthly_count, _monthly_count.c.month) if bucket == "month" and use_views \
+        else (models.DailyCount.__table__, models.DailyCount.__table__.c.day)
+    return select(
+        day.label("time"), source.c.location_label.label("location"), source.c.target.label("target"),
+        source.c.amount.label("amount"),
+    ).where(day >= lower.date(), day < upper.date())
+
+
+def _timeseries_query(bucket_starts: list[datetime], bucket: str, group_by: str = None,
+                      use_views: bool = False) -> Select:
+    """query for the amounts per bucket (and name) of a timeseries, returning (bucket start, name, amount) rows"""
+    source = _timeseries_source(bucket_starts[0], _next_bucket(bucket_starts[-1], bucket), bucket, use_views).subquery()
+    bucket_start = database.date_trunc(bucket, source.c.time)
+    amount = func.sum(source.c.amount).label("amount")
+    if group_by is None:
+        return select(bucket_start.label("bucket"), null().label("name"), amount).group_by(bucket_start)
+    name = func.coalesce(source.c[group_by], "")
+    return select(bucket_start.label("bucket"), name.label("name"), amount).group_by(bucket_start, name)
+
+
+def _timeseries_result(rows, bucket_starts: list[datetime], bucket: str, group_by: str = None) -> dict:
+    """convert the (bucket start, name, amount) rows of a timeseries query to its result"""
+    index = {bucket_start: number for number, bucket_start in enumerate(bucket_starts)}
+    series = {"total": [0] * len(bucket_starts)} if group_by is None else {}
+    for bucket_start, name, amount in rows:
+        values = series.setdefault("total" if group_by is None else name, [0] * len(bucket_starts))
+        values[index[bucket_start]] += int(amount)
+    return {
+        "bucket": bucket,
+        "labels": [bucket_start.isoformat() for bucket_start in bucket_starts],
+        "series": {name: series[name] for name in sorted(series)},
+    }
+
+
+def _location_map_query(use_views: bool = False) -> Select:
+    """(label, latitude, longitude, amount of occurrences) of the locations with occurrences"""
+    location = models.Location.__table__
+    if use_views:
+        return select(location.c.label, location.c.latitude, location.c.longitude, _location_count.c.amount) \
+            .join(_location_count, _location_count.c.location_label == location.c.label)
+    daily_count = models.DailyCount.__table__
+    return select(location.c.label, location.c.latitude, location.c.longitude, func.sum(daily_count.c.amount).label("amount")) \
+        .join(daily_count, daily_count.c.location_label == location.c.label) \
+        .group_by(location.c.label, location.c.latitude, location.c.longitude)
+
+
+def time_window(time_range: str) -> tuple[datetime, datetime, str]:
+    """start, end and bucket of the time series shown on the dashboard for
+    the last week, month or year
+    """
+    today = datetime.combine(date.today(), time())
     match time_range:
+        case 'week':
+            return today - timedelta(days=6), today, "day"
         case 'month':
-            # Get Occurrences per day for the last month
-            occurrences_per_day = database.get_sql_data(
-                """
-                SELECT
-                    EXTRACT('day' FROM DATE_TRUNC('day', o.time)) AS day,
-                    COUNT(o.time) AS amount
-                FROM occurrence o
-                WHERE o.time BETWEEN DATE_TRUNC('day', now()- interval '2 months') AND DATE_TRUNC('day', now()- interval '1 month' + interval '1 day')
-                GROUP BY DATE_TRUNC('day', o.time)
-                ORDER BY DATE_TRUNC('day', o.time) ASC
-                """
-            )
-            for day in occurrences_per_day:
-                data.append((day[0], day[1]))
+            return today - timedelta(days=30), today, "day"
         case 'year':
-            # Get Occurrrences per month for the last year
-            occurrences_per_month = database.get_sql_data(
-                """
-                SELECT TO_CHAR(DATE_TRUNC('month', o.time), 'Year') AS year,
-                    to_char(DATE_TRUNC('month', o.time), 'Month') AS month,
-                    COUNT(o.time) AS amount
-                FROM occurrence o
-                WHERE o.time >= DATE_TRUNC('month', now() - interval '1 years')
-                GROUP BY DATE_TRUNC('month', o.time)
-                ORDER BY DATE_TRUNC('month', o.time) ASC
-                """
-            )
-            last_date = None
-            for year, month, amount in occurrences_per_month:
-                month_index = int(datetime.strptime(month.strip(), '%B').month) - 1
-
-                if last_date and month_index != (last_date[1] + 1) % 12:
-                    if year > last_date[0]:
-                        month_index += 12
-
-                    for i in range(last_date[1] + 1, month_index):
-                        data.append((datetime.strftime(datetime(1900, i % 12 + 1, 1), '%B'), 0))
-
-                last_date = (year, month_index)
-                data.append((month, amount))
+            return today.replace(year=today.year - 1, day=1), today, "month"
+        case _:
+            raise ValueError(f"Unknown time range: {time_range}")
 
-    return data
+
+@cache.cached()
+@database.replica_reads
+def weekly_bar_data() -> list:
+    """Data for weekly bar graph: (name of weekday, amount) for the last 7 days"""
+    series = timeseries(*time_window('week'))
+    return [
+        (datetime.fromisoformat(bucket_start).strftime("%A"), amount)
+        for bucket_start, amount in zip(series["labels"], series["series"]["total"])
+    ]
+
+
+@cache.cached()
+@database.replica_reads
+def line_data(time_range) -> list:
+    """Data for line graphs: (day of month, amount) for every day of the last month,
+    or (name of month, amount) for every month of the last year
+    """
+    series = timeseries(*time_window(time_range))
+    if time_range == 'month':
+        label = lambda bucket_start: bucket_start.day  # pylint: disable=C3001
+    else:
+        label = lambda bucket_start: bucket_start.strftime("%B")  # pylint: disable=C3001
+    return [
+        (label(datetime.fromisoformat(bucket_start)), amount)
+        for bucket_start, amount in zip(series["labels"], series["series"]["total"])
+    ]
 
 
-def location_map_data() -> str:
-    """Data for location map"""
-    data = []
-    occurrences_per_location = database.get_sql_data(
-        """
-        SELECT
-            l.label,
-            l.latitude,
-            l.longitude,
-            COUNT(o.time) as amount
-        FROM "location" l
-        JOIN "occurrence" o ON
-            o.location_label = l.label
-        GROUP BY l.label, l.latitude, l.longitude
-        """
+@cache.cached()
+@database.replica_reads
+def location_map_data() -> list:
+    """Data for location heatmap: list of (latitude, longitude, amount)"""
+    return [(latitude, longitude, amount) for _, latitude, longitude, amount in mapped_locations() if amount]
+
+
+@cache.cached()
+@database.replica_reads
+def mapped_locations() -> list:
+    """(label, latitude, longitude, amount of occurrences) of every location with coordinates"""
+    location = models.Location.__table__
+    if columnar.enabled():
+        totals = columnar.columns().location_totals()
+    else:
+        totals = {label: int(amount) for label, _, _, amount in database.execute(_location_map_query(_use_views()))}
+    locations = database.execute(
+        select(location.c.label, location.c.latitude, location.c.longitude)
+        .where(location.c.latitude.isnot(None), location.c.longitude.isnot(None))
     )
-    for location in occurrences_per_location:
-        if location[1] is not None and location[2] is not None:  # Coordinates are in database
-            # Add Latitude, Longitude and Amount
-            data.append((location[1], location[2], location[3]))
-
-    location_map = folium.Map([51.05, 3.43], zoom_start=9)
-    folium.plugins.HeatMap(data).add_to(location_map)
-    # noinspection PyProtectedMember
-    return location_map.get_root()._repr_html_()  # TODO: use different function because _repr_html_ is protected
+    return [(label, latitude, longitude, totals.get(label, 0)) for label, latitude, longitude in locations]
+
+
+# geohash index of mapped_locations, for the heatmap cells and nearby locations
+location_index = spatial.LocationIndex(mapped_locations)
+
+DASHBOARD_PANELS = ("week", "month", "year", "heatmap")
+# initial zoom level of the heatmap on the dashboard (see scripts/heatmap.js)
+DASHBOARD_HEATMAP_ZOOM = 9
+
+
+@database.replica_reads
+def dashboard_panel(panel: str):
+    """data of one dashboard panel: the timeseries of the last week, month or year, or the heatmap cells"""
+    if panel == "heatmap":
+        return location_index.cells(DASHBOARD_HEATMAP_ZOOM)
+    return timeseries(*time_window(panel))
+
+
+@cache.cached()
+@database.replica_reads
+def dashboard_panels() -> dict:
+    """data of all dashboard panels (see dashboard_panel), the time series fetched in a single statement"""
+    if columnar.enabled():
+        return {panel: dashboard_panel(panel) for panel in DASHBOARD_PANELS}
+    use_views = _use_views()
+    parts = []
+    bucket_starts = {}
+    for panel in DASHBOARD_PANELS[:-1]:
+        start, end, bucket = time_window(panel)
+        bucket_starts[panel] = _bucket_starts(start, end, bucket)
+        counts = _timeseries_query(bucket_starts[panel], bucket, use_views=use_views).subquery()
+        parts.append(select(
+            literal_column(f"'{panel}'").label("panel"), counts.c.bucket, counts.c.amount,
+        ))
+    rows = database.execute(union_all(*parts)).all()
+
+    panel_rows = {panel: [] for panel in DASHBOARD_PANELS[:-1]}
+    for panel, bucket_start, amount in rows:
+        panel_rows[panel].append((bucket_start, None, amount))
+    data = {
+        panel: _timeseries_result(panel_rows[panel], bucket_starts[panel], time_window(panel)[2])
+        for panel in DASHBOARD_PANELS[:-1]
+    }
+    data["heatmap"] = location_index.cells(DASHBOARD_HEATMAP_ZOOM)
+    return data
+
+
+MAX_ROLLING_WINDOW = 365
+
+
+@cache.cached()
+@database.replica_reads
+def hour_weekday(start: datetime = None, end: datetime = None, target: str = None, location: str = None) -> list:
+    """amount of occurrences per weekday (rows, monday first) and hour of the day (columns),
+    optionally between start and end (both inclusive) and of a target or location
+    """
+    return columnar.columns().hour_weekday(start=start, end=end, target=target, location=location)
+
+
+@cache.cached()
+@database.replica_reads
+def streaks(target: str = None, location: str = None) -> list:
+    """Longest run of consecutive days with occurrences of every target, optionally only
+    at a location, and the current run (which ended today or yesterday). Longest first.
+
+    :return: [{"target": target, "longest": days, "longest_end": ISO 8601 last day, "current": days}]
+    """
+    return columnar.columns().streaks(date.today(), target=target, location=location)
+
+
+@cache.cached()
+@database.replica_reads
+def rolling_average(start: datetime, end: datetime, window: int = 7, target: str = None, location: str = None) -> dict:
+    """Average amount of occurrences per day over the window days up to every day between
+    start and end (both inclusive), optionally of a target or location.
+
+    :return: {"bucket": "day", "window": window, "labels": [ISO 8601 day], "series": {"total": [average]}}
+    """
+    if not 1 <= window <= MAX_ROLLING_WINDOW:
+        raise ValueError(f"window must be between 1 and {MAX_ROLLING_WINDOW} days")
+    if end < start:
+        raise ValueError("end must not be before start")
+    if _bucket_count(start, end, "day") > MAX_BUCKETS:
+        raise ValueError(f"a time series can have at most {MAX_BUCKETS} buckets")
+    return columnar.columns().rolling_average(start, end, window, target, location)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 """Run a debug webserver"""
-from kill_your_selfie.app import app
+from kill_your_selfie.app import create_app
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,56 @@
+import uuid
+
+import psycopg2
+import pytest
+
+from kill_your_selfie.config import Config
+
+
+@pytest.fixture(scope="session")
+def postgres_config():
+    """Config of a new Postgres database that is dropped after the tests, skips them without a database server"""
+    # imported here, so the tests that don't need a database run without one
+    from benchmarks.dataset import ephemeral_database  # pylint: disable=C0415
+
+    try:
+        psycopg2.connect(host=Config.DB_HOST, port=Config.DB_PORT, user=Config.DB_USERNAME,
+                         password=Config.DB_PASSWORD, dbname=Config.DB_DATABASE).close()
+    except psycopg2.OperationalError as exc:
+        pytest.skip(f"no database server: {exc}")
+    with ephemeral_database(f"kys_test_{uuid.uuid4().hex[:8]}", NTFY_ENDPOINT=None, BCRYPT_LOG_ROUNDS=4,
+                            LOGIN_ATTEMPTS_PER_USERNAME=1000, LOGIN_ATTEMPTS_PER_IP=1000) as config:
+        yield config
+
+
+@pytest.fixture(scope="session")
+def postgres_app(postgres_config):
+    """app on the test database"""
+    from kill_your_selfie.app import create_app  # pylint: disable=C0415
+
+    return create_app(postgres_config)
+
+
+@pytest.fixture
+def app_context(postgres_app):
+    with postgres_app.app_context():
+        yield postgres_app
+
+
+@pytest.fixture(scope="session")
+def admin_credentials(postgres_app):
+    """username and password of an admin user"""
+    from kill_your_selfie import auth  # pylint: disable=C0415
+
+    with postgres_app.app_context():
+        auth.create_user("test-admin", "test-admin@example.com", "admin password", admin=True)
+    return "test-admin", "admin password"
+
+
+@pytest.fixture
+def admin_client(postgres_app, admin_credentials):
+    """test client logged in as an admin"""
+    client = postgres_app.test_client()
+    username, password = admin_credentials
+    response = client.post("/login", data={"username": username, "password": password})
+    assert response.status_code == 302
+    return client
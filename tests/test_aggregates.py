@@ -0,0 +1,47 @@
+from flask import current_app
+
+from kill_your_selfie import aggregates, cache, database
+
+
+def _fresh(max_staleness: float) -> bool:
+    freshness = current_app.extensions["aggregate_freshness"]
+    freshness.max_staleness, freshness.until = max_staleness, 0.0
+    return aggregates.fresh()
+
+
+def test_views_are_fresh_within_the_staleness_bound(app_context):  # pylint: disable=W0613
+    aggregates.refresh(force=True)
+    assert _fresh(0)
+
+    aggregates.mark_stale()
+    database.commit()
+    # the views miss a write that is younger than their refresh
+    assert _fresh(300)
+    assert not _fresh(0)
+
+    assert aggregates.refresh()
+    assert _fresh(0)
+
+
+def test_fresh_keeps_its_answer(app_context):  # pylint: disable=W0613
+    aggregates.refresh(force=True)
+    assert _fresh(300)
+    aggregates.mark_stale()
+    database.commit()
+    current_app.extensions["aggregate_freshness"].max_staleness = 0
+    assert aggregates.fresh()
+
+
+def test_scheduler_starts_with_the_first_request(postgres_app):
+    scheduler = postgres_app.extensions["aggregate_scheduler"]
+    postgres_app.test_client().get("/login")
+    assert scheduler._thread is not None and scheduler._thread.is_alive()  # pylint: disable=W0212
+
+
+def test_refresh_only_invalidates_the_stats(app_context):  # pylint: disable=W0613
+    aggregates.mark_stale()
+    database.commit()
+    stats_version, occurrences_version = cache.version(), cache.version(cache.OCCURRENCES)
+    assert aggregates.refresh()
+    assert cache.version() > stats_version
+    assert cache.version(cache.OCCURRENCES) == occurrences_version
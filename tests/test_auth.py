@@ -0,0 +1,81 @@
+import pytest
+
+from kill_your_selfie import auth, database, models
+from kill_your_selfie.app import create_app
+
+
+@pytest.fixture
+def login_limits(postgres_app):  # pylint: disable=W0613
+    """set the login limits of a test, restoring those of the test app afterwards"""
+    yield auth.init_login_limits
+    auth.init_login_limits(1000, 1000, 60)
+
+
+def _login(client, username: str, password: str = "wrong", remote_addr: str = "192.0.2.1", **headers) -> int:
+    return client.post("/login", data={"username": username, "password": password},
+                       environ_base={"REMOTE_ADDR": remote_addr}, headers=headers).status_code
+
+
+def test_login_limit_per_username(postgres_app, login_limits):
+    login_limits(2, 100, 60)
+    client = postgres_app.test_client()
+    assert [_login(client, "limited user") for _ in range(3)] == [200, 200, 429]
+    # the username is limited case insensitively, other usernames aren't
+    assert _login(client, "Limited User") == 429
+    assert _login(client, "another user") == 200
+
+
+def test_login_limit_per_ip(postgres_app, login_limits):
+    login_limits(100, 2, 60)
+    client = postgres_app.test_client()
+    assert [_login(client, f"user {number}") for number in range(3)] == [200, 200, 429]
+    assert _login(client, "user 3", remote_addr="192.0.2.2") == 200
+
+
+def test_login_limit_per_ip_behind_a_proxy(postgres_config, login_limits):
+    app = create_app(type("ProxyConfig", (postgres_config,), {"TRUSTED_PROXIES": 1}))
+    login_limits(100, 2, 60)
+    client = app.test_client()
+    # every request comes from the proxy, the limit applies to the client address it forwards
+    assert [_login(client, f"user {number}", remote_addr="10.0.0.1", **{"X-Forwarded-For": "192.0.2.3"})
+            for number in range(3)] == [200, 200, 429]
+    assert _login(client, "user 3", remote_addr="10.0.0.1", **{"X-Forwarded-For": "192.0.2.4"}) == 200
+
+
+def test_dummy_hash_is_computed_in_advance(postgres_app):  # pylint: disable=W0613
+    assert auth._dummy_hash is not None  # pylint: disable=W0212
+
+
+def test_wrong_password_and_unknown_user(postgres_app, admin_credentials):
+    client = postgres_app.test_client()
+    username, password = admin_credentials
+    assert b"Wrong username or password" in client.post("/login", data={"username": username, "password": "x"}).data
+    assert b"Wrong username or password" in client.post("/login", data={"username": "nobody", "password": password}).data
+
+
+def test_loaded_users_are_cached_until_invalidated(app_context):  # pylint: disable=W0613
+    auth.create_user("cached user", "cached@example.com", "password")
+    user = models.User.query.filter_by(username="cached user").one()
+    assert auth.load_user(str(user.id)).email == "cached@example.com"
+
+    user.email = "changed@example.com"
+    database.commit()
+    assert auth.load_user(str(user.id)).email == "cached@example.com"
+    auth.invalidate_user_cache()
+    assert auth.load_user(str(user.id)).email == "changed@example.com"
+
+    auth.update_user(str(user.id), "renamed user")
+    assert auth.load_user(str(user.id)).username == "renamed user"
+
+
+def test_revoked_admin_rights_apply_right_away(admin_client, postgres_app, admin_credentials):
+    assert admin_client.get("/api/occurrences").status_code == 200
+    with postgres_app.app_context():
+        # a change without invalidating the user cache, like one made by a worker on another host
+        models.User.query.filter_by(username=admin_credentials[0]).update({"admin": False})
+        database.commit()
+    try:
+        assert admin_client.get("/api/occurrences").status_code == 401
+    finally:
+        with postgres_app.app_context():
+            auth.set_admin(admin_credentials[0], True)
@@ -0,0 +1,94 @@
+import io
+from datetime import datetime
+
+import pytest
+
+from kill_your_selfie import bulk, cache, models
+
+
+def _record(minute: int, location: str = "school", target: str = "homework", context: str = "") -> dict:
+    return {"time": f"1990-01-01T12:{minute:02}:00", "location": location, "target": target, "context": context}
+
+
+def test_parse_record():
+    assert bulk.parse_record(_record(1, context=None)) == {
+        "time": datetime(1990, 1, 1, 12, 1), "location_label": "school", "target": "homework", "context": "",
+    }
+
+
+@pytest.mark.parametrize("record", [
+    {"location": "school", "target": "homework"},
+    {**_record(1), "time": "yesterday"},
+    {**_record(1), "time": None},
+    {**_record(1), "target": 3},
+    ["1990-01-01T12:01:00", "school", "homework"],
+    _record(1, location="x" * (bulk.MAX_LENGTHS["location_label"] + 1)),
+    _record(1, target="x" * (bulk.MAX_LENGTHS["target"] + 1)),
+])
+def test_parse_invalid_record(record):
+    assert bulk.parse_record(record) is None
+
+
+def test_parse_rows():
+    csv_rows = bulk.parse_rows(io.StringIO("time,location,target,context\n1990-01-01T12:01:00,school,bus,\nnow,a,b,\n"),
+                               "csv")
+    jsonl_rows = bulk.parse_rows(io.StringIO('{"time": "1990-01-01T12:01:00", "location": "school", "target": "bus"}\n'
+                                             '\n{"location": "school"}\n'), "jsonl")
+    for rows in (csv_rows, jsonl_rows):
+        first, second = rows
+        assert first["time"] == datetime(1990, 1, 1, 12, 1) and first["target"] == "bus"
+        assert second is None
+
+
+def test_parse_rows_with_broken_lines():
+    """lines that aren't json or UTF-8 are invalid rows, the rows after them are still parsed"""
+    data = ('{"time": "1990-01-01T12:01:00", "location": "sch'.encode() + b"\xff" + b'ool", "target": "bus"}\n'
+            + b'{"time": "1990-01-01T12:02:00", "location":\n'
+            + b'{"time": "1990-01-01T12:03:00", "location": "school", "target": "bus"}\n')
+    rows = list(bulk.parse_rows(io.TextIOWrapper(io.BytesIO(data), encoding="utf-8", errors="surrogateescape"), "jsonl"))
+    assert rows[:2] == [None, None]
+    assert rows[2]["time"] == datetime(1990, 1, 1, 12, 3)
+
+
+def test_format_from_filename():
+    assert bulk.format_from_filename("export.CSV") == "csv"
+    assert bulk.format_from_filename("export.json") == "jsonl"
+    with pytest.raises(ValueError):
+        bulk.format_from_filename("export.xlsx")
+
+
+def test_import_batch_statuses(app_context):  # pylint: disable=W0613
+    assert bulk.import_batch([_record(1), _record(2)]) == ["created", "created"]
+    assert bulk.import_batch([
+        _record(1),  # sent again
+        _record(2, target="bus"),  # another occurrence at a time that is taken
+        _record(3),
+        _record(3),  # twice in the same batch
+        _record(4, target="bus"),
+        _record(4),  # a different one later in the same batch
+        {"time": "now", "location": "school", "target": "homework"},
+        _record(5, target="x" * (bulk.MAX_LENGTHS["target"] + 1)),
+    ]) == ["duplicate", "conflict", "created", "duplicate", "created", "conflict", "invalid", "invalid"]
+    assert models.Occurrence.query.filter_by(time=datetime(1990, 1, 1, 12, 4)).one().target == "bus"
+
+
+def test_import_rows_result(app_context):  # pylint: disable=W0613
+    rows = [bulk.parse_record(_record(minute, location="station")) for minute in (10, 11, 10)] + [None]
+    result = bulk.import_rows(rows, batch_size=2)
+    assert result.inserted == 2
+    assert result.duplicates == [datetime(1990, 1, 1, 12, 10)]
+    assert result.invalid == [4]
+    assert models.Location.query.filter_by(label="station").count() == 1
+    assert sum(count.amount for count in models.DailyCount.query.filter_by(location_label="station")) == 2
+
+
+def test_failed_import_invalidates_the_cache(app_context):  # pylint: disable=W0613
+    def rows():
+        yield bulk.parse_record(_record(20, location="library"))
+        raise OSError("connection reset")
+
+    version = cache.version()
+    with pytest.raises(OSError):
+        bulk.import_rows(rows(), batch_size=1)
+    assert cache.version() > version
+    assert models.Occurrence.query.filter_by(location_label="library").count() == 1
@@ -0,0 +1,103 @@
+import pytest
+
+from kill_your_selfie import cache
+
+
+@pytest.fixture(params=["sqlite", "lru"])
+def configured(request, tmp_path, monkeypatch):
+    """cache with a backend on a new file, restoring the module's backend afterwards"""
+    monkeypatch.setattr(cache, "_backend", cache._backend)  # pylint: disable=W0212
+    monkeypatch.setattr(cache, "_versions", cache._versions)  # pylint: disable=W0212
+    path = str(tmp_path / "cache.sqlite3")
+    cache.configure(request.param, path, max_size=4)
+    return path
+
+
+def test_cached_until_version_is_bumped(configured):  # pylint: disable=W0613
+    calls = []
+
+    @cache.cached("test")
+    def compute(value):
+        calls.append(value)
+        return value * len(calls)
+
+    assert compute(2) == 2
+    assert compute(2) == 2
+    assert compute(3) == 6
+    assert calls == [2, 3]
+
+    cache.bump_version("test")
+    assert compute(2) == 6
+    assert calls == [2, 3, 2]
+
+
+def test_bump_only_invalidates_its_namespace(configured):  # pylint: disable=W0613
+    calls = []
+
+    @cache.cached("other")
+    def compute():
+        calls.append(None)
+        return len(calls)
+
+    assert compute() == 1
+    cache.bump_version("test")
+    assert compute() == 1
+
+
+def test_versions_are_shared_through_the_file(configured):
+    other_process = cache.VersionStore(configured)
+    version = cache.version("test")
+    changed_at = other_process.get_changed_at("test")
+    assert other_process.get_version("test") == version
+
+    other_process.bump_version("test")
+    assert cache.version("test") == version + 1
+    assert cache.last_modified("test").timestamp() >= changed_at
+
+
+def test_lru_evicts_least_recently_used():
+    backend = cache.LRUBackend(max_size=2)
+    backend.set("test", "a", 1)
+    backend.set("test", "b", 2)
+    assert backend.get("a") == (True, 1)
+    backend.set("test", "c", 3)
+    assert backend.get("b") == (False, None)
+    assert backend.get("a") == (True, 1)
+
+
+@pytest.mark.parametrize("backend", [cache.LRUBackend, cache.SQLiteBackend])
+def test_discard_only_removes_its_namespace(backend, tmp_path):
+    store = backend(str(tmp_path / "cache.sqlite3")) if backend is cache.SQLiteBackend else backend()
+    store.set("test", "a", 1)
+    store.set("other", "b", 2)
+    store.discard("test")
+    assert store.get("a") == (False, None)
+    assert store.get("b") == (True, 2)
+
+
+def test_unknown_backend(tmp_path):
+    with pytest.raises(ValueError):
+        cache.configure("redis", str(tmp_path / "cache.sqlite3"))
+
+
+def test_snapshot_versions_follow_the_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "_backend", cache._backend)  # pylint: disable=W0212
+    monkeypatch.setattr(cache, "_versions", cache._versions)  # pylint: disable=W0212
+    snapshot = tmp_path / "snapshot.sqlite3"
+    snapshot.write_text("old")
+    cache.configure("sqlite", str(tmp_path / "cache.sqlite3"), snapshot=str(snapshot))
+    calls = []
+
+    @cache.cached("test")
+    def compute():
+        calls.append(None)
+        return len(calls)
+
+    assert compute() == 1
+    assert compute() == 1
+
+    # like snapshot.write, replace the file with a new one
+    replacement = tmp_path / "snapshot.sqlite3.tmp"
+    replacement.write_text("new")
+    replacement.replace(snapshot)
+    assert compute() == 2
@@ -0,0 +1,78 @@
+import time
+from datetime import datetime
+
+import pytest
+from sqlalchemy import column, create_engine, literal, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from kill_your_selfie import database
+from kill_your_selfie.database import date_trunc
+
+
+@pytest.mark.parametrize(("bucket", "expected"), [
+    ("hour", datetime(2024, 5, 15, 13)),
+    ("day", datetime(2024, 5, 15)),
+    ("week", datetime(2024, 5, 13)),  # the monday before
+    ("month", datetime(2024, 5, 1)),
+])
+def test_date_trunc_on_sqlite(bucket, expected):
+    engine = create_engine("sqlite://")
+    with engine.connect() as connection:
+        assert connection.scalar(select(date_trunc(bucket, literal(datetime(2024, 5, 15, 13, 42, 7))))) == expected
+
+
+@pytest.mark.parametrize("day", ["2024-05-13", "2024-05-19"])
+def test_date_trunc_week_on_sqlite_boundaries(day):
+    """a monday stays on itself, a sunday goes back to the monday before"""
+    engine = create_engine("sqlite://")
+    with engine.connect() as connection:
+        truncated = connection.scalar(select(date_trunc("week", literal(datetime.fromisoformat(day)))))
+    assert truncated == datetime(2024, 5, 13)
+
+
+def test_date_trunc_compiles_per_dialect():
+    expression = date_trunc("day", column("time"))
+    assert str(expression.compile(dialect=postgresql.dialect())) == "DATE_TRUNC('day', CAST(time AS TIMESTAMP))"
+    assert str(expression.compile(dialect=sqlite.dialect())) == "datetime(time, 'start of day')"
+
+
+def test_date_trunc_unknown_bucket():
+    with pytest.raises(ValueError):
+        date_trunc("year", column("time"))
+
+
+@pytest.fixture
+def replica_app(postgres_config, monkeypatch):
+    """app with the test database as its read replica as well, recording the read target of every request"""
+    from kill_your_selfie.app import create_app  # pylint: disable=C0415
+
+    monkeypatch.setattr(database, "_replicas", database._replicas)  # pylint: disable=W0212
+    monkeypatch.setattr(database, "_replica_lag_seconds", database._replica_lag_seconds)  # pylint: disable=W0212
+    app = create_app(type("ReplicaConfig", (postgres_config,), {
+        "DB_REPLICA_URLS": [database.database_url(postgres_config)], "DB_REPLICA_LAG_SECONDS": 0.5,
+    }))
+    app.read_targets = []
+
+    @app.after_request
+    def record_read_target(response):
+        app.read_targets.append(database.read_target())
+        return response
+
+    return app
+
+
+def test_reads_stick_to_the_primary_after_a_write(replica_app, admin_credentials):
+    client = replica_app.test_client()
+    client.get("/login")
+    username, password = admin_credentials
+    assert client.post("/login", data={"username": username, "password": password}).status_code == 302
+    client.get("/login")
+    time.sleep(0.6)
+    client.get("/login")
+    assert replica_app.read_targets == ["replica_0", "replica_0", database.PRIMARY, "replica_0"]
+
+
+def test_replica_reads_use_the_replica(replica_app):
+    with replica_app.test_request_context(), database.reading_from("replica_0"):
+        assert database.replica_reads(database.db.session.get_bind)() is database.db.engines["replica_0"]
+        assert database.db.session.get_bind() is database.db.engine
@@ -0,0 +1,21 @@
+import pytest
+
+from kill_your_selfie.app import create_app
+
+
+@pytest.fixture
+def token_app(postgres_config):
+    return create_app(type("MetricsConfig", (postgres_config,), {"METRICS_TOKEN": "scrape token"}))
+
+
+def test_metrics_need_authentication(token_app):
+    client = token_app.test_client()
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer scrape token"})
+    assert response.status_code == 200
+    assert b"# TYPE" in response.data
+
+
+def test_metrics_for_admins(admin_client):
+    assert admin_client.get("/metrics").status_code == 200
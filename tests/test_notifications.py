@@ -0,0 +1,131 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from kill_your_selfie.notifications import NtfyController, NtfyDispatcher
+
+
+class _NtfyStub(BaseHTTPRequestHandler):
+    """ntfy server that records the messages, failing the first server.failures of them,
+    and answering only once server.answer is set
+    """
+
+    def do_POST(self):  # pylint: disable=C0103
+        self.server.answer.wait()
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        with self.server.lock:
+            self.server.attempts += 1
+            failed = self.server.attempts <= self.server.failures
+            if not failed:
+                self.server.received.append((data, dict(self.headers)))
+        self.send_response(500 if failed else 200)
+        self.end_headers()
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        pass
+
+
+@pytest.fixture
+def ntfy_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _NtfyStub)
+    server.lock = threading.Lock()
+    server.attempts = server.failures = 0
+    server.received = []
+    server.answer = threading.Event()
+    server.answer.set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.answer.set()
+    server.shutdown()
+    server.server_close()
+
+
+def _endpoint(server) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}/kys"
+
+
+def test_sends_notification(ntfy_server):
+    controller = NtfyController("Bearer token", _endpoint(ntfy_server))
+    controller.sendNotification("a message", title="A title", tags="test", priority="3")
+    assert controller.dispatcher.flush()
+    controller.dispatcher.close()
+
+    [(data, headers)] = ntfy_server.received
+    assert data == "a message"
+    assert headers["Authorization"] == "Bearer token"
+    assert headers["Title"] == "A title"
+    assert headers["Tags"] == "test"
+    assert headers["Priority"] == "3"
+
+
+def test_retries_failed_posts(ntfy_server):
+    ntfy_server.failures = 2
+    dispatcher = NtfyDispatcher(_endpoint(ntfy_server), retries=3, backoff=0.01)
+    dispatcher.submit("retried", {"Title": "retry"})
+    assert dispatcher.flush()
+    dispatcher.close()
+
+    assert ntfy_server.attempts == 3
+    assert [data for data, _ in ntfy_server.received] == ["retried"]
+
+
+def test_gives_up_after_retries(ntfy_server):
+    ntfy_server.failures = 10
+    dispatcher = NtfyDispatcher(_endpoint(ntfy_server), retries=1, backoff=0.01)
+    dispatcher.submit("lost", {"Title": "lost"})
+    assert dispatcher.flush()
+    dispatcher.close()
+
+    assert ntfy_server.attempts == 2
+    assert not ntfy_server.received
+
+
+def test_coalesces_messages(ntfy_server):
+    dispatcher = NtfyDispatcher(_endpoint(ntfy_server), coalesce_window=0.5)
+    dispatcher.submit("first", {"Title": "one", "Tags": "newoccurrence", "Priority": "3"})
+    dispatcher.submit("second", {"Title": "two", "Tags": "newuser", "Priority": "4"})
+    assert dispatcher.flush()
+    dispatcher.close()
+
+    [(data, headers)] = ntfy_server.received
+    assert data == "**one**\nfirst\n\n**two**\nsecond"
+    assert headers["Title"] == "2 new notifications"
+    assert headers["Tags"] == "newoccurrence,newuser"
+    assert headers["Priority"] == "4"
+
+
+def test_drops_messages_when_queue_is_full(ntfy_server):
+    ntfy_server.answer.clear()
+    dispatcher = NtfyDispatcher(_endpoint(ntfy_server), queue_size=1)
+    assert dispatcher.submit("sent", {"Title": "sent"})
+    # wait until the background thread is posting the first message, so the queue is empty
+    deadline = time.monotonic() + 5
+    while not dispatcher._queue.empty() and time.monotonic() < deadline:  # pylint: disable=W0212
+        time.sleep(0.01)
+    assert dispatcher.submit("queued", {"Title": "queued"})
+    assert not dispatcher.submit("dropped", {"Title": "dropped"})
+    ntfy_server.answer.set()
+    assert dispatcher.flush()
+    dispatcher.close()
+
+    assert [data for data, _ in ntfy_server.received] == ["sent", "queued"]
+
+
+def test_close_with_a_full_queue(ntfy_server):
+    ntfy_server.answer.clear()
+    dispatcher = NtfyDispatcher(_endpoint(ntfy_server), queue_size=1, retries=0)
+    dispatcher.submit("sent", {"Title": "sent"})
+    deadline = time.monotonic() + 5
+    while not dispatcher._queue.empty() and time.monotonic() < deadline:  # pylint: disable=W0212
+        time.sleep(0.01)
+    assert dispatcher.submit("queued", {"Title": "queued"})
+
+    start = time.monotonic()
+    dispatcher.close(timeout=0.2)
+    assert time.monotonic() - start < 1
+    ntfy_server.answer.set()
+    dispatcher._thread.join(5)  # pylint: disable=W0212
+    assert not dispatcher._thread.is_alive()  # pylint: disable=W0212
+    assert [data for data, _ in ntfy_server.received] == ["sent"]
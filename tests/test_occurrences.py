@@ -0,0 +1,44 @@
+from kill_your_selfie import bulk
+from kill_your_selfie.occurrences import OptionIndex
+
+
+def test_option_search():
+    index = OptionIndex(lambda: [("Bus", 3), ("bike", 5), ("boat", 3), ("car", 9), ("Bicycle", 1)])
+    assert index.search("b") == ["bike", "boat", "Bus", "Bicycle"]
+    assert index.search("B", limit=2) == ["bike", "boat"]
+    assert index.search("bi") == ["bike", "Bicycle"]
+    assert index.search("", limit=1) == ["car"]
+    assert index.search("x") == []
+
+
+def test_options_limit_is_clamped(admin_client, postgres_app):
+    with postgres_app.app_context():
+        bulk.import_batch([{"time": f"1993-01-01T10:0{minute}:00", "location": f"limit {minute}", "target": "rain"}
+                           for minute in range(3)])
+    assert len(admin_client.get("/api/options/location?prefix=limit&limit=-1").get_json()) == 1
+    assert len(admin_client.get("/api/options/location?prefix=limit&limit=0").get_json()) == 1
+    assert len(admin_client.get("/api/options/location?prefix=limit&limit=2").get_json()) == 2
+
+
+def test_history_pages_in_both_directions(admin_client, postgres_app):
+    with postgres_app.app_context():
+        bulk.import_batch([{"time": f"1994-01-01T10:0{number}:00", "location": "office", "target": "paging"}
+                           for number in range(1, 8)])
+
+    def page(**cursor):
+        response = admin_client.get("/api/occurrences", query_string={"target": "paging", "limit": 3, **cursor})
+        assert response.status_code == 200
+        data = response.get_json()
+        return [int(occurrence["time"][15]) for occurrence in data["occurrences"]], data["newer"], data["older"]
+
+    first = page()
+    assert first[:2] == ([7, 6, 5], None)
+    second = page(before=first[2])
+    assert second[0] == [4, 3, 2]
+    last = page(before=second[2])
+    assert last[0] == [1] and last[2] is None
+
+    assert page(after=last[1])[0] == [4, 3, 2]
+    back = page(after=second[1])
+    assert back[0] == [7, 6, 5] and back[1] is None
+    assert admin_client.get("/occurrences", query_string={"target": "paging", "before": second[2]}).status_code == 200
@@ -0,0 +1,77 @@
+import pytest
+
+from kill_your_selfie import cache, spatial
+
+LOCATIONS = [
+    ("dam", 52.3731, 4.8926, 3),
+    ("central station", 52.3791, 4.9003, 1),
+    ("utrecht", 52.0907, 5.1214, 2),
+    ("east of the antimeridian", -17.7, 179.9, 4),
+    ("west of the antimeridian", -17.7, -179.9, 5),
+]
+
+
+def test_geohash_bounds_contain_the_location():
+    assert spatial.encode(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    for _, latitude, longitude, _ in LOCATIONS:
+        south, west, north, east = spatial.bounds(spatial.encode(latitude, longitude))
+        assert south <= latitude <= north and west <= longitude <= east
+        assert (north - south, east - west) == pytest.approx(spatial.cell_size(spatial.MAX_PRECISION))
+
+
+def test_nearby_is_nearest_first_within_the_radius():
+    index = spatial.LocationIndex(lambda: LOCATIONS)
+    found = index.nearby(52.3730, 4.8925, 1000)
+    assert [location["label"] for location in found] == ["dam", "central station"]
+    assert found[0]["distance"] < found[1]["distance"] <= 1000
+    assert found[0]["amount"] == 3
+    assert [location["label"] for location in index.nearby(52.3730, 4.8925, 50000)] == [
+        "dam", "central station", "utrecht"]
+    assert [location["label"] for location in index.nearby(52.3730, 4.8925, 50000, limit=1)] == ["dam"]
+    # the search box wraps around the antimeridian
+    assert sorted(location["label"] for location in index.nearby(-17.7, 180, 20000)) == [
+        "east of the antimeridian", "west of the antimeridian"]
+    assert index.nearby(0, 0, 1000) == []
+
+
+@pytest.mark.parametrize("latitude, longitude, radius", [(91, 0, 10), (0, 181, 10), (0, 0, 0), (0, 0, 50001)])
+def test_nearby_rejects_invalid_arguments(latitude, longitude, radius):
+    with pytest.raises(ValueError):
+        spatial.LocationIndex(lambda: LOCATIONS).nearby(latitude, longitude, radius)
+
+
+def test_heatmap_cells_per_zoom_and_bbox():
+    index = spatial.LocationIndex(lambda: LOCATIONS)
+    # at the finest zoom every location is a cell of its own, at the coarsest Amsterdam and Utrecht are one
+    assert len(index.cells(spatial.MAX_ZOOM)) == len(LOCATIONS)
+    netherlands = [cell for cell in index.cells(0) if cell[0] > 0]
+    assert len(netherlands) == 1 and netherlands[0][2] == 6
+    assert netherlands[0][0] == pytest.approx((52.3731 * 3 + 52.3791 + 52.0907 * 2) / 6)
+    assert sorted(amount for _, _, amount in index.cells(spatial.MAX_ZOOM, spatial.parse_bbox("4.8,52.3,5,52.4"))) == [
+        1, 3]
+    crossing = spatial.parse_bbox("179,-18,181,-17")
+    assert sorted(amount for _, _, amount in index.cells(spatial.MAX_ZOOM, crossing)) == [4, 5]
+    with pytest.raises(ValueError):
+        index.cells(spatial.MAX_ZOOM + 1)
+
+
+def test_heatmap_cells_follow_writes():
+    index = spatial.LocationIndex(lambda: LOCATIONS)
+    index.cells(spatial.MAX_ZOOM)
+    cache.bump_version()
+    index.add("dam")
+    assert (52.3731, 4.8926, 4) in index.cells(spatial.MAX_ZOOM)
+
+
+@pytest.mark.parametrize("bbox", ["1,2,3", "a,b,c,d", "3,0,1,1", "0,1,1,0", "nan,0,1,1"])
+def test_parse_bbox_rejects_invalid_boxes(bbox):
+    with pytest.raises(ValueError):
+        spatial.parse_bbox(bbox)
+
+
+def test_spatial_endpoints_validate_parameters(admin_client):
+    assert admin_client.get("/api/heatmap?zoom=x").status_code == 400
+    assert admin_client.get("/api/heatmap?zoom=3&bbox=1,2,3").status_code == 400
+    assert admin_client.get("/api/heatmap?zoom=3&bbox=-180,-90,180,90").status_code == 200
+    assert admin_client.get("/api/locations/nearby?latitude=0&longitude=0&radius=100000").status_code == 400
+    assert admin_client.get("/api/locations/nearby?latitude=0&longitude=0&radius=100").get_json() is not None
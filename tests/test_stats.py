@@ -0,0 +1,25 @@
+import pytest
+
+from kill_your_selfie import bulk
+
+
+@pytest.fixture(scope="module")
+def occurrence(postgres_app):
+    with postgres_app.app_context():
+        bulk.import_batch([{"time": "1991-06-02T10:00:00", "location": "park", "target": "rain"}])
+
+
+@pytest.mark.parametrize(("start", "end"), [
+    ("1991-06-01T00:00:00+02:00", "1991-06-03T00:00:00+02:00"),
+    ("1991-06-01T00:00:00Z", "1991-06-03"),
+])
+def test_timeseries_with_time_zone_offsets(admin_client, occurrence, start, end):  # pylint: disable=W0613
+    response = admin_client.get("/api/stats/timeseries", query_string={"from": start, "to": end, "bucket": "day"})
+    assert response.status_code == 200
+    data = response.get_json()
+    assert sum(data["series"]["total"]) == 1
+
+
+def test_timeseries_invalid_time(admin_client):
+    response = admin_client.get("/api/stats/timeseries", query_string={"from": "yesterday", "to": "1991-06-03"})
+    assert response.status_code == 400